@@ -1,23 +1,154 @@
 import csv as csv
 import logging
 import os
-from typing import Any
+import threading
+from functools import lru_cache
+from typing import Any, Optional
 
-import nibabel as nib
 import numpy as np
 import pandas as pd
+from scipy import sparse
+
+from .nifti_io import get_slabs, load_nii
+from .parallel import run_tasks
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename="pipeline.log", encoding="utf-8", level=logging.DEBUG)
 
 
+def count_labels(img: np.ndarray, chunk_size: int = 1 << 22) -> np.ndarray:
+    """
+    Counts the voxels of each label in a label map, in a single pass over the image
+    in its stored integer type (non-integer images are truncated to int, and
+    negative values are ignored). The image is processed in chunks, so that no
+    full size temporary array is created
+
+    :param img: the label map
+    :type img: np.ndarray
+    :param chunk_size: the number of voxels counted at once
+    :type chunk_size: int
+
+    :return: the number of voxels of each label (indexed by the label value)
+    :rtype: np.ndarray
+    """
+    # Flatten in memory order (no copy for C or F ordered arrays)
+    vec = img.ravel(order="K")
+    if vec.size == 0:
+        return np.zeros(1, dtype=np.int64)
+
+    # Types that bincount can not read directly (float, uint64) are converted to
+    # int, one chunk at a time
+    is_native = vec.dtype.kind == "i" or (
+        vec.dtype.kind == "u" and vec.dtype.itemsize < 8
+    )
+    max_label = max(int(vec.max()), 0)
+    counts = np.zeros(max_label + 1, dtype=np.int64)
+    for i in range(0, vec.size, chunk_size):
+        chunk = vec[i : i + chunk_size]
+        if not is_native:
+            chunk = chunk.astype(np.int64)
+        if chunk.dtype.kind == "i" and chunk.min() < 0:
+            chunk = chunk[chunk >= 0]
+        counts += np.bincount(chunk, minlength=max_label + 1)
+    return counts
+
+
+def get_label_counts(in_img: Any, slab_memory: Optional[int] = None) -> tuple:
+    """
+    Calculates the label histogram of a label map
+
+    :param in_img: the input image (filename or image in memory)
+    :type in_img: niftii image
+    :param slab_memory: if given (in MB), the image is read one slab at a time,
+                        using about this much memory
+    :type slab_memory: int
+
+    :return: the number of voxels of each label (indexed by the label value) and
+             the voxel size
+    :rtype: tuple
+    """
+    # Read image (in the stored data type, without a float copy)
+    if slab_memory is None:
+        nii = load_nii(in_img)
+        cnt = count_labels(np.asanyarray(nii.dataobj))
+    else:
+        nii = load_nii(in_img, keep_file_open=True)
+        cnt = np.zeros(1, dtype=np.int64)
+        # About 8 bytes per voxel: the stored slab and its int64 chunks
+        for slicer in get_slabs(nii.shape, 8, slab_memory):
+            cnt_slab = count_labels(np.asanyarray(nii.dataobj[slicer]))
+            if len(cnt_slab) > len(cnt):
+                cnt = np.pad(cnt, (0, len(cnt_slab) - len(cnt)))
+            cnt[: len(cnt_slab)] += cnt_slab
+
+    # Get voxel size
+    vox_size = np.prod(nii.header.get_zooms()[0:3])
+    return cnt, vox_size
+
+
+def counts_to_volumes(counts: Any, vox_size: Any, label_indices: Any) -> np.ndarray:
+    """
+    Calculates roi volumes from label histograms
+
+    :param counts: the label histogram of each subject (one row per subject, or a
+                   single histogram)
+    :type counts: np.ndarray
+    :param vox_size: the voxel size of each subject
+    :type vox_size: np.ndarray
+    :param label_indices: the selected labels (label 0 has volume 0)
+    :type label_indices: Any
+
+    :return: the volumes of the selected labels (one row per subject)
+    :rtype: np.ndarray
+    """
+    counts = np.atleast_2d(counts)
+    label_indices = np.array(label_indices, dtype=int)
+
+    # Get volumes for all rois
+    n_labels = np.max([label_indices.max(initial=0), counts.shape[1] - 1]) + 1
+    tmp_cnt = np.zeros((counts.shape[0], n_labels))
+    tmp_cnt[:, : counts.shape[1]] = counts
+    tmp_cnt[:, 0] = 0
+
+    # Get volumes for selected rois
+    sel_cnt = tmp_cnt[:, label_indices]
+    return sel_cnt * np.reshape(vox_size, (-1, 1))
+
+
+def get_roi_volumes(in_img: Any, label_indices: Any = ()) -> tuple:
+    """
+    Calculates the volumes of rois
+
+    :param in_img: the input image (filename or image in memory)
+    :type in_img: niftii image
+    :param label_indices: the label indices. If empty, all labels in the image
+                          (except 0) are used
+    :type label_indices: Any
+
+    :return: the label indices and the volume of each label
+    :rtype: tuple
+    """
+
+    # Keep input lists as arrays
+    label_indices = np.array(label_indices, dtype=int)
+
+    cnt, vox_size = get_label_counts(in_img)
+
+    # Get label indices (excluding 0)
+    if label_indices.shape[0] == 0:
+        # logger.warning('Label indices not provided, generating from data')
+        label_indices = np.nonzero(cnt[1:])[0] + 1
+
+    return label_indices, counts_to_volumes(cnt, vox_size, label_indices)[0]
+
+
 def calc_roi_volumes(mrid: Any, in_img: Any, label_indices: np.ndarray) -> pd.DataFrame:
     """
     Creates a dataframe with the volumes of rois
 
     :param mrid: the input mrid
     :type mrid: Any
-    :param in_img: the input image
+    :param in_img: the input image (filename or image in memory)
     :type in_img: niftii image
     :param label_indices: passed label indices
     :type label_indices: np.ndarray
@@ -25,78 +156,154 @@ def calc_roi_volumes(mrid: Any, in_img: Any, label_indices: np.ndarray) -> pd.Da
     :return: Dataframe with details of images
     :rtype: pd.DataFrame
     """
+    label_indices, sel_vol = get_roi_volumes(in_img, label_indices)
+    label_names = label_indices.astype(str)
 
-    # Keep input lists as arrays
-    label_indices = np.array(label_indices)
+    # Create dataframe
+    df_out = pd.DataFrame(
+        index=[mrid], columns=label_names, data=sel_vol.reshape(1, -1)
+    )
+    df_out = df_out.reset_index().rename({"index": "MRID"}, axis=1)
 
-    # Read image
-    nii = nib.load(in_img)
-    img_vec = nii.get_fdata().flatten().astype(int)
+    # Return output dataframe
+    return df_out
 
-    # Get counts of unique indices (excluding 0)
-    img_vec = img_vec[img_vec != 0]
-    u_ind, u_cnt = np.unique(img_vec, return_counts=True)
 
-    # Get label indices
-    if label_indices.shape[0] == 0:
-        # logger.warning('Label indices not provided, generating from data')
-        label_indices = u_ind
+@lru_cache(maxsize=None)
+def get_single_roi_indices(list_single_roi: str) -> tuple:
+    """
+    Returns the indices of the single MUSE rois (from the single roi list, with the
+    cortical CSF roi added with index 1), in the order of the roi csv columns
 
-    label_names = label_indices.astype(str)
+    :param list_single_roi: single roi list file
+    :type list_single_roi: str
 
-    # Get voxel size
-    vox_size = np.prod(nii.header.get_zooms()[0:3])
+    :return: the roi indices
+    :rtype: tuple
+    """
+    df_map = pd.read_csv(list_single_roi)
+    df_map = df_map[["IndexMUSE", "ROINameMUSE"]]
 
-    # Get volumes for all rois
-    tmp_cnt = np.zeros(np.max([label_indices.max(), u_ind.max()]) + 1)
-    tmp_cnt[u_ind] = u_cnt
+    # Add ROI for cortical CSF with index set to 1
+    df_map.loc[len(df_map)] = [1, "Cortical CSF"]
+    df_map = df_map.sort_values("IndexMUSE")
 
-    # Get volumes for selected rois
-    sel_cnt = tmp_cnt[label_indices]
-    sel_vol = (sel_cnt * vox_size).reshape(1, -1)
+    return tuple(df_map.IndexMUSE.tolist()[1:])
 
-    # Create dataframe
-    df_out = pd.DataFrame(index=[mrid], columns=label_names, data=sel_vol)
-    df_out = df_out.reset_index().rename({"index": "MRID"}, axis=1)
 
-    # Return output dataframe
-    return df_out
+def make_roi_dataframe(
+    mrids: list, vols: np.ndarray, list_single_roi: Any, map_derived_roi: Any
+) -> pd.DataFrame:
+    """
+    Creates the roi dataframe (derived roi volumes) of one or more subjects from
+    their single roi volumes
+
+    :param mrids: the subject ids
+    :type mrids: list
+    :param vols: the single roi volumes (one row per subject, in the order of
+                 get_single_roi_indices)
+    :type vols: np.ndarray
+    :param list_single_roi: single roi list file
+    :type list_single_roi: Any
+    :param map_derived_roi: derived roi map file
+    :type map_derived_roi: Any
 
+    :return: ROI dataframe
+    :rtype: pd.DataFrame
+    """
+    label_indices = np.array(get_single_roi_indices(str(list_single_roi)), dtype=int)
+    df_muse = pd.DataFrame(
+        index=list(mrids),
+        columns=label_indices.astype(str),
+        data=np.asarray(vols).reshape(len(mrids), -1),
+    )
+    df_muse = df_muse.reset_index().rename({"index": "MRID"}, axis=1)
+    return calc_derived_rois(df_muse, map_derived_roi)
 
-def append_derived_rois(df_in: pd.DataFrame, derived_roi_map: Any) -> pd.DataFrame:
+
+@lru_cache(maxsize=None)
+def read_derived_roi_map(derived_roi_map: str) -> tuple:
     """
-    Calculates a dataframe with the volumes of derived rois.
+    Reads the derived roi map file. The file is read once per process; later calls
+    return the cached result
 
-    :param df_in: the passed dataframe
+    :param derived_roi_map: derived roi map file
+    :type derived_roi_map: str
+
+    :return: the derived roi names and, for each derived roi, the list of the
+             single rois it contains
+    :rtype: tuple
+    """
+    roi_names = []
+    roi_lists = []
+    with open(derived_roi_map) as roi_map:
+        reader = csv.reader(roi_map, delimiter=",")
+        for row in reader:
+            roi_names.append(str(row[0]))
+            roi_lists.append(tuple(str(x) for x in row[2:]))
+    return tuple(roi_names), tuple(roi_lists)
+
+
+@lru_cache(maxsize=16)
+def get_derived_roi_matrix(derived_roi_map: str, single_rois: tuple) -> tuple:
+    """
+    Compiles the derived roi map into a sparse membership matrix, so that the
+    derived roi volumes are the product of the single roi volumes with this matrix.
+    The matrix is cached for each map file and list of single rois
+
+    :param derived_roi_map: derived roi map file
+    :type derived_roi_map: str
+    :param single_rois: names of the single roi columns (in order)
+    :type single_rois: tuple
+
+    :return: the derived roi names and the sparse matrix (single rois x derived
+             rois)
+    :rtype: tuple
+    """
+    roi_names, roi_lists = read_derived_roi_map(derived_roi_map)
+    col_index = {x: i for i, x in enumerate(single_rois)}
+
+    rows = []
+    cols = []
+    for i, roi_list in enumerate(roi_lists):
+        missing = [x for x in roi_list if x not in col_index]
+        if len(missing) > 0:
+            raise KeyError(
+                f"Single rois missing for derived roi {roi_names[i]}: {missing}"
+            )
+        rows.extend(col_index[x] for x in roi_list)
+        cols.extend([i] * len(roi_list))
+
+    # A single roi listed twice in a derived roi is counted twice
+    mat = sparse.csc_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(len(single_rois), len(roi_names))
+    )
+    return roi_names, mat
+
+
+def calc_derived_rois(df_in: pd.DataFrame, derived_roi_map: Any) -> pd.DataFrame:
+    """
+    Calculates the volumes of the derived rois for all subjects of a table of single
+    roi volumes, with one sparse matrix product
+
+    :param df_in: the single roi volumes (one row per subject, with an MRID column
+                  and one column per single roi)
     :type df_in: pd.DataFrame
     :param derived_roi_map: derived roi map file
     :type derived_roi_map: Any
 
-    :return: ROI dataframe
+    :return: the derived roi volumes (MRID column and one column per derived roi)
     :rtype: pd.DataFrame
     """
+    single_rois = tuple(str(x) for x in df_in.columns if x != "MRID")
+    label_names, mat = get_derived_roi_matrix(str(derived_roi_map), single_rois)
 
-    # Read derived roi map file to a dictionary
-    roi_dict = {}
-    with open(derived_roi_map) as roi_map:
-        reader = csv.reader(roi_map, delimiter=",")
-        for row in reader:
-            key = str(row[0])
-            val = [str(x) for x in row[2:]]
-            roi_dict[key] = val
-
-    # Calculate volumes for derived rois
-    label_names = np.array(list(roi_dict.keys())).astype(str)
-    label_vols = np.zeros(label_names.shape[0])
-    for i, key in enumerate(roi_dict):
-        key_vals = roi_dict[key]
-        key_vol = df_in[key_vals].sum(axis=1).values[0]
-        label_vols[i] = key_vol
+    vols = df_in[[x for x in df_in.columns if x != "MRID"]].to_numpy(dtype=float)
+    label_vols = np.asarray((mat.T @ vols.T).T)
 
     # Create dataframe
-    mrid = df_in["MRID"][0]
     df_out = pd.DataFrame(
-        index=[mrid], columns=label_names, data=label_vols.reshape(1, -1)
+        index=df_in["MRID"].values, columns=list(label_names), data=label_vols
     )
     df_out = df_out.reset_index().rename({"index": "MRID"}, axis=1)
 
@@ -104,40 +311,285 @@ def append_derived_rois(df_in: pd.DataFrame, derived_roi_map: Any) -> pd.DataFra
     return df_out
 
 
+def append_derived_rois(df_in: pd.DataFrame, derived_roi_map: Any) -> pd.DataFrame:
+    """
+    Calculates a dataframe with the volumes of derived rois.
+
+    :param df_in: the passed dataframe
+    :type df_in: pd.DataFrame
+    :param derived_roi_map: derived roi map file
+    :type derived_roi_map: Any
+
+    :return: ROI dataframe
+    :rtype: pd.DataFrame
+    """
+    return calc_derived_rois(df_in, derived_roi_map)
+
+
 def create_roi_csv(
-    mrid: Any, in_roi: Any, list_single_roi: Any, map_derived_roi: Any, out_csv: str
-) -> None:
+    mrid: Any,
+    in_roi: Any,
+    list_single_roi: Any,
+    map_derived_roi: Any,
+    out_csv: str,
+    slab_memory: Optional[int] = None,
+) -> tuple:
     """
     Creates a csv file with the results of the roi calculations
 
     :param mrid: the input mrid
     :type mrid: Any
-    :param in_roi: the input ROI
+    :param in_roi: the input ROI image (filename or image in memory)
     :type in_roi: Any
+    :param list_single_roi: single roi list file
+    :type list_single_roi: Any
     :param map_derived_roi: derived roi map file
     :type map_derived_roi: Any
     :param out_csv: output csv filename
     :type out_csv: str
+    :param slab_memory: if given (in MB), the ROI image is read one slab at a
+                        time (see get_label_counts)
+    :type slab_memory: int
 
-    :rtype: None
+    :return: the label histogram and the voxel size of the ROI image
+    :rtype: tuple
     """
 
     # Calculate MUSE ROIs
-    df_map = pd.read_csv(list_single_roi)
-    df_map = df_map[["IndexMUSE", "ROINameMUSE"]]
-
-    # Add ROI for cortical CSF with index set to 1
-    df_map.loc[len(df_map)] = [1, "Cortical CSF"]
-    df_map = df_map.sort_values("IndexMUSE")
-
-    list_roi = df_map.IndexMUSE.tolist()[1:]
-    df_muse = calc_roi_volumes(mrid, in_roi, list_roi)
+    counts, vox_size = get_label_counts(in_roi, slab_memory)
+    list_roi = get_single_roi_indices(str(list_single_roi))
+    vols = counts_to_volumes(counts, vox_size, list_roi)
 
     # Calculate Derived ROIs
-    df_dmuse = append_derived_rois(df_muse, map_derived_roi)
+    df_dmuse = make_roi_dataframe([mrid], vols, list_single_roi, map_derived_roi)
 
     # Write out csv
     df_dmuse.to_csv(out_csv, index=False)
+    return counts, vox_size
+
+
+def write_label_counts(
+    out_file: str,
+    df_img: pd.DataFrame,
+    counts: np.ndarray,
+    vox_size: np.ndarray,
+) -> None:
+    """
+    Writes the label histograms of a cohort to a compressed numpy file (.npz)
+
+    :param out_file: the output file
+    :type out_file: str
+    :param df_img: the subjects (MRID and img_prefix columns)
+    :type df_img: pd.DataFrame
+    :param counts: the label histogram of each subject (one row per subject)
+    :type counts: np.ndarray
+    :param vox_size: the voxel size of each subject
+    :type vox_size: np.ndarray
+
+    :rtype: None
+    """
+    # Voxel counts are stored as uint32 when they fit, to keep the file small
+    counts = np.asarray(counts)
+    if counts.size == 0 or counts.max() < np.iinfo(np.uint32).max:
+        counts = counts.astype(np.uint32)
+    with open(out_file, "wb") as f:
+        np.savez_compressed(
+            f,
+            MRID=np.array(df_img.MRID, dtype=str),
+            img_prefix=np.array(df_img.img_prefix, dtype=str),
+            counts=counts,
+            vox_size=np.asarray(vox_size, dtype=np.float64),
+        )
+
+
+def read_label_counts(in_file: str) -> tuple:
+    """
+    Reads the label histograms of a cohort
+
+    :param in_file: the label counts file (.npz)
+    :type in_file: str
+
+    :return: the subjects (MRID and img_prefix columns), the label histograms and
+             the voxel sizes
+    :rtype: tuple
+    """
+    with np.load(in_file) as data:
+        df_img = pd.DataFrame({"MRID": data["MRID"], "img_prefix": data["img_prefix"]})
+        return df_img, data["counts"].astype(np.int64), data["vox_size"]
+
+
+class ROITable:
+    """
+    Cohort table of roi volumes. The label histogram (number of voxels of each
+    label) and the voxel size of the subjects are stored in a preallocated matrix
+    while the subjects are processed. The single and derived roi volumes of all
+    subjects are calculated at once when the table is written, so that the cohort
+    csv is created without reading per-subject csv files, and the histograms can
+    be saved to re-derive the volumes later without the label maps
+    """
+
+    def __init__(
+        self,
+        df_img: pd.DataFrame,
+        list_single_roi: Any,
+        map_derived_roi: Any,
+        n_labels: int = 256,
+    ) -> None:
+        """
+        :param df_img: the subjects of the table (img_prefix and MRID columns), in
+                       the order of the output rows
+        :type df_img: pd.DataFrame
+        :param list_single_roi: single roi list file
+        :type list_single_roi: Any
+        :param map_derived_roi: derived roi map file
+        :type map_derived_roi: Any
+        :param n_labels: initial size of the histograms (extended if a label map
+                         has larger label values)
+        :type n_labels: int
+        """
+        self.list_single_roi = str(list_single_roi)
+        self.map_derived_roi = str(map_derived_roi)
+        self.mrids = list(df_img.MRID)
+        self.prefixes = list(df_img.img_prefix)
+        self.rows = {x: i for i, x in enumerate(self.prefixes)}
+        self.counts = np.zeros((len(self.rows), n_labels), dtype=np.int64)
+        self.vox_size = np.zeros(len(self.rows))
+        self.done = np.zeros(len(self.rows), dtype=bool)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_label_counts(
+        cls, in_file: str, list_single_roi: Any, map_derived_roi: Any
+    ) -> "ROITable":
+        """
+        Creates a table with all subjects of a label counts file
+
+        :param in_file: the label counts file (.npz)
+        :type in_file: str
+        :param list_single_roi: single roi list file
+        :type list_single_roi: Any
+        :param map_derived_roi: derived roi map file
+        :type map_derived_roi: Any
+
+        :return: the roi table
+        :rtype: ROITable
+        """
+        df_img, counts, vox_size = read_label_counts(in_file)
+        table = cls(df_img, list_single_roi, map_derived_roi, counts.shape[1])
+        table.counts[:, :] = counts
+        table.vox_size[:] = vox_size
+        table.done[:] = True
+        return table
+
+    def add(self, img_prefix: str, counts: np.ndarray, vox_size: float) -> None:
+        """
+        Sets the label histogram and the voxel size of a subject
+        """
+        i = self.rows[img_prefix]
+        with self.lock:
+            if len(counts) > self.counts.shape[1]:
+                pad = len(counts) - self.counts.shape[1]
+                self.counts = np.pad(self.counts, ((0, 0), (0, pad)))
+            self.counts[i, :] = 0
+            self.counts[i, : len(counts)] = counts
+            self.vox_size[i] = vox_size
+            self.done[i] = True
+
+    def add_label_counts(self, in_file: str, img_prefixes: Any = None) -> None:
+        """
+        Sets the histograms of the subjects without volumes from a label counts
+        file (subjects are matched by their image prefix)
+
+        :param in_file: the label counts file (.npz)
+        :type in_file: str
+        :param img_prefixes: if given, only these subjects are set
+        :type img_prefixes: list
+
+        :rtype: None
+        """
+        df_img, counts, vox_size = read_label_counts(in_file)
+        missing = set(self.missing())
+        if img_prefixes is not None:
+            missing = missing.intersection(img_prefixes)
+        for i, img_prefix in enumerate(df_img.img_prefix):
+            if img_prefix in missing:
+                self.add(img_prefix, counts[i], vox_size[i])
+
+    def __contains__(self, img_prefix: str) -> bool:
+        return bool(self.done[self.rows[img_prefix]])
+
+    def missing(self) -> list:
+        """
+        Returns the image prefixes of the subjects without volumes
+        """
+        return [x for x, i in self.rows.items() if not self.done[i]]
+
+    def _selected(self) -> tuple:
+        with self.lock:
+            sel = np.nonzero(self.done)[0]
+            return sel, self.counts[sel, :], self.vox_size[sel]
+
+    def single_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the single roi volumes of the subjects with volumes
+
+        :return: single ROI dataframe
+        :rtype: pd.DataFrame
+        """
+        sel, counts, vox_size = self._selected()
+        label_indices = get_single_roi_indices(self.list_single_roi)
+        df_out = pd.DataFrame(
+            index=[self.mrids[i] for i in sel],
+            columns=np.array(label_indices).astype(str),
+            data=counts_to_volumes(counts, vox_size, label_indices),
+        )
+        return df_out.reset_index().rename({"index": "MRID"}, axis=1)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the roi dataframe (derived roi volumes) of the subjects with
+        volumes
+
+        :return: ROI dataframe
+        :rtype: pd.DataFrame
+        """
+        sel, counts, vox_size = self._selected()
+        label_indices = get_single_roi_indices(self.list_single_roi)
+        return make_roi_dataframe(
+            [self.mrids[i] for i in sel],
+            counts_to_volumes(counts, vox_size, label_indices),
+            self.list_single_roi,
+            self.map_derived_roi,
+        )
+
+    def write_csv(self, out_csv: str) -> None:
+        """
+        Writes the roi csv of the subjects with volumes
+
+        :param out_csv: output csv filename
+        :type out_csv: str
+
+        :rtype: None
+        """
+        self.to_dataframe().to_csv(out_csv, index=False)
+
+    def write_label_counts(self, out_file: str) -> None:
+        """
+        Writes the label histograms of the subjects with volumes
+
+        :param out_file: the output file (.npz)
+        :type out_file: str
+
+        :rtype: None
+        """
+        sel, counts, vox_size = self._selected()
+        df_img = pd.DataFrame(
+            {
+                "MRID": [self.mrids[i] for i in sel],
+                "img_prefix": [self.prefixes[i] for i in sel],
+            }
+        )
+        write_label_counts(out_file, df_img, counts, vox_size)
 
 
 def apply_create_roi_csv(
@@ -148,6 +600,7 @@ def apply_create_roi_csv(
     dict_derived_roi: str,
     out_dir: str,
     out_suff: str,
+    workers: int = 1,
 ) -> None:
     """
     Apply roi volume calc to all images
@@ -162,19 +615,23 @@ def apply_create_roi_csv(
     :type out_dir: str
     :param out_suff: the output suffix
     :type out_suff: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         img_prefix = tmp_row.img_prefix
         mrid = tmp_row.MRID
         in_img = os.path.join(in_dir, img_prefix + in_suff)
         out_csv = os.path.join(out_dir, img_prefix + out_suff)
+        tasks.append((mrid, in_img, dict_single_roi, dict_derived_roi, out_csv))
 
-        create_roi_csv(mrid, in_img, dict_single_roi, dict_derived_roi, out_csv)
+    run_tasks(create_roi_csv, tasks, workers, keep_results=False)
 
 
 def combine_roi_csv(
@@ -202,7 +659,7 @@ def combine_roi_csv(
     out_csv = os.path.join(out_dir, out_name)
 
     dfs = []
-    for i, tmp_row in df_img.iterrows():
+    for tmp_row in df_img.itertuples(index=False):
         img_prefix = tmp_row.img_prefix
         in_csv = os.path.join(in_dir, img_prefix + in_suff)
         try:
@@ -1,14 +1,127 @@
+import json
+import logging
 import os
-from typing import Any
+from typing import Any, Optional
 
-import nibabel as nib
 import numpy as np
 import pandas as pd
 from scipy import ndimage
 from scipy.ndimage.measurements import label
 
+from .nifti_io import (
+    SlabWriter,
+    get_img_data,
+    get_img_dtype,
+    get_label_data,
+    get_slabs,
+    load_nii,
+    make_nii,
+    save_nii,
+)
+from .parallel import run_tasks
+from .scheduler import estimate_memory
+from .timing import RunTimer
+
+# Face connectivity (6-neighbourhood) used to find the connected components of
+# the masks
+STR_3D = np.array(
+    [
+        [[0, 0, 0], [0, 1, 0], [0, 0, 0]],
+        [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
+        [[0, 0, 0], [0, 1, 0], [0, 0, 0]],
+    ],
+    dtype="uint8",
+)
+
+
+def _coarse_box(img: np.ndarray, downsample: int) -> tuple:
+    """
+    Returns the region of img that contains the largest connected component of
+    the mask downsampled by the given factor (a voxel of the downsampled mask is
+    set if any voxel of its block is set, and weighted by their number)
+    """
+    counts = img != 0
+    for axis in range(img.ndim):
+        starts = np.arange(0, img.shape[axis], downsample)
+        counts = np.add.reduceat(counts, starts, axis=axis, dtype=np.int32)
+
+    labeled, ncomp = label(counts > 0, STR_3D)
+    if ncomp == 0:
+        return tuple(slice(0, n) for n in img.shape)
+    sizes = np.bincount(labeled.ravel(), weights=counts.ravel())
+    sizes[0] = 0
+    comp = int(np.argmax(sizes))
+    box = ndimage.find_objects(labeled, max_label=comp)[comp - 1]
+    return tuple(
+        slice(s.start * downsample, min(s.stop * downsample, n))
+        for s, n in zip(box, img.shape)
+    )
+
+
+def find_largest_component(img: np.ndarray, downsample: int = 1) -> tuple:
+    """
+    Finds the largest connected component (face connectivity) of the foreground of
+    img. Component sizes are counted from the label image, so no mask is created
+    for each component.
+
+    With downsample > 1 the components are first found in a downsampled mask, and
+    the labelling at full resolution is done only in the box of the largest one.
+    This is faster for masks with a large FOV, but the result may differ from the
+    full resolution search if small components merge in the downsampled mask
+
+    :param img: the mask
+    :type img: np.ndarray
+    :param downsample: downsampling factor of the first search (default = 1, the
+                       mask is labelled at full resolution)
+    :type downsample: int
+
+    :return: the label image of the searched region, the label of the largest
+             component (0 if the mask is empty) and the searched region of img
+             (a tuple of slices)
+    :rtype: tuple
+    """
+    img = img.astype("uint8", copy=False)
+    region = tuple(slice(0, n) for n in img.shape)
+    if downsample > 1:
+        region = _coarse_box(img, downsample)
+
+    labeled, ncomp = label(img[region], STR_3D)
+    if ncomp == 0:
+        return labeled, 0, region
+    sizes = np.bincount(labeled.ravel())
+    sizes[0] = 0
+    return labeled, int(np.argmax(sizes)), region
+
+
+def largest_component_bbox(img: np.ndarray, downsample: int = 1) -> Optional[tuple]:
+    """
+    Returns the bounding box of the largest connected component of img, as a
+    tuple of slices (None if the mask is empty). See find_largest_component
+    """
+    labeled, comp, region = find_largest_component(img, downsample)
+    if comp == 0:
+        return None
+    box = ndimage.find_objects(labeled, max_label=comp)[comp - 1]
+    return tuple(
+        slice(r.start + s.start, r.start + s.stop) for r, s in zip(region, box)
+    )
+
 
-def calc_bbox_with_padding(img: np.ndarray, perc_pad: int = 10) -> np.ndarray:
+def keep_largest_component(img: np.ndarray, downsample: int = 1) -> np.ndarray:
+    """
+    Returns the largest connected component of img as a binary (uint8) mask. See
+    find_largest_component
+    """
+    labeled, comp, region = find_largest_component(img, downsample)
+    img_out = np.zeros(img.shape, dtype=np.uint8)
+    if comp > 0:
+        img_out[region] = labeled == comp
+    return img_out
+
+
+def calc_bbox_with_padding(
+    img: np.ndarray, perc_pad: int = 10, downsample: int = 1
+) -> np.ndarray:
     """
     Finds bounding box for the foreground values in img, with a given padding percentage
 
@@ -16,13 +129,14 @@ def calc_bbox_with_padding(img: np.ndarray, perc_pad: int = 10) -> np.ndarray:
     :type img: np.ndarray
     :param perc_pad: the given padding percentage
     :type perc_pad: int
+    :param downsample: downsampling factor of the connected component search (see
+                       find_largest_component)
+    :type downsample: int
 
     :return: an array with the coordinates of the bounding box
     :rtype: np.ndarray
     """
 
-    img = img.astype("uint8")
-
     # Output is the coordinates of the bounding box
     bcoors = np.zeros([3, 2], dtype=int)
 
@@ -30,31 +144,18 @@ def calc_bbox_with_padding(img: np.ndarray, perc_pad: int = 10) -> np.ndarray:
     # INFO: In images with very large FOV DLICV may have small isolated regions in
     #       boundaries; so we calculate the bounding box based on the brain, not all
     #       foreground voxels
-    str_3D = np.array(
-        [
-            [[0, 0, 0], [0, 1, 0], [0, 0, 0]],
-            [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
-            [[0, 0, 0], [0, 1, 0], [0, 0, 0]],
-        ],
-        dtype="uint8",
-    )
-    labeled, ncomp = label(img, str_3D)
-    sizes = ndimage.sum(img, labeled, range(ncomp + 1))
-    img_largest_cc = (labeled == np.argmax(sizes)).astype(int)
+    box = largest_component_bbox(img, downsample)
+    if box is None:
+        box = tuple(slice(0, n) for n in img.shape)
 
     # Find coors in each axis
     for sel_axis in [0, 1, 2]:
 
-        # Get axes other than the selected
-        other_axes = [0, 1, 2]
-        other_axes.remove(sel_axis)
-
         # Get img dim in selected axis
-        dim = img_largest_cc.shape[sel_axis]
+        dim = img.shape[sel_axis]
 
-        # Find bounding box (index of first and last non-zero slices)
-        nonzero = np.any(img_largest_cc, axis=tuple(other_axes))
-        bbox = np.where(nonzero)[0][[0, -1]]
+        # Bounding box (index of first and last non-zero slices)
+        bbox = [box[sel_axis].start, box[sel_axis].stop - 1]
 
         # Add padding
         size_pad = int(np.round((bbox[1] - bbox[0]) * perc_pad / 100))
@@ -66,86 +167,261 @@ def calc_bbox_with_padding(img: np.ndarray, perc_pad: int = 10) -> np.ndarray:
     return bcoors
 
 
-def mask_img(in_img: Any, mask_img: Any, out_img: str) -> None:
+def write_crop_box(crop_json: str, bcoors: np.ndarray, shape: Any) -> None:
+    """
+    Saves the crop box of a subject (bounding box of the ICV mask, with padding) as
+    a json sidecar, so that the same box is used to crop the image and to pad the
+    DLMUSE result back to the initial size
+
+    :param crop_json: the sidecar file
+    :type crop_json: str
+    :param bcoors: the coordinates of the bounding box
+    :type bcoors: np.ndarray
+    :param shape: the shape of the ICV mask
+    :type shape: Any
+
+    :rtype: None
+    """
+    crop = {"bbox": np.asarray(bcoors).tolist(), "shape": [int(x) for x in shape]}
+    with open(crop_json, "w") as f:
+        json.dump(crop, f)
+
+
+def read_crop_box(crop_json: Optional[str], shape: Any) -> Optional[np.ndarray]:
+    """
+    Reads the crop box of a subject from its json sidecar
+
+    :param crop_json: the sidecar file
+    :type crop_json: str
+    :param shape: the shape of the ICV mask, checked against the saved one
+    :type shape: Any
+
+    :return: the coordinates of the bounding box, or None if the sidecar does not
+             exist or does not match the mask
+    :rtype: np.ndarray
+    """
+    if crop_json is None or not os.path.exists(crop_json):
+        return None
+    with open(crop_json) as f:
+        crop = json.load(f)
+    if crop["shape"] != [int(x) for x in shape]:
+        logging.warning(f"Crop box does not match the mask, recomputed: {crop_json}")
+        return None
+    return np.array(crop["bbox"], dtype=int)
+
+
+def mask_img(
+    in_img: Any,
+    mask_img: Any,
+    out_img: Optional[str],
+    compresslevel: Optional[int] = None,
+    crop_json: Optional[str] = None,
+    slab_memory: Optional[int] = None,
+) -> Any:
     """
     Applies the input mask to the input image
     Crops the image around the mask
 
-    :param in_img: the passed image
-    :param mask_img: the input mask
-    :param out_img: the output filename
+    :param in_img: the passed image (filename or image in memory)
+    :param mask_img: the input mask (filename or image in memory)
+    :param out_img: the output filename. If None, the output image is only returned
     :type out_img: str
-    :rtype: None
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param crop_json: if given, the crop box is saved to this json file
+    :type crop_json: str
+    :param slab_memory: if given (in MB), the input image is read, masked and
+                        written one slab at a time, using about this much memory
+                        (the mask is read at once, to find the crop box). The
+                        output image must be a file, and is returned unloaded
+    :type slab_memory: int
+    :return: the masked image
+    :rtype: niftii image
     """
 
     # Read input image and mask
-    nii_in = nib.load(in_img)
-    nii_mask = nib.load(mask_img)
-
-    img_in = nii_in.get_fdata()
-    img_mask = nii_mask.get_fdata()
-
-    # Mask image
-    img_in[img_mask == 0] = 0
+    use_slabs = slab_memory is not None and out_img is not None
+    nii_in = load_nii(in_img, keep_file_open=use_slabs)
+    nii_mask = load_nii(mask_img)
+    img_mask = get_img_data(nii_mask)
 
     # INFO: nnunet hallucinated on images with large FOV. To solve this problem
     #       we added pre/post processing steps to crop initial image around ICV
     #       mask before sending to DLMUSE
 
-    # Crop image
+    # Crop box
     bcoors = calc_bbox_with_padding(img_mask)
-    img_in_crop = img_in[
-        bcoors[0, 0] : bcoors[0, 1],
-        bcoors[1, 0] : bcoors[1, 1],
-        bcoors[2, 0] : bcoors[2, 1],
-    ]
+    if crop_json is not None:
+        write_crop_box(crop_json, bcoors, img_mask.shape)
+    box = tuple(slice(b[0], b[1]) for b in bcoors)
+    shape_crop = tuple(b[1] - b[0] for b in bcoors)
+
+    # Out image is saved in the stored data type of the input image. Scaled or
+    # float intensities are written as float32, as they are read, so that the
+    # slab-wise and whole-image outputs have the same type
+    out_dtype = nii_in.get_data_dtype()
+    if out_dtype == np.float64 or get_img_dtype(nii_in).kind == "f":
+        out_dtype = np.float32
+
+    if use_slabs:
+        # About 12 bytes per voxel: the stored and float32 slab, mask and output
+        slabs = get_slabs(shape_crop, 12, slab_memory)
+        with SlabWriter(
+            out_img, nii_in, shape_crop, out_dtype, compresslevel
+        ) as writer:
+            for slicer in slabs:
+                z = slicer[-1]
+                z_in = slice(box[2].start + z.start, box[2].start + z.stop)
+                img_in = get_img_data(nii_in, slicer=box[:2] + (z_in,))
+                mask_crop = img_mask[box[:2] + (z_in,)]
+                writer.write(np.where(mask_crop == 0, 0, img_in))
+        return load_nii(out_img)
+
+    # Intensities are read in the stored integer type (or float32), not float64
+    img_in = get_img_data(nii_in)
+
+    # Mask the cropped image
+    img_in_crop = np.where(img_mask[box] == 0, 0, img_in[box])
+    img_in_crop = img_in_crop.astype(img_in.dtype, copy=False)
 
     # Save out image
-    nii_out = nib.Nifti1Image(img_in_crop, nii_in.affine, nii_in.header)
-    nii_out.to_filename(out_img)
+    nii_out = make_nii(img_in_crop, nii_in, out_dtype)
+    if out_img is not None:
+        save_nii(nii_out, out_img, compresslevel)
+
+    return nii_out
+
+
+def refine_mask(
+    in_mask: Any, out_img: Optional[str], compresslevel: Optional[int] = None
+) -> Any:
+    """
+    Keeps only the largest connected component of a mask (e.g. DLICV masks of
+    refaced images, that may have small isolated regions)
+
+    :param in_mask: the input mask (filename or image in memory)
+    :param out_img: the output filename. If None, the output image is only returned
+    :type out_img: str
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
 
+    :return: the refined mask (uint8)
+    :rtype: niftii image
+    """
+    nii_mask = load_nii(in_mask)
+    img_out = keep_largest_component(get_img_data(nii_mask))
 
-def combine_masks(dlmuse_mask: Any, dlicv_mask: Any, out_img: str) -> None:
+    nii_out = make_nii(img_out, nii_mask)
+    if out_img is not None:
+        save_nii(nii_out, out_img, compresslevel)
+
+    return nii_out
+
+
+def combine_masks(
+    dlmuse_mask: Any,
+    dlicv_mask: Any,
+    out_img: Optional[str],
+    compresslevel: Optional[int] = None,
+    crop_json: Optional[str] = None,
+    slab_memory: Optional[int] = None,
+) -> Any:
     """'
     Combine icv and muse masks
 
-    :param dlmuse_mask: The passed dlmuse mask
-    :param dlicv_mask: The passed dlicv mask
-    :param out_img: the output filename
+    :param dlmuse_mask: The passed dlmuse mask (filename or image in memory)
+    :param dlicv_mask: The passed dlicv mask (filename or image in memory)
+    :param out_img: the output filename. If None, the output image is only returned
     :type out_img: str
-
-    :rtype: None
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param crop_json: the crop box saved when the image was cropped (default: the
+                      box is computed from the ICV mask)
+    :type crop_json: str
+    :param slab_memory: if given (in MB), the masks are read, combined and written
+                        one slab at a time, using about this much memory. The
+                        output image must be a file, and is returned unloaded
+    :type slab_memory: int
+
+    :return: the combined mask
+    :rtype: niftii image
     """
 
-    # Read input images
-    nii_dlmuse = nib.load(dlmuse_mask)
-    nii_icv = nib.load(dlicv_mask)
+    # Read input images (in the stored data types, without float copies)
+    use_slabs = slab_memory is not None and out_img is not None
+    nii_dlmuse = load_nii(dlmuse_mask, keep_file_open=use_slabs)
+    nii_icv = load_nii(dlicv_mask, keep_file_open=use_slabs)
+
+    if use_slabs:
+        bcoors = read_crop_box(crop_json, nii_icv.shape)
+        if bcoors is None:
+            bcoors = calc_bbox_with_padding(get_img_data(nii_icv))
+        out_dtype = get_img_dtype(nii_dlmuse)
+        if out_dtype.kind not in "iu":
+            out_dtype = np.dtype(np.int32)
+        out_dtype = np.promote_types(out_dtype, np.uint8)
+
+        # Each slab of the full size image: label 1 in the ICV, and the MUSE labels
+        # of the part of the slab that is in the crop box
+        # About 8 bytes per voxel: the ICV, MUSE and output slabs
+        slabs = get_slabs(nii_icv.shape, 8, slab_memory)
+        with SlabWriter(
+            out_img, nii_dlmuse, nii_icv.shape, out_dtype, compresslevel
+        ) as writer:
+            for slicer in slabs:
+                z = slicer[-1]
+                img_out = (get_img_data(nii_icv, slicer=slicer) > 0).astype(out_dtype)
+                z0 = max(z.start, bcoors[2, 0])
+                z1 = min(z.stop, bcoors[2, 1])
+                if z0 < z1:
+                    z_muse = slice(z0 - bcoors[2, 0], z1 - bcoors[2, 0])
+                    img_dlmuse = get_label_data(nii_dlmuse, (Ellipsis, z_muse))
+                    img_crop = img_out[
+                        bcoors[0, 0] : bcoors[0, 1],
+                        bcoors[1, 0] : bcoors[1, 1],
+                        z0 - z.start : z1 - z.start,
+                    ]
+                    np.copyto(
+                        img_crop, img_dlmuse, casting="unsafe", where=img_dlmuse != 0
+                    )
+                writer.write(img_out)
+        return load_nii(out_img)
+
+    img_dlmuse = get_label_data(nii_dlmuse)
+    img_icv = get_img_data(nii_icv)
 
-    img_dlmuse = nii_dlmuse.get_fdata()
-    img_icv = nii_icv.get_fdata()
+    # Merge masks : Add a new label (1) to MUSE for foreground voxels in ICV that is not in MUSE
+    # this label will mainly represent cortical CSF
+    #
+    # The full size image is created once, in the output data type, with label 1
+    # in the ICV; the MUSE labels are then copied into the crop box
+    img_out = (img_icv > 0).astype(np.promote_types(img_dlmuse.dtype, np.uint8))
 
     # INFO: nnunet hallucinated on images with large FOV. To solve this problem
     #       we added pre/post processing steps to crop initial image around ICV
     #       mask before sending to DLMUSE
     #
-    # MUSE image may have been cropped. Pad it to initial image size
-    bcoors = calc_bbox_with_padding(img_icv)
-    img_out = img_icv * 0
-    img_out[
+    # MUSE image may have been cropped. Pad it to initial image size, using the
+    # crop box of the masking step if it was saved
+    bcoors = read_crop_box(crop_json, img_icv.shape)
+    if bcoors is None:
+        bcoors = calc_bbox_with_padding(img_icv)
+    img_crop = img_out[
         bcoors[0, 0] : bcoors[0, 1],
         bcoors[1, 0] : bcoors[1, 1],
         bcoors[2, 0] : bcoors[2, 1],
-    ] = img_dlmuse
-
-    # Merge masks : Add a new label (1) to MUSE for foreground voxels in ICV that is not in MUSE
-    # this label will mainly represent cortical CSF
-    img_out[(img_out == 0) & (img_icv > 0)] = 1
-
-    img_out = img_out.astype(int)
+    ]
+    np.copyto(img_crop, img_dlmuse, casting="unsafe", where=img_dlmuse != 0)
 
     # Save out image
-    nii_out = nib.Nifti1Image(img_out, nii_dlmuse.affine, nii_dlmuse.header)
-    nii_out.to_filename(out_img)
+    nii_out = make_nii(img_out, nii_dlmuse)
+    if out_img is not None:
+        save_nii(nii_out, out_img, compresslevel)
+
+    return nii_out
 
 
 def apply_mask_img(
@@ -156,6 +432,13 @@ def apply_mask_img(
     mask_suff: str,
     out_dir: str,
     out_suff: str,
+    workers: int = 1,
+    timer: Optional[RunTimer] = None,
+    compresslevel: Optional[int] = None,
+    crop_suff: Optional[str] = None,
+    slab_memory: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    failed: Optional[list] = None,
 ) -> None:
     """
     Apply reorientation to all images
@@ -172,19 +455,58 @@ def apply_mask_img(
     :type out_dir: str
     :param out_suff: the passed output suffix
     :type out_suff: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param timer: if given, the time of each subject is recorded (default: None)
+    :type timer: RunTimer
+    :param compresslevel: gzip compression level of the output files (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param crop_suff: if given, the crop box of each image is saved to out_dir,
+                      with this suffix
+    :type crop_suff: str
+    :param slab_memory: if given (in MB), the images are masked one slab at a time
+                        (see mask_img)
+    :type slab_memory: int
+    :param max_memory: if given (in MB), subjects are started only while the
+                       estimated memory of the running subjects stays below
+                       this budget (see scheduler.estimate_memory)
+    :type max_memory: int
+    :param failed: if given, the errors of the subjects are logged and their
+                   MRIDs are added to this list, and the other subjects continue
+    :type failed: list
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         img_prefix = tmp_row.img_prefix
         in_img = os.path.join(in_dir, img_prefix + in_suff)
         in_mask = os.path.join(mask_dir, img_prefix + mask_suff)
         out_img = os.path.join(out_dir, img_prefix + out_suff)
-
-        mask_img(in_img, in_mask, out_img)
+        crop_json = None
+        if crop_suff is not None:
+            crop_json = os.path.join(out_dir, img_prefix + crop_suff)
+        tasks.append((in_img, in_mask, out_img, compresslevel, crop_json, slab_memory))
+
+    task_memory = None
+    if max_memory is not None:
+        task_memory = [estimate_memory(x[0], "mask", slab_memory) for x in tasks]
+    run_tasks(
+        mask_img,
+        tasks,
+        workers,
+        timer,
+        "mask",
+        list(df_img.MRID),
+        keep_results=False,
+        task_memory=task_memory,
+        max_memory=max_memory,
+        failed=failed,
+    )
 
 
 def apply_combine_masks(
@@ -195,6 +517,7 @@ def apply_combine_masks(
     dlicv_suff: str,
     out_dir: str,
     out_suff: str,
+    workers: int = 1,
 ) -> None:
     """
     Apply reorientation to all images
@@ -213,16 +536,20 @@ def apply_combine_masks(
     :type out_dir: str
     :param out_suff: the output suffix
     :type out_suff: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         img_prefix = tmp_row.img_prefix
         dlmuse_mask = os.path.join(dlmuse_dir, img_prefix + dlmuse_suff)
         dlicv_mask = os.path.join(dlicv_dir, img_prefix + dlicv_suff)
         out_img = os.path.join(out_dir, img_prefix + out_suff)
+        tasks.append((dlmuse_mask, dlicv_mask, out_img))
 
-        combine_masks(dlmuse_mask, dlicv_mask, out_img)
+    run_tasks(combine_masks, tasks, workers, keep_results=False)
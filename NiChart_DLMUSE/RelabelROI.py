@@ -1,37 +1,37 @@
 import os
-from typing import Any
+from functools import lru_cache
+from typing import Any, Optional
 
-import nibabel as nib
 import numpy as np
 import pandas as pd
 
+from .nifti_io import (
+    SlabWriter,
+    get_label_data,
+    get_slabs,
+    load_nii,
+    make_nii,
+    save_nii,
+)
+from .parallel import run_tasks
 
-def relabel_rois(
-    in_img: Any, roi_map: str, label_from: Any, label_to: Any, out_img: str
-) -> None:
+
+@lru_cache(maxsize=None)
+def get_relabel_map(roi_map: str, label_from: Any, label_to: Any) -> np.ndarray:
     """
-    Convert labels in input roi image to new labels based on the mapping
-    The mapping file should contain numeric indices for the mapping
-    between the input roi image (from) and output roi image (to)
+    Reads the roi index mapping and returns it as a lookup table (the value at
+    index v is the new label of v). The table is read once per process
 
-    :param in_img: the passed image
-    :type in_img: niftii image
     :param roi_map: the passed roi map
     :type roi_map: str
     :param label_from: input roi image
     :type label_from: Any
     :param label_to: output roi image
     :type label_to: Any
-    :param out_img: the desired filename for the output image
-    :type out_img: str
 
-    :rtype: None
+    :return: the lookup table
+    :rtype: np.ndarray
     """
-
-    # Read image
-    in_nii = nib.load(in_img)
-    img_mat = in_nii.get_fdata().astype(int)
-
     # Read dictionary with roi index mapping
     df_dict = pd.read_csv(roi_map)
 
@@ -42,13 +42,72 @@ def relabel_rois(
     # Create a mapping with consecutive numbers from dest to target values
     tmp_map = np.zeros(np.max([v_from, v_to]) + 1).astype(int)
     tmp_map[v_from] = v_to
+    return tmp_map.astype(np.uint8)
+
+
+def relabel_rois(
+    in_img: Any,
+    roi_map: str,
+    label_from: Any,
+    label_to: Any,
+    out_img: Optional[str],
+    compresslevel: Optional[int] = None,
+    slab_memory: Optional[int] = None,
+) -> Any:
+    """
+    Convert labels in input roi image to new labels based on the mapping
+    The mapping file should contain numeric indices for the mapping
+    between the input roi image (from) and output roi image (to)
 
-    # Replace each value v in data by the value of tmp_map with the index v
-    out_mat = tmp_map[img_mat].astype(np.uint8)
+    :param in_img: the passed image (filename or image in memory)
+    :type in_img: niftii image
+    :param roi_map: the passed roi map
+    :type roi_map: str
+    :param label_from: input roi image
+    :type label_from: Any
+    :param label_to: output roi image
+    :type label_to: Any
+    :param out_img: the desired filename for the output image. If None, the output
+                    image is only returned
+    :type out_img: str
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param slab_memory: if given (in MB), the image is read, relabeled and written
+                        one slab at a time, using about this much memory. The
+                        output image must be a file, and is returned unloaded
+    :type slab_memory: int
+
+    :return: the relabeled image
+    :rtype: niftii image
+    """
+
+    tmp_map = get_relabel_map(str(roi_map), label_from, label_to)
+
+    if slab_memory is not None and out_img is not None:
+        in_nii = load_nii(in_img, keep_file_open=True)
+        # About 16 bytes per voxel: the stored, rounded and relabeled slabs
+        slabs = get_slabs(in_nii.shape, 16, slab_memory)
+        with SlabWriter(
+            out_img, in_nii, in_nii.shape, tmp_map.dtype, compresslevel
+        ) as writer:
+            for slicer in slabs:
+                writer.write(tmp_map[get_label_data(in_nii, slicer)])
+        return load_nii(out_img, keep_file_open=True)
+
+    # Read image (in a compact integer type, without a float copy)
+    in_nii = load_nii(in_img)
+    img_mat = get_label_data(in_nii)
+
+    # Replace each value v in data by the value of the lookup table with the index v
+    out_mat = tmp_map[img_mat]
 
     # Write updated img
-    out_nii = nib.Nifti1Image(out_mat, in_nii.affine, in_nii.header)
-    nib.save(out_nii, out_img)
+    out_nii = make_nii(out_mat, in_nii)
+    if out_img is not None:
+        save_nii(out_nii, out_img, compresslevel)
+
+    return out_nii
 
 
 def apply_relabel_rois(
@@ -60,6 +119,7 @@ def apply_relabel_rois(
     roi_map: Any,
     label_from: Any,
     label_to: Any,
+    workers: int = 1,
 ) -> None:
     """
     Apply relabeling to all images
@@ -80,15 +140,19 @@ def apply_relabel_rois(
     :type label_from: Any
     :param label_to: output roi image
     :type label_to: Any
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         img_prefix = tmp_row.img_prefix
         in_img = os.path.join(in_dir, img_prefix + in_suff)
         out_img = os.path.join(out_dir, img_prefix + out_suff)
+        tasks.append((in_img, roi_map, label_from, label_to, out_img))
 
-        relabel_rois(in_img, roi_map, label_from, label_to, out_img)
+    run_tasks(relabel_rois, tasks, workers, keep_results=False)
@@ -1,42 +1,172 @@
+import json
 import logging
 import os
-from typing import Any
+from typing import Any, Optional
 
 import nibabel as nib
+import numpy as np
 import pandas as pd
-from nibabel.orientations import axcodes2ornt, ornt_transform
+from nibabel.orientations import axcodes2ornt, ornt2axcodes, ornt_transform
+
+from .nifti_io import load_nii, save_nii
+from .parallel import run_tasks
+from .scheduler import estimate_memory
+from .timing import RunTimer
 
 IMG_EXT = ".nii.gz"
 
+# Orientation transform that keeps all axes
+IDENTITY_TRANSFORM = np.array([[0, 1], [1, 1], [2, 1]])
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename="pipeline.log", encoding="utf-8", level=logging.DEBUG)
 
 
-def reorient_img(in_img: Any, ref: Any, out_img: str) -> None:
+def get_orientation(in_img: Any) -> str:
+    """
+    Returns the orientation of an image (e.g. 'LPS'), from the NIfTI header only
+
+    :param in_img: the input image (filename or image in memory)
+    :type in_img: str
+
+    :return: the axis codes of the image
+    :rtype: str
+    """
+    return "".join(nib.aff2axcodes(load_nii(in_img).affine))
+
+
+def invert_transform(transform: np.ndarray) -> np.ndarray:
+    """
+    Returns the inverse of an orientation transform (nibabel orientation matrix):
+    the axis of the output that each input axis goes to becomes the axis of the
+    input that it comes from, with the same flip
+
+    :param transform: the transform, one (axis, flip) row for each input axis
+    :type transform: np.ndarray
+
+    :return: the inverse transform
+    :rtype: np.ndarray
+    """
+    transform = np.asarray(transform)
+    inverse = np.zeros_like(transform)
+    for i, (axis, flip) in enumerate(transform):
+        inverse[int(axis)] = [i, flip]
+    return inverse
+
+
+def write_orient(
+    orient_json: str, transform: np.ndarray, orient_in: str, shape: Any
+) -> None:
+    """
+    Saves the orientation transform of a subject (from the initial orientation to
+    the pipeline orientation) as a json sidecar, so that it is inverted to reorient
+    the results back instead of reading the initial image again
+
+    :param orient_json: the sidecar file
+    :type orient_json: str
+    :param transform: the orientation transform
+    :type transform: np.ndarray
+    :param orient_in: the initial orientation (e.g. 'RAS')
+    :type orient_in: str
+    :param shape: the shape of the reoriented image
+    :type shape: Any
+
+    :rtype: None
+    """
+    orient = {
+        "orient_in": orient_in,
+        "transform": np.asarray(transform).astype(int).tolist(),
+        "shape": [int(x) for x in shape],
+    }
+    with open(orient_json, "w") as f:
+        json.dump(orient, f)
+
+
+def read_orient(orient_json: Optional[str], shape: Any) -> Optional[np.ndarray]:
+    """
+    Reads the orientation transform of a subject from its json sidecar
+
+    :param orient_json: the sidecar file
+    :type orient_json: str
+    :param shape: the shape of the reoriented image, checked against the saved one
+    :type shape: Any
+
+    :return: the orientation transform, or None if the sidecar does not exist or
+             does not match the image
+    :rtype: np.ndarray
+    """
+    if orient_json is None or not os.path.exists(orient_json):
+        return None
+    with open(orient_json) as f:
+        orient = json.load(f)
+    if orient["shape"] != [int(x) for x in shape[0:3]]:
+        logging.warning(f"Orientation does not match the image, ignored: {orient_json}")
+        return None
+    return np.array(orient["transform"], dtype=float)
+
+
+def _link_input(in_img: str, out_img: str) -> bool:
+    """
+    Links out_img to the input file. Returns False if the files have different
+    formats (.nii/.nii.gz) or the link can not be created
+    """
+    if in_img.endswith(".gz") != out_img.endswith(".gz"):
+        return False
+    if os.path.lexists(out_img):
+        os.remove(out_img)
+    try:
+        os.symlink(os.path.abspath(in_img), out_img)
+    except OSError:
+        return False
+    return True
+
+
+def reorient_img(
+    in_img: Any,
+    ref: Any,
+    out_img: Optional[str],
+    compresslevel: Optional[int] = None,
+    orient_json: Optional[str] = None,
+    passthrough: bool = False,
+) -> Any:
     """
-    Reorient image
+    Reorient image. The orientation is found from the image header, and the image
+    data is read only if the image is not in the target orientation already
 
-    :param in_img: the input image
+    :param in_img: the input image (filename or image in memory)
     :type in_img: niftii image
-    :param out_img: the desired filename for the output image
+    :param ref: the target orientation (e.g. 'LPS') or a reference image
+    :type ref: str
+    :param out_img: the desired filename for the output image. If None, the output
+                    image is only returned
     :type out_img: str
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param orient_json: if given, the orientation transform is saved to this json
+                        file (see write_orient)
+    :type orient_json: str
+    :param passthrough: if True and the input file is in the target orientation
+                        already, out_img is a link to the input file instead of a
+                        copy (the input file must be kept until out_img is used)
+    :type passthrough: bool
 
-    :rtype: None
+    :return: the reoriented image
+    :rtype: niftii image
     """
-    if os.path.exists(out_img):
+    if out_img is not None and os.path.exists(out_img):
         logging.info("Out file exists, skip reorientation ...")
+        return nib.load(out_img)
 
     else:
-        # Read input img
-        nii_in = nib.load(in_img)
+        # Read input img (header only)
+        nii_in = load_nii(in_img)
 
         # Detect target orient
         if len(ref) == 3:
             ref_orient = ref
         else:
-            nii_ref = nib.load(ref)
-            ref_orient = nib.aff2axcodes(nii_ref.affine)
-            ref_orient = "".join(ref_orient)
+            ref_orient = get_orientation(ref)
 
         # Find transform from current (approximate) orientation to
         # target, in nibabel orientation matrix and affine forms
@@ -45,15 +175,86 @@ def reorient_img(in_img: Any, ref: Any, out_img: str) -> None:
         transform = ornt_transform(orient_in, orient_out)
         # affine_xfm = inv_ornt_aff(transform, nii_in.shape)
 
+        if orient_json is not None:
+            shape = np.zeros(3, dtype=int)
+            shape[transform[:, 0].astype(int)] = nii_in.shape[0:3]
+            write_orient(
+                orient_json, transform, "".join(ornt2axcodes(orient_in)), shape
+            )
+
+        # Images in the target orientation are passed through without reading them
+        if np.array_equal(transform, IDENTITY_TRANSFORM):
+            if out_img is not None:
+                if not (
+                    passthrough
+                    and isinstance(in_img, str)
+                    and _link_input(in_img, out_img)
+                ):
+                    save_nii(nii_in, out_img, compresslevel)
+            return nii_in
+
         # Apply transform
         reoriented = nii_in.as_reoriented(transform)
 
         # Write to out file
-        reoriented.to_filename(out_img)
+        if out_img is not None:
+            save_nii(reoriented, out_img, compresslevel)
+
+        return reoriented
+
+
+def reorient_to_init(
+    in_img: Any,
+    ref_img: str,
+    out_img: Optional[str],
+    orient_json: Optional[str] = None,
+    compresslevel: Optional[int] = None,
+) -> Any:
+    """
+    Reorients an image of the pipeline back to the initial orientation of the
+    subject, with the inverse of the transform saved by reorient_img. If the
+    sidecar is not available the orientation is read from the initial image
+
+    :param in_img: the image to reorient (filename or image in memory)
+    :type in_img: niftii image
+    :param ref_img: the initial image of the subject
+    :type ref_img: str
+    :param out_img: the output filename. If None, the output image is only returned
+    :type out_img: str
+    :param orient_json: the orientation sidecar saved by reorient_img
+    :type orient_json: str
+    :param compresslevel: gzip compression level of the output file (default:
+                          nibabel default)
+    :type compresslevel: int
+
+    :return: the reoriented image
+    :rtype: niftii image
+    """
+    nii = load_nii(in_img)
+    transform = read_orient(orient_json, nii.shape)
+    if transform is None:
+        return reorient_img(nii, ref_img, out_img, compresslevel)
+
+    transform = invert_transform(transform)
+    if not np.array_equal(transform, IDENTITY_TRANSFORM):
+        nii = nii.as_reoriented(transform)
+    if out_img is not None:
+        save_nii(nii, out_img, compresslevel)
+    return nii
 
 
 def apply_reorient_img(
-    df_img: pd.DataFrame, ref_orient: Any, out_dir: str, out_suffix: str
+    df_img: pd.DataFrame,
+    ref_orient: Any,
+    out_dir: str,
+    out_suffix: str,
+    workers: int = 1,
+    timer: Optional[RunTimer] = None,
+    compresslevel: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    orient_suff: Optional[str] = None,
+    passthrough: bool = False,
+    failed: Optional[list] = None,
 ) -> None:
     """
     Apply reorientation to all images
@@ -64,20 +265,69 @@ def apply_reorient_img(
     :type out_dir: str
     :param out_suffix: the output suffix
     :type out_suffix: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param timer: if given, the time of each subject is recorded (default: None)
+    :type timer: RunTimer
+    :param compresslevel: gzip compression level of the output files (default:
+                          nibabel default)
+    :type compresslevel: int
+    :param max_memory: if given (in MB), subjects are started only while the
+                       estimated memory of the running subjects stays below
+                       this budget (see scheduler.estimate_memory)
+    :type max_memory: int
+    :param orient_suff: if given, the orientation transform of each image is saved
+                        to out_dir with this suffix (see write_orient)
+    :type orient_suff: str
+    :param passthrough: if True, the outputs of images that are in the target
+                        orientation already are links to the input files
+    :type passthrough: bool
+    :param failed: if given, the errors of the subjects are logged and their
+                   MRIDs are added to this list, and the other subjects continue
+    :type failed: list
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         in_img = tmp_row.img_path
         out_img = os.path.join(out_dir, tmp_row.img_prefix + out_suffix)
-        reorient_img(in_img, ref_orient, out_img)
+        orient_json = None
+        if orient_suff is not None:
+            orient_json = os.path.join(out_dir, tmp_row.img_prefix + orient_suff)
+        tasks.append(
+            (in_img, ref_orient, out_img, compresslevel, orient_json, passthrough)
+        )
+
+    task_memory = None
+    if max_memory is not None:
+        task_memory = [estimate_memory(x, "reorient") for x in df_img.img_path]
+    run_tasks(
+        reorient_img,
+        tasks,
+        workers,
+        timer,
+        "reorient",
+        list(df_img.MRID),
+        keep_results=False,
+        task_memory=task_memory,
+        max_memory=max_memory,
+        failed=failed,
+    )
 
 
 def apply_reorient_to_init(
-    df_img: pd.DataFrame, in_dir: str, in_suff: str, out_dir: str, out_suff: str
+    df_img: pd.DataFrame,
+    in_dir: str,
+    in_suff: str,
+    out_dir: str,
+    out_suff: str,
+    workers: int = 1,
+    orient_dir: Optional[str] = None,
+    orient_suff: Optional[str] = None,
 ) -> None:
     """
     Apply reorientation to init img to all images
@@ -92,16 +342,29 @@ def apply_reorient_to_init(
     :type out_dir: str
     :param out_suff: the output suffix
     :type out_suff: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param orient_dir: the directory with the orientation sidecars saved by
+                       apply_reorient_img (default: the orientation is read from
+                       the initial images)
+    :type orient_dir: str
+    :param orient_suff: the suffix of the orientation sidecars
+    :type orient_suff: str
 
     :rtype: None
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    for i, tmp_row in df_img.iterrows():
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
         ref_img = tmp_row.img_path
         img_prefix = tmp_row.img_prefix
         in_img = os.path.join(in_dir, img_prefix + in_suff)
         out_img = os.path.join(out_dir, img_prefix + out_suff)
+        orient_json = None
+        if orient_dir is not None and orient_suff is not None:
+            orient_json = os.path.join(orient_dir, img_prefix + orient_suff)
+        tasks.append((in_img, ref_img, out_img, orient_json))
 
-        reorient_img(in_img, ref_img, out_img)
+    run_tasks(reorient_to_init, tasks, workers, keep_results=False)
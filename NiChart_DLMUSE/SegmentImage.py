@@ -1,10 +1,221 @@
+import argparse
 import glob
+import logging
 import os
+import shlex
 import shutil
-from typing import Any
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
 import DLMUSE 
 import DLICV
 
+logger = logging.getLogger(__name__)
+
+# Segmentation backends: "subprocess" runs the DLICV/DLMUSE command line tools,
+# "inprocess" runs the nnU-Net predictors in the current process
+BACKENDS = ["subprocess", "inprocess"]
+
+# Model folders of the DLICV/DLMUSE packages (same as their command line tools)
+MODEL_DLICV = "Dataset%s_Task%s_dlicv/nnUNetTrainer__nnUNetPlans__%s/"
+MODEL_DLMUSE = "Dataset%s_Task%s_DLMUSEV2/nnUNetTrainer__nnUNetPlans__%s/"
+
+# Predictors loaded in this process, reused for all later batches. Each predictor
+# has its own lock, so DLICV and DLMUSE can run at the same time in streaming mode
+_PREDICTORS: dict = {}
+_PREDICTORS_LOCK = threading.Lock()
+
+
+def _parse_extra_args(extra_args: str, dataset: str) -> argparse.Namespace:
+    """
+    Parses the extra arguments of DLICV/DLMUSE that are used by the in-process
+    backend. The defaults are the ones of the DLICV/DLMUSE command line tools
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-d", type=str, default=dataset)
+    parser.add_argument("-c", type=str, default="3d_fullres")
+    parser.add_argument("-f", type=int, default=0)
+    parser.add_argument("-chk", type=str, default="checkpoint_final.pth")
+    parser.add_argument("-step_size", type=float, default=0.5)
+    parser.add_argument("-npp", type=int, default=2)
+    parser.add_argument("-nps", type=int, default=2)
+    parser.add_argument("--disable_tta", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--disable_progress_bar", action="store_true")
+    parser.add_argument("--post_processing", type=str, default="true")
+    args, unknown = parser.parse_known_args(shlex.split(extra_args))
+    if len(unknown) > 0:
+        logging.warning(f"Arguments not used by the in-process backend: {unknown}")
+    return args
+
+
+def get_predictor(model: str, device: str, extra_args: str = "") -> tuple:
+    """
+    Returns the nnU-Net predictor of DLICV or DLMUSE. The predictor is loaded on the
+    first call and kept in memory, so that later calls with the same settings do
+    not load the model weights again
+
+    :param model: "DLICV" or "DLMUSE"
+    :type model: str
+    :param device: cuda/mps for GPU acceleration otherwise cpu
+    :type device: str
+    :param extra_args: extra arguments for the DLICV/DLMUSE package
+    :type extra_args: str
+
+    :return: the predictor, the lock that serializes its use, and the parsed
+             arguments
+    :rtype: tuple
+    """
+    if model == "DLICV":
+        pkg, model_dir, dataset = DLICV, MODEL_DLICV, "901"
+    else:
+        pkg, model_dir, dataset = DLMUSE, MODEL_DLMUSE, "903"
+    args = _parse_extra_args(extra_args, dataset)
+
+    key = (
+        model,
+        device,
+        args.d,
+        args.c,
+        args.f,
+        args.chk,
+        args.step_size,
+        args.disable_tta,
+    )
+    with _PREDICTORS_LOCK:
+        if key in _PREDICTORS:
+            return _PREDICTORS[key] + (args,)
+
+        import torch
+
+        # exports for nnunetv2 purposes (as in DLICV/DLMUSE)
+        os.environ.setdefault("nnUNet_raw", "/nnunet_raw/")
+        os.environ.setdefault("nnUNet_preprocessed", "/nnunet_preprocessed")
+        os.environ.setdefault("nnUNet_results", "/nnunet_results")
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+        model_folder = os.path.join(
+            Path(pkg.__file__).parent,
+            "nnunet_results",
+            model_dir % (args.d, args.d, args.c),
+        )
+        if not os.path.exists(model_folder):
+            from huggingface_hub import snapshot_download
+
+            logging.info(f"{model} model not found, downloading...")
+            snapshot_download(
+                repo_id=f"nichart/{model}", local_dir=Path(pkg.__file__).parent
+            )
+
+        if device == "cpu":
+            import multiprocessing
+
+            torch.set_num_threads(multiprocessing.cpu_count() // 2)
+        elif device == "cuda":
+            torch.set_num_threads(1)
+
+        logging.info(f"Loading {model} model from {model_folder}")
+        predictor = nnUNetPredictor(
+            tile_step_size=args.step_size,
+            use_gaussian=True,
+            use_mirroring=not args.disable_tta,
+            perform_everything_on_device=True,
+            device=torch.device(device),
+            verbose=args.verbose,
+            verbose_preprocessing=args.verbose,
+            allow_tqdm=not args.disable_progress_bar,
+        )
+        predictor.initialize_from_trained_model_folder(
+            model_folder, [args.f], checkpoint_name=args.chk
+        )
+        _PREDICTORS[key] = (predictor, threading.Lock())
+    return _PREDICTORS[key] + (args,)
+
+
+@contextmanager
+def _deterministic(enabled: bool) -> Iterator:
+    """
+    Runs the DLICV predictions with deterministic algorithms, as the DLICV command
+    line tool, and restores the previous setting of the process afterwards, so
+    that DLMUSE runs as its command line tool. The setting is global: in streaming
+    mode, a DLMUSE batch that overlaps a DLICV batch also runs with it
+    """
+    if not enabled:
+        yield
+        return
+
+    import torch
+
+    prev = torch.are_deterministic_algorithms_enabled()
+    torch.use_deterministic_algorithms(True)
+    try:
+        yield
+    finally:
+        torch.use_deterministic_algorithms(prev)
+
+
+def _predict_inprocess(
+    model: str,
+    in_dir: str,
+    in_suff: str,
+    out_dir: str,
+    out_suff: str,
+    device: str,
+    extra_args: str,
+) -> list:
+    """
+    Segments all images of in_dir with the cached predictor. The outputs are
+    written directly with their final names (no renaming of the inputs/outputs)
+
+    :return: the output files
+    :rtype: list
+    """
+    predictor, lock, args = get_predictor(model, device, extra_args)
+
+    in_files = sorted(glob.glob(os.path.join(in_dir, "*" + in_suff)))
+    out_files = [
+        os.path.join(out_dir, os.path.basename(x).replace(in_suff, out_suff))
+        for x in in_files
+    ]
+    if len(in_files) == 0:
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+
+    # nnU-Net adds the file extension to the output names
+    out_trunc = [x[: -len(".nii.gz")] for x in out_files]
+    with lock, _deterministic(model == "DLICV"):
+        predictor.predict_from_files(
+            [[x] for x in in_files],
+            out_trunc,
+            save_probabilities=False,
+            overwrite=True,
+            num_processes_preprocessing=args.npp,
+            num_processes_segmentation_export=args.nps,
+        )
+
+    if model == "DLICV" and args.post_processing.upper() == "TRUE":
+        _select_icv_component(out_files)
+    return out_files
+
+
+def _select_icv_component(out_files: list) -> None:
+    """
+    Keeps the connected component of the DLICV masks that corresponds to the ICV
+    (the post-processing of the DLICV command line tool)
+    """
+    import SimpleITK as sitk
+    from DLICV.utils import analyze_connected_components_for_icv
+
+    for fpath in out_files:
+        if not os.path.exists(fpath):
+            continue
+        mask_component, _ = analyze_connected_components_for_icv(sitk.ReadImage(fpath))
+        if mask_component is None:
+            logging.warning(f"CC analysis failed, keeping the DLICV mask: {fpath}")
+        elif mask_component.GetNumberOfPixels() > 10:
+            sitk.WriteImage(mask_component, fpath)
+
 
 def run_dlicv(
     in_dir: str,
@@ -13,6 +224,7 @@ def run_dlicv(
     out_suff: str,
     device: str,
     extra_args: str = "",
+    backend: str = "subprocess",
 ) -> None:
     """
     Run dlicv with the passed images
@@ -29,9 +241,19 @@ def run_dlicv(
     :type device: str
     :param extra_args: extra arguments for DLICV package
     :type extra_args: str
+    :param backend: "subprocess" to call the DLICV command, or "inprocess" to
+                    run the model in this process and keep it loaded for the next
+                    calls (default = "subprocess")
+    :type backend: str
 
     :rtype: None
     """
+    if backend == "inprocess":
+        _predict_inprocess(
+            "DLICV", in_dir, in_suff, out_dir, out_suff, device, extra_args
+        )
+        return
+
     # Call DLICV
     os.system(f"DLICV -i {in_dir} -o {out_dir} -device {device} " + extra_args)
 
@@ -47,6 +269,7 @@ def run_dlmuse(
     out_suff: Any,
     device: str,
     extra_args: str = "",
+    backend: str = "subprocess",
 ) -> None:
     """
     Run dlmuse with the passed images
@@ -63,9 +286,19 @@ def run_dlmuse(
     :type device: str
     :param extra_args: extra arguments for DLMUSE package
     :type extra_args: str
+    :param backend: "subprocess" to call the DLMUSE command, or "inprocess" to
+                    run the model in this process and keep it loaded for the next
+                    calls (default = "subprocess")
+    :type backend: str
 
     :rtype: None
     """
+    if backend == "inprocess":
+        _predict_inprocess(
+            "DLMUSE", in_dir, in_suff, out_dir, out_suff, device, extra_args
+        )
+        return
+
     # Call DLMUSE
     os.system(f"DLMUSE -i {in_dir} -o {out_dir} -device {device} " + extra_args)
 
@@ -8,16 +8,9 @@ Use of this source code is governed by license located in license file: https://
 import argparse
 import os
 import shutil
-import threading
 
 from .dlmuse_pipeline import run_pipeline
-from .utils import (
-    collect_T1,
-    merge_bids_output_data,
-    merge_output_data,
-    remove_subfolders,
-    split_data,
-)
+from .utils import BIDS_MANIFEST, index_bids, merge_bids_output_data, split_data
 
 # VERSION = pkg_resources.require("NiChart_DLMUSE")[0].version
 VERSION = "1.0.7"
@@ -86,7 +79,7 @@ def main() -> None:
         "-c",
         "--cores",
         type=str,
-        help="Number of cores",
+        help="Number of cores. If > 1, the CPU stages run in a pool of one worker process per core (unless --workers is set)",
         default=1,
         required=False,
     )
@@ -139,6 +132,188 @@ def main() -> None:
         help="If set, refine DLICV mask by keeping only the largest connected component (for refaced data).",
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of workers for the CPU stages (reorient, mask, relabel, combine, ROI volumes): worker processes by default, threads with --streaming. This is independent of DLICV/DLMUSE inference. By default the number of --cores.",
+    )
+
+    parser.add_argument(
+        "--largest_first",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, subjects are processed by decreasing image size (read from the NIfTI headers), so that large scans do not delay the end of the run.",
+    )
+
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, the images in the subfolders of the input folder are also used. Image names must be unique.",
+    )
+
+    parser.add_argument(
+        "--scan_cache",
+        type=str,
+        required=False,
+        default=None,
+        help="If set, the list of the images of the input folder is saved to this file (.json, outside the output folder), and reused by the next runs while no file is added to or removed from the input folder.",
+    )
+
+    parser.add_argument(
+        "--check_headers",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, the NIfTI headers of the input images are read before the run (in parallel), and images that can not be read are skipped.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, the output folder is not emptied, and only new or changed subjects and stages that did not complete in an earlier run are processed (based on the run ledger saved in the output folder).",
+    )
+
+    parser.add_argument(
+        "--keep_intermediates",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, the intermediate images of the steps after DLMUSE (relabeled and combined masks) are written to the working folder for debugging. By default they are passed in memory.",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        required=False,
+        default="subprocess",
+        choices=["subprocess", "inprocess"],
+        help="How DLICV/DLMUSE are run. 'subprocess' calls the DLICV/DLMUSE commands for each batch; 'inprocess' loads the models once and keeps them in memory for all batches (avoids the model start-up cost of each call).",
+    )
+
+    parser.add_argument(
+        "--timing_report",
+        type=str,
+        required=False,
+        default=None,
+        help="If set, the wall time, CPU time, bytes read/written and voxel count of each stage and subject are saved to this file (.json or .csv) at the end of the run.",
+    )
+
+    parser.add_argument(
+        "--timing_summary",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, a table with the time spent in each stage is shown at the end of the run.",
+    )
+
+    parser.add_argument(
+        "--tmp_format",
+        type=str,
+        required=False,
+        default="nii.gz",
+        choices=["nii.gz", "nii"],
+        help="Format of the temporary images in the working folder. With 'nii' they are written without compression (the inputs of DLICV/DLMUSE keep the .nii.gz suffix). Final outputs are always .nii.gz.",
+    )
+
+    parser.add_argument(
+        "--tmp_compresslevel",
+        type=int,
+        required=False,
+        default=None,
+        choices=range(10),
+        metavar="[0-9]",
+        help="gzip compression level of the temporary .nii.gz images (0: no compression, fastest). By default the nibabel default is used.",
+    )
+
+    parser.add_argument(
+        "--scratch_dir",
+        type=str,
+        required=False,
+        default=None,
+        help="If set, the working folder is created in this folder (e.g. local NVMe disk or tmpfs) instead of the output folder. It is removed at the end of the run if all subjects completed.",
+    )
+
+    parser.add_argument(
+        "--subject_csv",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, a csv with the ROI volumes of each subject is also written to the output folder. By default only the cohort csv (DLMUSE_Volumes.csv) is written.",
+    )
+
+    parser.add_argument(
+        "--out_format",
+        type=str,
+        required=False,
+        default="csv",
+        choices=["csv", "parquet", "feather", "hdf5"],
+        help="Format of the ROI volumes of the cohort. 'parquet', 'feather' and 'hdf5' store float32 columns with MRID as the key (they need the pyarrow or tables package); with --resume, the new subjects are appended without rewriting the existing file.",
+    )
+
+    parser.add_argument(
+        "--slab_memory",
+        type=int,
+        required=False,
+        default=None,
+        help="If set (in MB), the masking, relabeling, mask combination and ROI counting steps read and write the images one slab at a time, using about this much memory per subject. Useful for very large or high-resolution images, so that more workers fit in memory. By default whole images are processed.",
+    )
+
+    parser.add_argument(
+        "--max_memory",
+        type=int,
+        required=False,
+        default=None,
+        help="If set (in MB), memory budget of the CPU steps. The peak memory of each image is estimated from its NIfTI header, and images are started only while the total of the running images stays below the budget, so that all workers can be used without running out of memory. DLICV/DLMUSE are not included. By default there is no limit.",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        required=False,
+        default=False,
+        help="If set, each subject moves through the pipeline on its own, so that DLICV/DLMUSE inference overlaps with the CPU stages and results are written while the batch is still running. The CPU stages then run in --workers threads of a single process.",
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        required=False,
+        default=8,
+        help="Maximum number of subjects sent together to DLICV/DLMUSE in streaming mode.",
+    )
+
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        required=False,
+        default=16,
+        help="Maximum number of subjects waiting between two stages in streaming mode.",
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        required=False,
+        default=None,
+        help="If set, the input images are split into this many shards in the output folder and the pipeline is not run. Each shard (split_1.txt, split_2.txt, ...) lists the full paths of its images and can be passed as the input (-i) of a separate run, e.g. one job of a cluster job array per shard.",
+    )
+
+    parser.add_argument(
+        "--shard_mode",
+        type=str,
+        required=False,
+        default="manifest",
+        choices=["manifest", "symlink", "hardlink"],
+        help="How the shards of --shards are written: a list of image paths (manifest, default), or a folder (split_1, split_2, ...) with symbolic links (symlink) or hard links (hardlink) to its images. The images are never copied.",
+    )
+
     # HELP argument
     help = "Show this message and exit"
     parser.add_argument("-h", "--help", action="store_true", help=help)
@@ -151,6 +326,28 @@ def main() -> None:
     dlicv_extra_args = args.dlicv_args
     dlmuse_extra_args = args.dlmuse_args
     refaced_data = args.refaced_data
+    pipeline_args = {
+        "streaming": args.streaming,
+        "batch_size": args.batch_size,
+        "queue_size": args.queue_size,
+        "workers": args.workers,
+        "largest_first": args.largest_first,
+        "resume": args.resume,
+        "keep_intermediates": args.keep_intermediates,
+        "backend": args.backend,
+        "timing_report": args.timing_report,
+        "timing_summary": args.timing_summary,
+        "tmp_format": args.tmp_format,
+        "tmp_compresslevel": args.tmp_compresslevel,
+        "scratch_dir": args.scratch_dir,
+        "subject_csv": args.subject_csv,
+        "out_format": args.out_format,
+        "slab_memory": args.slab_memory,
+        "max_memory": args.max_memory,
+        "recursive": args.recursive,
+        "scan_cache": args.scan_cache,
+        "check_headers": args.check_headers,
+    }
 
     print()
     print("Arguments:")
@@ -162,7 +359,7 @@ def main() -> None:
         # os.system(f"mkdir {out_dir}")
         os.mkdir(out_dir)
 
-    elif len(os.listdir(out_dir)) != 0:
+    elif len(os.listdir(out_dir)) != 0 and not args.resume:
         print(f"Emptying output folder: {out_dir}...")
         for root, dirs, files in os.walk(out_dir):
             for f in files:
@@ -176,85 +373,60 @@ def main() -> None:
 
     working_dir = os.path.join(os.path.abspath(out_dir))
 
+    if args.shards is not None:
+        # Only the shards are written; each one is then run as a separate job
+        in_data = in_dir
+        if args.bids is True:
+            in_data = os.path.join(out_dir, BIDS_MANIFEST)
+            index_bids(in_dir, in_data)
+        shards = split_data(in_data, args.shards, working_dir, mode=args.shard_mode)
+        print(f"Wrote {len(shards)} shards:")
+        for shard in shards:
+            print(f"  {shard}")
+        return
+
     # Run pipeline
+    # INFO: With more than one core, the CPU stages of the batch pipeline run in a
+    #       pool of one worker process per core. An explicit --workers is kept
+    no_cores = int(args.cores)
+    if args.workers is None:
+        pipeline_args["workers"] = max(1, no_cores)
+    elif no_cores > 1 and args.workers != no_cores:
+        print(f"Using --workers {args.workers} for the CPU stages (--cores {no_cores})")
+    if args.streaming and pipeline_args["workers"] > 1:
+        print(
+            "Streaming mode: the CPU stages run in threads of a single process; "
+            "without --streaming they run in worker processes"
+        )
+
     if args.bids is True:
-        if int(args.cores) > 1:
-            collect_T1(in_dir, out_dir)
-
-            no_threads = int(args.cores)
-            subfolders = split_data("raw_temp_T1", no_threads)
-            threads = []
-            for i in range(len(subfolders)):
-                curr_out_dir = out_dir + f"/split_{i}"
-                curr_thread = threading.Thread(
-                    target=run_pipeline,
-                    args=(
-                        subfolders[i],
-                        curr_out_dir,
-                        device,
-                        dlmuse_extra_args,
-                        dlicv_extra_args,
-                        refaced_data,
-                        i,
-                    ),
-                )
-                curr_thread.start()
-                threads.append(curr_thread)
-
-            for t in threads:
-                t.join()
-
-            merge_bids_output_data(working_dir)
-            remove_subfolders("raw_temp_T1")
-            remove_subfolders(out_dir)
-        else:  # No core parallelization
-            run_pipeline(
-                in_dir,
-                out_dir,
-                device,
-                dlmuse_extra_args,
-                dlicv_extra_args,
-                refaced_data,
-            )
+        # The T1 images are indexed in place, and the pipeline runs on the list of
+        # their paths
+        manifest = os.path.join(out_dir, BIDS_MANIFEST)
+        df_bids = index_bids(in_dir, manifest)
+
+        run_pipeline(
+            manifest,
+            out_dir,
+            device,
+            dlmuse_extra_args,
+            dlicv_extra_args,
+            refaced_data,
+            **pipeline_args,
+        )
+
+        merge_bids_output_data(working_dir, df_bids)
 
     else:  # Non-BIDS
-        if int(args.cores) > 1:
-            no_threads = int(args.cores)
-            subfolders = split_data(in_dir, no_threads)
-
-            threads = []
-            for i in range(len(subfolders)):
-                curr_out_dir = out_dir + f"/split_{i}"
-                curr_thread = threading.Thread(
-                    target=run_pipeline,
-                    args=(
-                        subfolders[i],
-                        curr_out_dir,
-                        device,
-                        dlmuse_extra_args,
-                        dlicv_extra_args,
-                        refaced_data,
-                        i,
-                    ),
-                )
-                curr_thread.start()
-                threads.append(curr_thread)
-
-            for t in threads:
-                t.join()
-
-            merge_output_data(out_dir)
-            remove_subfolders(in_dir)
-            remove_subfolders(out_dir)
-        else:  # No core parallelization
-            run_pipeline(
-                in_dir,
-                out_dir,
-                device,
-                dlmuse_extra_args,
-                dlicv_extra_args,
-                refaced_data,
-            )
+        run_pipeline(
+            in_dir,
+            out_dir,
+            device,
+            dlmuse_extra_args,
+            dlicv_extra_args,
+            refaced_data,
+            **pipeline_args,
+        )
 
 
 if __name__ == "__main__":
@@ -1,14 +1,33 @@
+import hashlib
 import logging
 import os
+import shutil
 import sys
+import tempfile
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Callable, Iterator, NamedTuple, Optional
 
+import pandas as pd
 import pkg_resources  # type: ignore
 
-from .CalcROIVol import apply_create_roi_csv, combine_roi_csv
-from .MaskImage import apply_combine_masks, apply_mask_img
-from .RelabelROI import apply_relabel_rois
-from .ReorientImage import apply_reorient_img, apply_reorient_to_init
+from .CalcROIVol import ROITable, create_roi_csv, get_label_counts
+from .ledger import LEDGER_FILE, RunLedger
+from .MaskImage import apply_mask_img, combine_masks, mask_img, refine_mask
+from .parallel import run_tasks
+from .RelabelROI import relabel_rois
+from .ReorientImage import apply_reorient_img, reorient_img, reorient_to_init
+from .results_io import OUT_FORMATS, check_out_format, write_volumes
+from .scheduler import (
+    MemoryBudget,
+    estimate_memory,
+    estimate_subject_memory,
+    get_voxel_count,
+    sort_largest_first,
+)
 from .SegmentImage import run_dlicv, run_dlmuse
+from .streaming import Stage, run_stream
+from .timing import RunTimer
 from .utils import make_img_list
 
 # Config vars
@@ -16,7 +35,11 @@ SUFF_LPS = "_LPS.nii.gz"
 SUFF_DLICV = "_DLICV.nii.gz"
 SUFF_DLMUSE = "_DLMUSE.nii.gz"
 SUFF_ROI = "_DLMUSE_Volumes.csv"
+SUFF_CROP = "_crop.json"
+SUFF_ORIENT = "_orient.json"
 OUT_CSV = "DLMUSE_Volumes.csv"
+OUT_VOLUMES = "DLMUSE_Volumes"
+OUT_LABEL_COUNTS = "DLMUSE_LabelCounts.npz"
 
 REF_ORIENT = "LPS"
 
@@ -47,6 +70,26 @@ def run_pipeline(
     refaced_data: bool = False,
     sub_fldr: int = 1,
     progress_bar = None,
+    streaming: bool = False,
+    batch_size: int = 8,
+    queue_size: int = 16,
+    workers: int = 1,
+    largest_first: bool = False,
+    resume: bool = False,
+    keep_intermediates: bool = False,
+    backend: str = "subprocess",
+    timing_report: Optional[str] = None,
+    timing_summary: bool = False,
+    tmp_format: str = "nii.gz",
+    tmp_compresslevel: Optional[int] = None,
+    scratch_dir: Optional[str] = None,
+    subject_csv: bool = False,
+    out_format: str = "csv",
+    slab_memory: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    recursive: bool = False,
+    scan_cache: Optional[str] = None,
+    check_headers: bool = False,
 ) -> None:
     """
     NiChart pipeline
@@ -65,14 +108,95 @@ def run_pipeline(
     :type sub_fldr: int
     :param progress_bar: tqdm/stqdm progress bar for DLMUSE (default: None)
     :type progress_bar: tqdm
+    :param streaming: if True, each subject moves through the stages on its own
+                      instead of running each stage on the whole batch
+    :type streaming: bool
+    :param batch_size: maximum number of subjects sent together to DLICV/DLMUSE
+                       in streaming mode (default = 8)
+    :type batch_size: int
+    :param queue_size: maximum number of subjects waiting between two stages in
+                       streaming mode (default = 16)
+    :type queue_size: int
+    :param workers: number of workers for the CPU stages (reorient, mask, relabel,
+                    combine, ROI volumes), independent of DLICV/DLMUSE (default = 1)
+    :type workers: int
+    :param largest_first: if True, subjects are processed by decreasing number of
+                          voxels (read from the NIfTI headers)
+    :type largest_first: bool
+    :param resume: if True, subjects and stages completed in an earlier run with the
+                   same input image and versions (according to the run ledger in
+                   the output directory) are skipped
+    :type resume: bool
+    :param keep_intermediates: if True, the intermediate images of the steps after
+                               DLMUSE (s5_relabeled, s6_combined) are written to the
+                               working dir for debugging (default = False)
+    :type keep_intermediates: bool
+    :param backend: "subprocess" to call the DLICV/DLMUSE commands for each batch,
+                    or "inprocess" to load the models once in this process and
+                    reuse them for all batches (default = "subprocess")
+    :type backend: str
+    :param timing_report: if given, the wall time, CPU time, bytes read/written and
+                          voxel count of each stage and subject are saved to this
+                          file (.json or .csv) at the end of the run
+    :type timing_report: str
+    :param timing_summary: if True, a summary of the time spent in each stage is
+                           shown at the end of the run
+    :type timing_summary: bool
+    :param tmp_format: format of the temporary images in the working dir: "nii.gz"
+                       or "nii" (uncompressed). The images read by DLICV/DLMUSE
+                       keep the .nii.gz suffix, but are stored without compression
+                       (default = "nii.gz")
+    :type tmp_format: str
+    :param tmp_compresslevel: gzip compression level (0-9) of the temporary
+                              .nii.gz images (default: nibabel default). Final
+                              outputs always use the default
+    :type tmp_compresslevel: int
+    :param scratch_dir: if given, the working dir is created in this folder (e.g.
+                        on a local disk or tmpfs) instead of the output dir, and
+                        removed at the end of a run where all subjects completed
+    :type scratch_dir: str
+    :param subject_csv: if True, a roi csv is also written for each subject. The
+                        cohort volumes file (DLMUSE_Volumes) is always written
+    :type subject_csv: bool
+    :param out_format: format of the cohort volumes file: "csv", or "parquet",
+                       "feather" or "hdf5" (float32 columns, MRID as key). With
+                       resume, the subjects of the run are appended to an
+                       existing parquet/feather/hdf5 file (default = "csv")
+    :type out_format: str
+    :param slab_memory: if given (in MB), the masking, relabeling, mask
+                        combination and ROI counting steps read and write the
+                        images one slab at a time, so that their memory per
+                        subject is about slab_memory instead of depending on the
+                        image size (default: whole images)
+    :type slab_memory: int
+    :param max_memory: if given (in MB), memory budget of the CPU stages: the
+                       peak memory of each subject is estimated from its NIfTI
+                       header, and subjects are started only while the total of
+                       the running subjects stays below the budget (a subject
+                       above the budget runs alone). DLICV/DLMUSE are not
+                       included (default: no limit)
+    :type max_memory: int
+    :param recursive: if True, the images in the subfolders of the input folder
+                      are also used
+    :type recursive: bool
+    :param scan_cache: if given, the list of the images of the input folder is
+                       cached in this file (.json), and reused by the next runs
+                       while the folder is not modified
+    :type scan_cache: str
+    :param check_headers: if True, input images with a NIfTI header that can not
+                          be read are skipped before the run
+    :type check_headers: bool
 
 
     :rtype: None
     """
     logging.info(f"Starting the pipeline on folder {sub_fldr}")
+    check_out_format(out_format)
     logging.info(f"Detecting input images for batch [{sub_fldr}]...")
     # Detect input images
-    df_img = make_img_list(in_data)
+    df_img = make_img_list(in_data, recursive, scan_cache, check_headers)
+    if largest_first:
+        df_img = sort_largest_first(df_img)
     logging.info(f"Detecting input images for batch [{sub_fldr}] done")
 
     # Set init paths and envs
@@ -81,11 +205,281 @@ def run_pipeline(
         os.makedirs(out_dir)
     out_dir_final = out_dir
 
-    # Create working dir (FIXME: created within the output dir for now)
-    working_dir = os.path.join(out_dir_final, "temp_working_dir")
+    # Create working dir, within the output dir or in the scratch dir. The name of
+    # the scratch working dir depends on the output dir, so that a resumed run
+    # finds its intermediate files
+    if scratch_dir is None:
+        working_dir = os.path.join(out_dir_final, "temp_working_dir")
+    else:
+        digest = hashlib.sha1(out_dir_final.encode()).hexdigest()[:12]
+        working_dir = os.path.join(
+            os.path.abspath(scratch_dir), f"temp_working_dir_{digest}"
+        )
+        logging.info(f"Using working dir {working_dir}")
 
     os.makedirs(working_dir, exist_ok=True)
 
+    # With the nii format, the temporary images that must be .nii.gz (inputs of
+    # DLICV/DLMUSE) are written without compression
+    compresslevel = 0 if tmp_format == "nii" else tmp_compresslevel
+
+    # Register subjects in the run ledger; with resume, completed subjects are skipped
+    ledger = RunLedger(
+        os.path.join(out_dir_final, LEDGER_FILE),
+        {
+            "dlicv_args": dlicv_extra_args,
+            "dlmuse_args": dlmuse_extra_args,
+            "refaced_data": refaced_data,
+        },
+    )
+    df_all = df_img
+    df_img = ledger.start(df_all, resume)
+    timer = RunTimer()
+
+    # The roi volumes of the subjects are collected in memory, and the cohort csv
+    # is written once at the end of the run
+    roi_table = ROITable(df_all.sort_index(), DICT_MUSE_SINGLE, DICT_MUSE_DERIVED)
+
+    if streaming:
+        if progress_bar is not None:
+            progress_bar.set_description("Running streaming pipeline")
+        run_pipeline_streaming(
+            df_img,
+            working_dir,
+            out_dir_final,
+            device,
+            dlmuse_extra_args=dlmuse_extra_args,
+            dlicv_extra_args=dlicv_extra_args,
+            refaced_data=refaced_data,
+            sub_fldr=sub_fldr,
+            batch_size=batch_size,
+            queue_size=queue_size,
+            workers=workers,
+            ledger=ledger,
+            keep_intermediates=keep_intermediates,
+            backend=backend,
+            timer=timer,
+            tmp_format=tmp_format,
+            compresslevel=compresslevel,
+            roi_table=roi_table,
+            subject_csv=subject_csv,
+            slab_memory=slab_memory,
+            max_memory=max_memory,
+        )
+    else:
+        run_pipeline_batch(
+            df_img,
+            working_dir,
+            out_dir_final,
+            device,
+            dlmuse_extra_args=dlmuse_extra_args,
+            dlicv_extra_args=dlicv_extra_args,
+            refaced_data=refaced_data,
+            sub_fldr=sub_fldr,
+            workers=workers,
+            ledger=ledger,
+            progress_bar=progress_bar,
+            keep_intermediates=keep_intermediates,
+            backend=backend,
+            timer=timer,
+            tmp_format=tmp_format,
+            compresslevel=compresslevel,
+            roi_table=roi_table,
+            subject_csv=subject_csv,
+            slab_memory=slab_memory,
+            max_memory=max_memory,
+        )
+
+    logging.info(f"Combine ROI csv for batch [{sub_fldr}]...")
+    # Write the cohort roi csv (for all subjects, including the ones skipped with
+    # resume; their volumes are read from the saved label counts, or calculated
+    # from their final segmentation). The label counts of all subjects are saved
+    # too, so that the volumes can be re-derived without the segmentations
+    if progress_bar is not None:
+        progress_bar.update(1)
+        progress_bar.set_description("Combining CSV")
+    out_volumes = os.path.join(out_dir_final, OUT_VOLUMES + OUT_FORMATS[out_format])
+    with timer.measure("combine_csv", n_subjects=len(df_all), out_files=[out_volumes]):
+        missing = set(roi_table.missing())
+        df_prev = df_all[
+            [x in missing and ledger.is_done(x, "roi_csv") for x in df_all.img_prefix]
+        ]
+        fill_roi_table(roi_table, df_prev, out_dir_final, workers, slab_memory)
+        write_volumes(
+            roi_table.to_dataframe(), out_volumes, resume, updated=df_img.MRID
+        )
+        roi_table.write_label_counts(os.path.join(out_dir_final, OUT_LABEL_COUNTS))
+    ledger.compact()
+
+    # The scratch working dir is kept only if some subjects did not complete
+    all_done = all(ledger.is_done(x, "roi_csv") for x in df_all.img_prefix)
+    if scratch_dir is not None and all_done and not keep_intermediates:
+        shutil.rmtree(working_dir)
+
+    if timing_summary:
+        print(f"Time per stage for batch [{sub_fldr}]:")
+        print(timer.format_summary())
+    if timing_report is not None:
+        timer.write_report(
+            timing_report,
+            {
+                "in_data": in_data,
+                "n_subjects": len(df_all),
+                "n_processed": len(df_img),
+                "device": device,
+                "backend": backend,
+                "streaming": streaming,
+                "workers": workers,
+                "batch_size": batch_size,
+                "versions": ledger.versions,
+            },
+        )
+
+    logging.info(f"Combine ROI csv for batch [{sub_fldr}] done")
+
+
+def _remove_outputs(df_img: pd.DataFrame, out_dir: str, out_suff: str) -> None:
+    """
+    Removes outputs left by an earlier run, for stages that are skipped when their
+    output exists
+    """
+    for img_prefix in df_img.img_prefix:
+        out_file = os.path.join(out_dir, img_prefix + out_suff)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+
+def _mark_stage(
+    ledger: RunLedger, df_img: pd.DataFrame, stage: str, out_dir: str, out_suff: str
+) -> None:
+    """
+    Records the stage as completed for the subjects with an output file
+    """
+    for img_prefix in df_img.img_prefix:
+        if os.path.exists(os.path.join(out_dir, img_prefix + out_suff)):
+            ledger.mark_done(img_prefix, stage)
+
+
+def _select_stage(
+    ledger: RunLedger,
+    df_img: pd.DataFrame,
+    stage: str,
+    prev_stage: Optional[str],
+    in_files: Callable,
+) -> pd.DataFrame:
+    """
+    Returns the images for which the stage is not completed and can run: the
+    previous stage is completed and the input files exist. The other images are
+    recorded as failed (once) and skipped. in_files returns the list of
+    (input file, stage that writes it) of a subject; a missing input is written
+    again by the next resumed run
+    """
+    sel = []
+    for row in df_img.itertuples(index=False):
+        if ledger.is_done(row.img_prefix, stage) or ledger.is_failed(row.img_prefix):
+            sel.append(False)
+            continue
+        if prev_stage is not None and not ledger.is_done(row.img_prefix, prev_stage):
+            logging.warning(f"Skip subject {row.MRID}, {prev_stage} not completed")
+            ledger.mark_failed(row.img_prefix)
+            sel.append(False)
+            continue
+        missing = [x for x in in_files(row) if not os.path.exists(x[0])]
+        if len(missing) > 0:
+            logging.warning(f"Skip subject {row.MRID}, input missing: {missing[0][0]}")
+            ledger.mark_failed(row.img_prefix, missing[0][1])
+            sel.append(False)
+            continue
+        sel.append(True)
+    return df_img.loc[sel]
+
+
+def _drop_failed(ledger: RunLedger, df_img: pd.DataFrame, failed: list) -> pd.DataFrame:
+    """
+    Records as failed the subjects with an MRID in the failed list, and returns
+    the other subjects
+    """
+    is_failed = df_img.MRID.isin(failed)
+    for img_prefix in df_img.img_prefix[is_failed]:
+        ledger.mark_failed(img_prefix)
+    return df_img[~is_failed]
+
+
+def run_pipeline_batch(
+    df_img: pd.DataFrame,
+    working_dir: str,
+    out_dir_final: str,
+    device: str,
+    dlmuse_extra_args: str,
+    dlicv_extra_args: str,
+    refaced_data: bool,
+    sub_fldr: int,
+    workers: int,
+    ledger: RunLedger,
+    progress_bar: Any = None,
+    keep_intermediates: bool = False,
+    backend: str = "subprocess",
+    timer: Optional[RunTimer] = None,
+    tmp_format: str = "nii.gz",
+    compresslevel: Optional[int] = None,
+    roi_table: Optional[ROITable] = None,
+    subject_csv: bool = True,
+    slab_memory: Optional[int] = None,
+    max_memory: Optional[int] = None,
+) -> None:
+    """
+    Batch version of the pipeline: each stage is applied to all subjects before the
+    next stage starts. Stages already completed for a subject (according to the
+    ledger) are skipped
+
+    :param df_img: the list of input images
+    :type df_img: pd.DataFrame
+    :param working_dir: the directory for the intermediate files
+    :type working_dir: str
+    :param out_dir_final: the output directory
+    :type out_dir_final: str
+    :param device: cuda/mps for GPU acceleration otherwise cpu
+    :type device: str
+    :param dlmuse_extra_args: extra arguments for DLMUSE package
+    :type dlmuse_extra_args: str
+    :param dlicv_extra_args: extra arguments for DLICV package
+    :type dlicv_extra_args: str
+    :param refaced_data: keep the largest component of the DLICV mask
+    :type refaced_data: bool
+    :param sub_fldr: the batch index used in log messages
+    :type sub_fldr: int
+    :param workers: number of workers for the CPU stages
+    :type workers: int
+    :param ledger: the run ledger
+    :type ledger: RunLedger
+    :param progress_bar: tqdm/stqdm progress bar for DLMUSE (default: None)
+    :type progress_bar: tqdm
+    :param keep_intermediates: if True, the relabeled and combined images are
+                               written to working_dir
+    :type keep_intermediates: bool
+    :param backend: segmentation backend ("subprocess" or "inprocess")
+    :type backend: str
+    :param timer: if given, the time of each stage and subject is recorded
+    :type timer: RunTimer
+    :param tmp_format: format of the temporary images ("nii.gz" or "nii")
+    :type tmp_format: str
+    :param compresslevel: gzip compression level of the temporary .nii.gz images
+    :type compresslevel: int
+    :param roi_table: if given, the roi volumes of the subjects are added to it
+    :type roi_table: ROITable
+    :param subject_csv: if True, a roi csv is written for each subject
+    :type subject_csv: bool
+    :param slab_memory: if given (in MB), the masking, relabeling, mask
+                        combination and ROI counting steps process the images one
+                        slab at a time, using about this much memory per subject
+    :type slab_memory: int
+    :param max_memory: if given (in MB), subjects are started only while the
+                       estimated memory of the running subjects stays below
+                       this budget
+    :type max_memory: int
+
+    :rtype: None
+    """
     logging.info(f"Reorient images to LPS for batch [{sub_fldr}]...")
     # Reorient image to LPS
     out_dir = os.path.join(working_dir, "s1_reorient_lps")
@@ -96,7 +490,26 @@ def run_pipeline(
     if progress_bar is not None:
         progress_bar.update(1)
         progress_bar.set_description("Reorienting images")
-    apply_reorient_img(df_img, ref, out_dir, out_suff)
+    df_todo = _select_stage(
+        ledger, df_img, "reorient", None, lambda x: [(x.img_path, None)]
+    )
+    _remove_outputs(df_todo, out_dir, out_suff)
+    failed: list = []
+    apply_reorient_img(
+        df_todo,
+        ref,
+        out_dir,
+        out_suff,
+        workers=workers,
+        timer=timer,
+        compresslevel=compresslevel,
+        max_memory=max_memory,
+        orient_suff=SUFF_ORIENT,
+        passthrough=True,
+        failed=failed,
+    )
+    df_todo = _drop_failed(ledger, df_todo, failed)
+    _mark_stage(ledger, df_todo, "reorient", out_dir, out_suff)
     logging.info(f"Reorient images to LPS for batch [{sub_fldr}] done")
 
     logging.info(f"Applying DLICV for batch [{sub_fldr}]...")
@@ -110,25 +523,50 @@ def run_pipeline(
     if progress_bar is not None:
         progress_bar.update(1)
         progress_bar.set_description("Running DLICV")
-    run_dlicv(in_dir, in_suff, out_dir, out_suff, device, dlicv_extra_args)
+    df_todo = _select_stage(
+        ledger,
+        df_img,
+        "dlicv",
+        "reorient",
+        lambda x: [(os.path.join(in_dir, x.img_prefix + in_suff), "reorient")],
+    )
+    rows = segment_batch(
+        list(df_todo.itertuples(index=False)),
+        run_dlicv,
+        in_dir,
+        in_suff,
+        out_dir,
+        out_suff,
+        device,
+        extra_args=dlicv_extra_args,
+        backend=backend,
+        timer=timer,
+    )
 
     # If refaced data is specified, refine the masks used in the next step (s3_masked)
     if refaced_data:
-        import SimpleITK as sitk
-
-        for _, tmp_row in df_img.iterrows():
-            img_prefix = tmp_row.img_prefix
-            fpath = os.path.join(out_dir, img_prefix + SUFF_DLICV)
-            if os.path.exists(fpath):
-                s2_dlicv_output = sitk.ReadImage(fpath)
-                # Keep only the largest connected component
-                mask_component = sitk.ConnectedComponent(s2_dlicv_output)
-                mask_sorted_component = sitk.RelabelComponent(
-                    mask_component, sortByObjectSize=True
-                )
-                final_mask = sitk.Equal(mask_sorted_component, 1)
-                # Write refined mask back in-place within s2_dlicv
-                sitk.WriteImage(final_mask, fpath)
+        tasks = [(os.path.join(out_dir, x.img_prefix + SUFF_DLICV),) for x in rows]
+        task_memory = None
+        if max_memory is not None:
+            task_memory = [estimate_memory(x[0], "refine_dlicv") for x in tasks]
+        run_tasks(
+            refine_dlicv_mask,
+            tasks,
+            workers,
+            timer=timer,
+            stage="refine_dlicv",
+            subjects=[x.MRID for x in rows],
+            keep_results=False,
+            task_memory=task_memory,
+            max_memory=max_memory,
+            failed=failed,
+        )
+        for tmp_row in rows:
+            if tmp_row.MRID in failed:
+                ledger.mark_failed(tmp_row.img_prefix)
+        rows = [x for x in rows if x.MRID not in failed]
+    for tmp_row in rows:
+        ledger.mark_done(tmp_row.img_prefix, "dlicv")
 
     logging.info(f"Applying DLICV for batch [{sub_fldr}] done")
 
@@ -145,7 +583,34 @@ def run_pipeline(
     if progress_bar is not None:
         progress_bar.update(1)
         progress_bar.set_description("Applying mask")
-    apply_mask_img(df_img, in_dir, in_suff, mask_dir, mask_suff, out_dir, out_suff)
+    df_todo = _select_stage(
+        ledger,
+        df_img,
+        "mask",
+        "dlicv",
+        lambda x: [
+            (os.path.join(in_dir, x.img_prefix + in_suff), "reorient"),
+            (os.path.join(mask_dir, x.img_prefix + mask_suff), "dlicv"),
+        ],
+    )
+    apply_mask_img(
+        df_todo,
+        in_dir,
+        in_suff,
+        mask_dir,
+        mask_suff,
+        out_dir,
+        out_suff,
+        workers=workers,
+        timer=timer,
+        compresslevel=compresslevel,
+        crop_suff=SUFF_CROP,
+        slab_memory=slab_memory,
+        max_memory=max_memory,
+        failed=failed,
+    )
+    df_todo = _drop_failed(ledger, df_todo, failed)
+    _mark_stage(ledger, df_todo, "mask", out_dir, out_suff)
 
     logging.info(f"Applying mask for batch [{sub_fldr}] done")
 
@@ -160,87 +625,820 @@ def run_pipeline(
     if progress_bar is not None:
         progress_bar.update(1)
         progress_bar.set_description("Running DLMUSE")
-    run_dlmuse(in_dir, in_suff, out_dir, out_suff, device, dlmuse_extra_args)
-
-    logging.info(f"Applying DLMUSE for batch [{sub_fldr}] done")
-
-    logging.info(f"Relabeling DLMUSE for batch [{sub_fldr}]...")
-    # Relabel DLMUSE
-    in_dir = os.path.join(working_dir, "s4_dlmuse")
-    out_dir = os.path.join(working_dir, "s5_relabeled")
-    in_suff = SUFF_DLMUSE
-    out_suff = SUFF_DLMUSE
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    if progress_bar is not None:
-        progress_bar.update(1)
-        progress_bar.set_description("Relabeling ROIs")
-    apply_relabel_rois(
+    df_todo = _select_stage(
+        ledger,
         df_img,
+        "dlmuse",
+        "mask",
+        lambda x: [(os.path.join(in_dir, x.img_prefix + in_suff), "mask")],
+    )
+    rows = segment_batch(
+        list(df_todo.itertuples(index=False)),
+        run_dlmuse,
         in_dir,
         in_suff,
         out_dir,
         out_suff,
+        device,
+        extra_args=dlmuse_extra_args,
+        backend=backend,
+        timer=timer,
+    )
+    for tmp_row in rows:
+        ledger.mark_done(tmp_row.img_prefix, "dlmuse")
+
+    logging.info(f"Applying DLMUSE for batch [{sub_fldr}] done")
+
+    logging.info(f"Post-processing DLMUSE for batch [{sub_fldr}]...")
+    # Relabel DLMUSE, combine DLICV and MUSE masks, reorient to initial orientation
+    # and create roi csv. These steps do not need inference, so the images are
+    # passed in memory from one step to the next
+    if progress_bar is not None:
+        progress_bar.update(4)
+        progress_bar.set_description("Post-processing DLMUSE")
+    dlicv_dir = os.path.join(working_dir, "s2_dlicv")
+    df_todo = _select_stage(
+        ledger,
+        df_img,
+        "roi_csv",
+        "dlmuse",
+        lambda x: [
+            (os.path.join(out_dir, x.img_prefix + SUFF_DLMUSE), "dlmuse"),
+            (os.path.join(dlicv_dir, x.img_prefix + SUFF_DLICV), "dlicv"),
+            (x.img_path, None),
+        ],
+    )
+    _remove_outputs(df_todo, out_dir_final, SUFF_DLMUSE)
+    apply_post_process(
+        df_todo,
+        working_dir,
+        out_dir_final,
+        keep_intermediates=keep_intermediates,
+        workers=workers,
+        timer=timer,
+        tmp_format=tmp_format,
+        compresslevel=compresslevel,
+        roi_table=roi_table,
+        subject_csv=subject_csv,
+        slab_memory=slab_memory,
+        max_memory=max_memory,
+        failed=failed,
+    )
+    df_todo = _drop_failed(ledger, df_todo, failed)
+    for stage in ["relabel", "combine", "reorient_init", "roi_csv"]:
+        _mark_stage(ledger, df_todo, stage, out_dir_final, SUFF_DLMUSE)
+
+    logging.info(f"Post-processing DLMUSE for batch [{sub_fldr}] done")
+
+
+def post_process_img(
+    mrid: Any,
+    dlmuse_mask: str,
+    dlicv_mask: str,
+    ref_img: str,
+    out_img: str,
+    out_csv: Optional[str],
+    relabeled_img: Optional[str] = None,
+    combined_img: Optional[str] = None,
+    compresslevel: Optional[int] = None,
+    crop_json: Optional[str] = None,
+    slab_memory: Optional[int] = None,
+    orient_json: Optional[str] = None,
+) -> Any:
+    """
+    Runs the steps after DLMUSE for one subject: relabel ROIs, combine the DLICV and
+    DLMUSE masks, reorient to the initial orientation and calculate the roi
+    volumes. The image is kept in memory between the steps, and the intermediate
+    images and the roi csv are written only if their filenames are given. With
+    slab_memory, relabeling and mask combination run one slab at a time, and the
+    image is passed between them through the intermediate images
+
+    :param mrid: the subject id
+    :type mrid: Any
+    :param dlmuse_mask: the DLMUSE output
+    :type dlmuse_mask: str
+    :param dlicv_mask: the DLICV mask
+    :type dlicv_mask: str
+    :param ref_img: the input image, used as reference for the orientation
+    :type ref_img: str
+    :param out_img: the final segmentation
+    :type out_img: str
+    :param out_csv: the roi csv (default: not written)
+    :type out_csv: str
+    :param relabeled_img: filename for the relabeled image (default: not written)
+    :type relabeled_img: str
+    :param combined_img: filename for the combined mask (default: not written)
+    :type combined_img: str
+    :param compresslevel: gzip compression level of the intermediate images
+    :type compresslevel: int
+    :param crop_json: the crop box saved by the masking step (default: computed
+                      from the DLICV mask)
+    :type crop_json: str
+    :param slab_memory: if given (in MB), memory limit of the slab-wise steps. The
+                        relabeled and combined images must be given
+    :type slab_memory: int
+    :param orient_json: the orientation transform saved by the reorientation step
+                        (default: read from the input image)
+    :type orient_json: str
+
+    :return: the label histogram and the voxel size of the final segmentation
+    :rtype: tuple
+    """
+    nii = relabel_rois(
+        dlmuse_mask,
         DICT_MUSE_NNUNET_MAP,
         LABEL_FROM,
         LABEL_TO,
+        relabeled_img,
+        compresslevel=compresslevel,
+        slab_memory=slab_memory,
+    )
+    nii = combine_masks(
+        nii,
+        dlicv_mask,
+        combined_img,
+        compresslevel=compresslevel,
+        crop_json=crop_json,
+        slab_memory=slab_memory,
     )
+    nii = reorient_to_init(nii, ref_img, out_img, orient_json=orient_json)
+    if out_csv is None:
+        return get_label_counts(nii)
+    return create_roi_csv(mrid, nii, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED, out_csv)
 
-    logging.info(f"Applying DLMUSE for batch [{sub_fldr}] done")
 
-    logging.info(f"Combining DLICV and MUSE masks for batch [{sub_fldr}]...")
-    # Combine DLICV and MUSE masks
-    in_dir = os.path.join(working_dir, "s5_relabeled")
-    mask_dir = os.path.join(working_dir, "s2_dlicv")
-    out_dir = os.path.join(working_dir, "s6_combined")
-    in_suff = SUFF_DLMUSE
-    mask_suff = SUFF_DLICV
-    out_suff = SUFF_DLMUSE
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    if progress_bar is not None:
-        progress_bar.update(1)
-        progress_bar.set_description("Combining masks")
-    apply_combine_masks(df_img, in_dir, in_suff, mask_dir, mask_suff, out_dir, out_suff)
+def apply_post_process(
+    df_img: pd.DataFrame,
+    working_dir: str,
+    out_dir: str,
+    keep_intermediates: bool = False,
+    workers: int = 1,
+    timer: Optional[RunTimer] = None,
+    tmp_format: str = "nii.gz",
+    compresslevel: Optional[int] = None,
+    roi_table: Optional[ROITable] = None,
+    subject_csv: bool = True,
+    slab_memory: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    failed: Optional[list] = None,
+) -> None:
+    """
+    Apply the steps after DLMUSE to all images
 
-    logging.info(f"Combining DLICV and MUSE masks for batch [{sub_fldr}] done")
+    :param df_img: the passed dataframe
+    :type df_img: pd.DataFrame
+    :param working_dir: the directory with the intermediate files
+    :type working_dir: str
+    :param out_dir: the output directory
+    :type out_dir: str
+    :param keep_intermediates: if True, the relabeled and combined images are
+                               written to working_dir (s5_relabeled, s6_combined)
+    :type keep_intermediates: bool
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param timer: if given, the time of each subject is recorded (default: None)
+    :type timer: RunTimer
+    :param tmp_format: format of the intermediate images ("nii.gz" or "nii")
+    :type tmp_format: str
+    :param compresslevel: gzip compression level of the temporary .nii.gz images
+    :type compresslevel: int
+    :param roi_table: if given, the roi volumes of the subjects are added to it
+    :type roi_table: ROITable
+    :param subject_csv: if True, a roi csv is written for each subject
+    :type subject_csv: bool
+    :param slab_memory: if given (in MB), memory limit of the slab-wise steps
+    :type slab_memory: int
+    :param max_memory: if given (in MB), subjects are started only while the
+                       estimated memory of the running subjects stays below
+                       this budget
+    :type max_memory: int
+    :param failed: if given, the errors of the subjects are logged and their
+                   MRIDs are added to this list, and the other subjects continue
+    :type failed: list
 
-    logging.info(f"Reorienting to initial orientation for batch [{sub_fldr}]...")
-    # Reorient to initial orientation
-    in_dir = os.path.join(working_dir, "s6_combined")
-    out_dir = out_dir_final
-    in_suff = SUFF_DLMUSE
-    out_suff = SUFF_DLMUSE
-    if progress_bar is not None:
-        progress_bar.update(1)
-        progress_bar.set_description("Revert to initial orientation")
-    apply_reorient_to_init(df_img, in_dir, in_suff, out_dir, out_suff)
+    :rtype: None
+    """
+    tasks = []
+    for tmp_row in df_img.itertuples(index=False):
+        tasks.append(
+            _post_process_args(
+                tmp_row,
+                working_dir,
+                out_dir,
+                keep_intermediates,
+                tmp_format=tmp_format,
+                compresslevel=compresslevel,
+                subject_csv=subject_csv,
+                slab_memory=slab_memory,
+            )
+        )
 
-    logging.info(f"Reorienting to initial orientation for batch [{sub_fldr}] done")
+    # The memory of a subject is estimated from its DLICV mask (full image size)
+    task_memory = None
+    if max_memory is not None:
+        task_memory = [
+            estimate_memory(x.dlicv_mask, "post_process", slab_memory) for x in tasks
+        ]
 
-    logging.info(f"Create ROI csv for batch [{sub_fldr}]...")
-    # Create roi csv
-    in_dir = out_dir_final
-    out_dir = out_dir_final
-    in_suff = SUFF_DLMUSE
-    out_suff = SUFF_ROI
-    if progress_bar is not None:
-        progress_bar.update(1)
-        progress_bar.set_description("Creating ROI CSV")
-    apply_create_roi_csv(
-        df_img, in_dir, in_suff, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED, out_dir, out_suff
+    # Only the label histograms (a small vector for each subject) are sent back
+    hists = run_tasks(
+        post_process_img,
+        tasks,
+        workers,
+        timer=timer,
+        stage="post_process",
+        subjects=list(df_img.MRID),
+        keep_results=roi_table is not None,
+        task_memory=task_memory,
+        max_memory=max_memory,
+        failed=failed,
     )
-    logging.info(f"Create ROI csv for batch [{sub_fldr}] done")
+    if roi_table is not None:
+        for img_prefix, hist in zip(df_img.img_prefix, hists):
+            # Failed subjects have no histogram
+            if hist is not None:
+                roi_table.add(img_prefix, *hist)
 
-    logging.info(f"Combine ROI csv for batch [{sub_fldr}]...")
-    # Combine roi csv
-    in_dir = out_dir_final
-    out_dir = out_dir_final
-    in_suff = SUFF_ROI
-    out_name = OUT_CSV
-    if progress_bar is not None:
-        progress_bar.update(1)
-        progress_bar.set_description("Combining CSV")
-    combine_roi_csv(df_img, in_dir, in_suff, out_dir, out_name)
 
-    logging.info(f"Combine ROI csv for batch [{sub_fldr}] done")
+def fill_roi_table(
+    roi_table: ROITable,
+    df_img: pd.DataFrame,
+    out_dir: str,
+    workers: int = 1,
+    slab_memory: Optional[int] = None,
+) -> None:
+    """
+    Adds to the roi table the volumes of subjects completed in an earlier run.
+    Their label histograms are read from the label counts file of the output
+    directory, or calculated from their final segmentation. Subjects without a
+    final segmentation are skipped
+
+    :param roi_table: the roi table
+    :type roi_table: ROITable
+    :param df_img: the subjects to add
+    :type df_img: pd.DataFrame
+    :param out_dir: the output directory
+    :type out_dir: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param slab_memory: if given (in MB), the segmentations are read one slab at
+                        a time
+    :type slab_memory: int
+
+    :rtype: None
+    """
+    counts_file = os.path.join(out_dir, OUT_LABEL_COUNTS)
+    if os.path.exists(counts_file):
+        roi_table.add_label_counts(counts_file, df_img.img_prefix)
+
+    prefixes = []
+    tasks = []
+    missing = set(roi_table.missing())
+    for img_prefix in df_img.img_prefix:
+        if img_prefix not in missing:
+            continue
+        in_img = os.path.join(out_dir, img_prefix + SUFF_DLMUSE)
+        if os.path.exists(in_img):
+            prefixes.append(img_prefix)
+            tasks.append((in_img, slab_memory))
+        else:
+            logging.info("Skip subject, segmentation missing: " + in_img)
+
+    hists = run_tasks(get_label_counts, tasks, workers)
+    for img_prefix, (counts, vox_size) in zip(prefixes, hists):
+        roi_table.add(img_prefix, counts, vox_size)
+
+
+class PostProcessTask(NamedTuple):
+    """
+    The arguments of post_process_img for a subject, in the order of its
+    parameters (so that the task can be passed positionally to run_tasks)
+    """
+
+    mrid: Any
+    dlmuse_mask: str
+    dlicv_mask: str
+    ref_img: str
+    out_img: str
+    out_csv: Optional[str]
+    relabeled_img: Optional[str]
+    combined_img: Optional[str]
+    compresslevel: Optional[int]
+    crop_json: Optional[str]
+    slab_memory: Optional[int]
+    orient_json: Optional[str]
+
+    @property
+    def in_files(self) -> list:
+        """
+        The files read by the task (DLMUSE, DLICV and initial images, crop box and
+        orientation)
+        """
+        return [
+            self.dlmuse_mask,
+            self.dlicv_mask,
+            self.ref_img,
+            self.crop_json,
+            self.orient_json,
+        ]
+
+    @property
+    def out_files(self) -> list:
+        """
+        The files written by the task
+        """
+        return [self.out_img, self.out_csv, self.relabeled_img, self.combined_img]
+
+
+def _post_process_args(
+    row: Any,
+    working_dir: str,
+    out_dir: str,
+    keep_intermediates: bool,
+    tmp_format: str = "nii.gz",
+    compresslevel: Optional[int] = None,
+    subject_csv: bool = True,
+    slab_memory: Optional[int] = None,
+) -> PostProcessTask:
+    """
+    Returns the arguments of post_process_img for a subject. The slab-wise steps
+    always write the intermediate images to the working dir
+    """
+    prefix = row.img_prefix
+    relabeled_img = None
+    combined_img = None
+    if keep_intermediates or slab_memory is not None:
+        tmp_suff = SUFF_DLMUSE.replace(".nii.gz", "." + tmp_format)
+        relabeled_img = os.path.join(working_dir, "s5_relabeled", prefix + tmp_suff)
+        combined_img = os.path.join(working_dir, "s6_combined", prefix + tmp_suff)
+        os.makedirs(os.path.dirname(relabeled_img), exist_ok=True)
+        os.makedirs(os.path.dirname(combined_img), exist_ok=True)
+    return PostProcessTask(
+        mrid=row.MRID,
+        dlmuse_mask=os.path.join(working_dir, "s4_dlmuse", prefix + SUFF_DLMUSE),
+        dlicv_mask=os.path.join(working_dir, "s2_dlicv", prefix + SUFF_DLICV),
+        ref_img=row.img_path,
+        out_img=os.path.join(out_dir, prefix + SUFF_DLMUSE),
+        out_csv=os.path.join(out_dir, prefix + SUFF_ROI) if subject_csv else None,
+        relabeled_img=relabeled_img,
+        combined_img=combined_img,
+        compresslevel=compresslevel,
+        crop_json=os.path.join(working_dir, "s3_masked", prefix + SUFF_CROP),
+        slab_memory=slab_memory,
+        orient_json=os.path.join(working_dir, "s1_reorient_lps", prefix + SUFF_ORIENT),
+    )
+
+
+def refine_dlicv_mask(fpath: str) -> Any:
+    """
+    Keeps only the largest connected component of a DLICV mask (for refaced data).
+    The refined mask is written back in-place
+
+    :param fpath: the DLICV mask file
+    :type fpath: str
+
+    :return: the refined mask
+    :rtype: niftii image
+    """
+    return refine_mask(fpath, fpath)
+
+
+def segment_batch(
+    rows: list,
+    seg_func: Callable,
+    in_dir: str,
+    in_suff: str,
+    out_dir: str,
+    out_suff: str,
+    device: str,
+    extra_args: str = "",
+    backend: str = "subprocess",
+    timer: Optional[RunTimer] = None,
+) -> list:
+    """
+    Runs DLICV or DLMUSE on a batch of subjects. The input images are linked into a
+    temporary batch folder, so that only the selected subjects are segmented
+
+    :param rows: the subjects of the batch (rows of the image list)
+    :type rows: list
+    :param seg_func: run_dlicv or run_dlmuse
+    :type seg_func: Callable
+    :param in_dir: the input directory
+    :type in_dir: str
+    :param in_suff: the input suffix
+    :type in_suff: str
+    :param out_dir: the output directory
+    :type out_dir: str
+    :param out_suff: the output suffix
+    :type out_suff: str
+    :param device: cuda/mps for GPU acceleration otherwise cpu
+    :type device: str
+    :param extra_args: extra arguments for the segmentation package
+    :type extra_args: str
+    :param backend: segmentation backend ("subprocess" or "inprocess")
+    :type backend: str
+    :param timer: if given, the time of the batch is recorded (default: None)
+    :type timer: RunTimer
+
+    :return: the subjects with a segmentation output
+    :rtype: list
+    """
+    if len(rows) == 0:
+        return []
+    batch_dir = tempfile.mkdtemp(prefix="batch_", dir=out_dir)
+    batch_in = os.path.join(batch_dir, "in")
+    batch_out = os.path.join(batch_dir, "out")
+    os.makedirs(batch_in)
+    for row in rows:
+        fname = row.img_prefix + in_suff
+        os.symlink(os.path.join(in_dir, fname), os.path.join(batch_in, fname))
+
+    # The batch is measured as a single timing record
+    timing: Any = nullcontext()
+    if timer is not None:
+        in_files = [os.path.join(in_dir, x.img_prefix + in_suff) for x in rows]
+        timing = timer.measure(
+            seg_func.__name__.replace("run_", ""),
+            ";".join(str(x.MRID) for x in rows),
+            in_files,
+            [os.path.join(batch_out, x.img_prefix + out_suff) for x in rows],
+            n_subjects=len(rows),
+            include_children=True,
+            voxels=sum(get_voxel_count(x) for x in in_files),
+        )
+    with timing:
+        seg_func(batch_in, in_suff, batch_out, out_suff, device, extra_args, backend)
+
+    done = []
+    for row in rows:
+        fname = row.img_prefix + out_suff
+        if os.path.exists(os.path.join(batch_out, fname)):
+            shutil.move(os.path.join(batch_out, fname), os.path.join(out_dir, fname))
+            done.append(row)
+        else:
+            logging.warning(f"Skip subject, segmentation output missing: {fname}")
+    shutil.rmtree(batch_dir)
+    return done
+
+
+def _stream_reorient(
+    row: Any,
+    working_dir: str,
+    ledger: RunLedger,
+    lps_cache: dict,
+    timer: RunTimer,
+    compresslevel: Optional[int],
+) -> Any:
+    if not ledger.is_done(row.img_prefix, "reorient"):
+        out_img = os.path.join(
+            working_dir, "s1_reorient_lps", row.img_prefix + SUFF_LPS
+        )
+        if os.path.exists(out_img):
+            os.remove(out_img)
+        with timer.measure("reorient", row.MRID, [row.img_path], [out_img]):
+            orient_json = os.path.join(
+                working_dir, "s1_reorient_lps", row.img_prefix + SUFF_ORIENT
+            )
+            lps_cache[row.img_prefix] = reorient_img(
+                row.img_path,
+                REF_ORIENT,
+                out_img,
+                compresslevel=compresslevel,
+                orient_json=orient_json,
+                passthrough=True,
+            )
+        ledger.mark_done(row.img_prefix, "reorient")
+    return row
+
+
+def _stream_dlicv(
+    rows: list,
+    working_dir: str,
+    device: str,
+    extra_args: str,
+    ledger: RunLedger,
+    lps_cache: dict,
+    backend: str,
+    timer: RunTimer,
+) -> list:
+    out_dir = os.path.join(working_dir, "s2_dlicv")
+    rows_done = [x for x in rows if ledger.is_done(x.img_prefix, "dlicv")]
+    rows_todo = [x for x in rows if not ledger.is_done(x.img_prefix, "dlicv")]
+    rows_seg = segment_batch(
+        rows_todo,
+        run_dlicv,
+        os.path.join(working_dir, "s1_reorient_lps"),
+        SUFF_LPS,
+        out_dir,
+        SUFF_DLICV,
+        device,
+        extra_args=extra_args,
+        backend=backend,
+        timer=timer,
+    )
+    for row in rows_seg:
+        ledger.mark_done(row.img_prefix, "dlicv")
+    # Release the images of the subjects that failed
+    for row in rows_todo:
+        if row not in rows_seg:
+            lps_cache.pop(row.img_prefix, None)
+    return rows_done + rows_seg
+
+
+def _stream_mask(
+    row: Any,
+    working_dir: str,
+    ledger: RunLedger,
+    lps_cache: dict,
+    timer: RunTimer,
+    compresslevel: Optional[int],
+    refaced_data: bool,
+    slab_memory: Optional[int],
+) -> Any:
+    in_img = os.path.join(working_dir, "s1_reorient_lps", row.img_prefix + SUFF_LPS)
+    # The reoriented image is read from disk only if it is not kept in memory
+    in_img = lps_cache.pop(row.img_prefix, in_img)
+    if not ledger.is_done(row.img_prefix, "mask"):
+        in_mask = os.path.join(working_dir, "s2_dlicv", row.img_prefix + SUFF_DLICV)
+        out_img = os.path.join(working_dir, "s3_masked", row.img_prefix + SUFF_DLICV)
+        crop_json = os.path.join(working_dir, "s3_masked", row.img_prefix + SUFF_CROP)
+        # INFO: for refaced data, the DLICV mask is refined here, so that the
+        #       masks of a batch are refined in parallel by the workers of this
+        #       stage. Refining is repeated on resume, which gives the same mask
+        if refaced_data:
+            with timer.measure("refine_dlicv", row.MRID, [in_mask], [in_mask]):
+                in_mask = refine_dlicv_mask(in_mask)
+        with timer.measure("mask", row.MRID, [in_mask, in_img], [out_img]):
+            mask_img(
+                in_img,
+                in_mask,
+                out_img,
+                compresslevel=compresslevel,
+                crop_json=crop_json,
+                slab_memory=slab_memory,
+            )
+        ledger.mark_done(row.img_prefix, "mask")
+    return row
+
+
+def _stream_dlmuse(
+    rows: list,
+    working_dir: str,
+    device: str,
+    extra_args: str,
+    ledger: RunLedger,
+    backend: str,
+    timer: RunTimer,
+) -> list:
+    rows_done = [x for x in rows if ledger.is_done(x.img_prefix, "dlmuse")]
+    rows_todo = [x for x in rows if not ledger.is_done(x.img_prefix, "dlmuse")]
+    rows_todo = segment_batch(
+        rows_todo,
+        run_dlmuse,
+        os.path.join(working_dir, "s3_masked"),
+        SUFF_DLICV,
+        os.path.join(working_dir, "s4_dlmuse"),
+        SUFF_DLMUSE,
+        device,
+        extra_args=extra_args,
+        backend=backend,
+        timer=timer,
+    )
+    for row in rows_todo:
+        ledger.mark_done(row.img_prefix, "dlmuse")
+    return rows_done + rows_todo
+
+
+def _stream_post(
+    row: Any,
+    working_dir: str,
+    out_dir: str,
+    keep_intermediates: bool,
+    ledger: RunLedger,
+    timer: RunTimer,
+    tmp_format: str,
+    compresslevel: Optional[int],
+    roi_table: Optional[ROITable],
+    subject_csv: bool,
+    slab_memory: Optional[int],
+) -> Any:
+    if not ledger.is_done(row.img_prefix, "roi_csv"):
+        f_out = os.path.join(out_dir, row.img_prefix + SUFF_DLMUSE)
+        if os.path.exists(f_out):
+            os.remove(f_out)
+        task = _post_process_args(
+            row,
+            working_dir,
+            out_dir,
+            keep_intermediates,
+            tmp_format=tmp_format,
+            compresslevel=compresslevel,
+            subject_csv=subject_csv,
+            slab_memory=slab_memory,
+        )
+        with timer.measure("post_process", row.MRID, task.in_files, task.out_files):
+            counts, vox_size = post_process_img(**task._asdict())
+        if roi_table is not None:
+            roi_table.add(row.img_prefix, counts, vox_size)
+        for stage in ["relabel", "combine", "reorient_init", "roi_csv"]:
+            ledger.mark_done(row.img_prefix, stage)
+    logging.info(f"Subject {row.MRID} done")
+    return row
+
+
+def run_pipeline_streaming(
+    df_img: pd.DataFrame,
+    working_dir: str,
+    out_dir: str,
+    device: str,
+    dlmuse_extra_args: str = "",
+    dlicv_extra_args: str = "",
+    refaced_data: bool = False,
+    sub_fldr: int = 1,
+    batch_size: int = 8,
+    queue_size: int = 16,
+    workers: int = 1,
+    ledger: Optional[RunLedger] = None,
+    keep_intermediates: bool = False,
+    backend: str = "subprocess",
+    timer: Optional[RunTimer] = None,
+    tmp_format: str = "nii.gz",
+    compresslevel: Optional[int] = None,
+    roi_table: Optional[ROITable] = None,
+    subject_csv: bool = True,
+    slab_memory: Optional[int] = None,
+    max_memory: Optional[int] = None,
+) -> None:
+    """
+    Streaming version of the pipeline: each subject moves through the stages on its
+    own, and the stages are connected with bounded queues. DLICV/DLMUSE run on
+    small batches of the subjects that are ready, while the CPU stages process
+    the other subjects, and final results are written as soon as a subject is done
+
+    :param df_img: the list of input images
+    :type df_img: pd.DataFrame
+    :param working_dir: the directory for the intermediate files
+    :type working_dir: str
+    :param out_dir: the output directory
+    :type out_dir: str
+    :param device: cuda/mps for GPU acceleration otherwise cpu
+    :type device: str
+    :param dlmuse_extra_args: extra arguments for DLMUSE package
+    :type dlmuse_extra_args: str
+    :param dlicv_extra_args: extra arguments for DLICV package
+    :type dlicv_extra_args: str
+    :param refaced_data: keep the largest component of the DLICV mask
+    :type refaced_data: bool
+    :param sub_fldr: the batch index used in log messages
+    :type sub_fldr: int
+    :param batch_size: maximum number of subjects sent together to DLICV/DLMUSE
+    :type batch_size: int
+    :param queue_size: maximum number of subjects waiting between two stages
+    :type queue_size: int
+    :param workers: number of worker threads for each CPU stage
+    :type workers: int
+    :param ledger: the run ledger; stages already completed for a subject are
+                   skipped. If None, a new ledger is created in the output directory
+    :type ledger: RunLedger
+    :param keep_intermediates: if True, the relabeled and combined images are
+                               written to working_dir
+    :type keep_intermediates: bool
+    :param backend: segmentation backend ("subprocess" or "inprocess")
+    :type backend: str
+    :param timer: the timer that records the time of each stage and subject. If
+                  None, a new timer is used
+    :type timer: RunTimer
+    :param tmp_format: format of the temporary images ("nii.gz" or "nii")
+    :type tmp_format: str
+    :param compresslevel: gzip compression level of the temporary .nii.gz images
+    :type compresslevel: int
+    :param roi_table: if given, the roi volumes of the subjects are added to it
+    :type roi_table: ROITable
+    :param subject_csv: if True, a roi csv is written for each subject
+    :type subject_csv: bool
+    :param slab_memory: if given (in MB), the masking, relabeling, mask
+                        combination and ROI counting steps process the images one
+                        slab at a time, using about this much memory per subject
+    :type slab_memory: int
+    :param max_memory: if given (in MB), subjects are started only while the
+                       estimated memory of the running subjects stays below
+                       this budget
+    :type max_memory: int
+
+    :rtype: None
+    """
+    if ledger is None:
+        ledger = RunLedger(os.path.join(out_dir, LEDGER_FILE))
+        df_img = ledger.start(df_img, resume=False)
+    if timer is None:
+        timer = RunTimer()
+
+    for sdir in ["s1_reorient_lps", "s2_dlicv", "s3_masked", "s4_dlmuse"]:
+        os.makedirs(os.path.join(working_dir, sdir), exist_ok=True)
+
+    # INFO: reoriented images are kept in memory until they are masked, so that
+    #       they are not read back from disk. At most queue_size + batch_size +
+    #       workers images are waiting for DLICV at the same time
+    lps_cache: dict = {}
+
+    stages = [
+        Stage(
+            "reorient",
+            partial(
+                _stream_reorient,
+                working_dir=working_dir,
+                ledger=ledger,
+                timer=timer,
+                compresslevel=compresslevel,
+                lps_cache=lps_cache,
+            ),
+            workers,
+        ),
+        Stage(
+            "dlicv",
+            partial(
+                _stream_dlicv,
+                working_dir=working_dir,
+                device=device,
+                extra_args=dlicv_extra_args,
+                ledger=ledger,
+                timer=timer,
+                lps_cache=lps_cache,
+                backend=backend,
+            ),
+            batch_size=batch_size,
+        ),
+        Stage(
+            "mask",
+            partial(
+                _stream_mask,
+                working_dir=working_dir,
+                ledger=ledger,
+                timer=timer,
+                compresslevel=compresslevel,
+                lps_cache=lps_cache,
+                refaced_data=refaced_data,
+                slab_memory=slab_memory,
+            ),
+            workers,
+        ),
+        Stage(
+            "dlmuse",
+            partial(
+                _stream_dlmuse,
+                working_dir=working_dir,
+                device=device,
+                extra_args=dlmuse_extra_args,
+                ledger=ledger,
+                timer=timer,
+                backend=backend,
+            ),
+            batch_size=batch_size,
+        ),
+        Stage(
+            "post",
+            partial(
+                _stream_post,
+                working_dir=working_dir,
+                out_dir=out_dir,
+                keep_intermediates=keep_intermediates,
+                ledger=ledger,
+                timer=timer,
+                tmp_format=tmp_format,
+                compresslevel=compresslevel,
+                roi_table=roi_table,
+                subject_csv=subject_csv,
+                slab_memory=slab_memory,
+            ),
+            workers,
+        ),
+    ]
+
+    logging.info(f"Running streaming pipeline for batch [{sub_fldr}]...")
+    rows = list(df_img.itertuples(index=False))
+
+    # Admission by memory: a subject enters the pipeline when its estimated peak
+    # memory fits in the budget, and returns it when it leaves the pipeline
+    budget = MemoryBudget(None if max_memory is None else max_memory * 2**20)
+    row_memory = {}
+    if max_memory is not None:
+        for row in rows:
+            row_memory[row.img_prefix] = estimate_subject_memory(
+                row.img_path, slab_memory
+            )
+
+    def _admit(rows: list) -> Iterator:
+        for row in rows:
+            budget.acquire(row_memory.get(row.img_prefix, 0))
+            yield row
+
+    def _release(row: Any) -> None:
+        budget.release(row_memory.get(row.img_prefix, 0))
+
+    done, failed = run_stream(_admit(rows), stages, queue_size, _release)
+    for row in failed:
+        ledger.mark_failed(row.img_prefix)
+    logging.info(
+        f"Running streaming pipeline for batch [{sub_fldr}] done: "
+        f"{len(done)} subjects completed, {len(failed)} failed"
+    )
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+from typing import Any, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FILE = "DLMUSE_ledger.jsonl"
+
+# Stages recorded in the ledger, in pipeline order
+STAGES = [
+    "reorient",
+    "dlicv",
+    "mask",
+    "dlmuse",
+    "relabel",
+    "combine",
+    "reorient_init",
+    "roi_csv",
+]
+
+
+def hash_file(in_file: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the sha256 hash of the content of a file
+
+    :param in_file: the input file
+    :type in_file: str
+    :param chunk_size: the size of the chunks read from the file
+    :type chunk_size: int
+
+    :return: the hex digest of the file content
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(in_file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_versions() -> dict:
+    """
+    Returns the installed versions of the pipeline and of the segmentation models
+
+    :return: a dictionary with the package versions
+    :rtype: dict
+    """
+    versions = {}
+    for pkg in ["NiChart_DLMUSE", "DLICV", "DLMUSE"]:
+        try:
+            versions[pkg] = metadata.version(pkg)
+        except metadata.PackageNotFoundError:
+            versions[pkg] = "unknown"
+    return versions
+
+
+class RunLedger:
+    """
+    Per-run record of the processed subjects. For each subject (identified by its
+    image prefix) the ledger keeps the hash of the input image, the pipeline and
+    model versions, and the completed stages. It is used to skip the subjects and
+    stages that are already done when a run is resumed.
+
+    The ledger is an append-only json lines file: each update writes the new record
+    of a subject, and the last record of a subject is the valid one. The file is
+    compacted when the run ends.
+    """
+
+    def __init__(self, ledger_file: str, config: Optional[dict] = None) -> None:
+        """
+        :param ledger_file: the ledger file (created if it does not exist)
+        :type ledger_file: str
+        :param config: pipeline settings that change the results (e.g. extra args
+                       of DLICV/DLMUSE). Subjects processed with other settings are
+                       processed again
+        :type config: dict
+        """
+        self.ledger_file = ledger_file
+        self.versions = get_versions()
+        self.versions.update(config or {})
+        self.records: dict = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(ledger_file):
+            with open(ledger_file) as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A partially written last line (e.g. killed run)
+                        logging.warning(f"Skip invalid ledger line: {line.strip()}")
+                        continue
+                    self.records[rec["img_prefix"]] = rec
+
+    def _write(self, rec: dict) -> None:
+        self.records[rec["img_prefix"]] = rec
+        with open(self.ledger_file, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+
+    def _is_unchanged(self, row: Any, size: int, mtime: float) -> bool:
+        """
+        Checks if an input image has the path, size and modification time stored in
+        the ledger
+        """
+        rec = self.records.get(row.img_prefix)
+        return (
+            rec is not None
+            and rec["img_path"] == row.img_path
+            and rec["size"] == size
+            and rec["mtime"] == mtime
+        )
+
+    def _stat_input(self, row: Any) -> tuple:
+        """
+        Returns the size and modification time of an input image, without a hash
+        """
+        stat = os.stat(row.img_path)
+        return None, stat.st_size, stat.st_mtime
+
+    def _hash_input(self, row: Any) -> tuple:
+        """
+        Returns the hash of an input image. The hash stored in the ledger is reused
+        if the file size and modification time did not change
+        """
+        _, size, mtime = self._stat_input(row)
+        rec = self.records.get(row.img_prefix)
+        if self._is_unchanged(row, size, mtime) and rec["input_hash"] is not None:
+            return rec["input_hash"], size, mtime
+        return hash_file(row.img_path), size, mtime
+
+    def start(self, df_img: pd.DataFrame, resume: bool = True) -> pd.DataFrame:
+        """
+        Registers the input images in the ledger and selects the ones to process.
+        A subject is kept if it is new, if its input or the versions changed, or
+        if one of its stages did not complete. The input images are hashed only
+        when the run is resumed: otherwise their size and modification time are
+        stored, and the hash is computed by the next resumed run
+
+        :param df_img: the list of input images
+        :type df_img: pd.DataFrame
+        :param resume: if False, all subjects are processed from the first stage
+        :type resume: bool
+
+        :return: the list of images to process
+        :rtype: pd.DataFrame
+        """
+        rows = list(df_img.itertuples(index=False))
+        read_input = self._hash_input if resume else self._stat_input
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            hashes = list(executor.map(read_input, rows))
+
+        sel = []
+        with self.lock:
+            for row, (input_hash, size, mtime) in zip(rows, hashes):
+                rec = self.records.get(row.img_prefix)
+                # Records without a hash (non-resumed runs) are checked by the size
+                # and modification time of the input
+                is_valid = (
+                    resume
+                    and rec is not None
+                    and (
+                        rec["input_hash"] == input_hash
+                        or rec["input_hash"] is None
+                        and self._is_unchanged(row, size, mtime)
+                    )
+                    and rec["versions"] == self.versions
+                )
+                if is_valid and set(STAGES).issubset(rec["stages"]):
+                    sel.append(False)
+                    continue
+                if not is_valid:
+                    rec = {
+                        "img_prefix": row.img_prefix,
+                        "MRID": row.MRID,
+                        "img_path": row.img_path,
+                        "input_hash": input_hash,
+                        "size": size,
+                        "mtime": mtime,
+                        "versions": self.versions,
+                        "stages": [],
+                        "status": "pending",
+                    }
+                else:
+                    rec = dict(
+                        rec,
+                        input_hash=input_hash,
+                        size=size,
+                        mtime=mtime,
+                        status="pending",
+                    )
+                self._write(rec)
+                sel.append(True)
+
+        df_out = df_img.loc[sel]
+        logging.info(
+            f"Ledger: {len(df_out)} of {len(df_img)} subjects need to be processed"
+        )
+        return df_out
+
+    def is_done(self, img_prefix: str, stage: str) -> bool:
+        """
+        Checks if a stage is completed for a subject
+        """
+        rec = self.records.get(img_prefix)
+        return rec is not None and stage in rec["stages"]
+
+    def pending(self, df_img: pd.DataFrame, stage: str) -> pd.DataFrame:
+        """
+        Returns the images for which the stage is not completed
+        """
+        sel = [not self.is_done(x, stage) for x in df_img.img_prefix]
+        return df_img.loc[sel]
+
+    def mark_done(self, img_prefix: str, stage: str) -> None:
+        """
+        Records a completed stage for a subject
+        """
+        with self.lock:
+            rec = dict(self.records[img_prefix])
+            rec["stages"] = rec["stages"] + [stage]
+            is_done = set(STAGES).issubset(rec["stages"])
+            rec["status"] = "done" if is_done else "running"
+            self._write(rec)
+
+    def is_failed(self, img_prefix: str) -> bool:
+        """
+        Checks if the processing of a subject failed in this run
+        """
+        rec = self.records.get(img_prefix)
+        return rec is not None and rec["status"] == "failed"
+
+    def mark_failed(self, img_prefix: str, redo_stage: Optional[str] = None) -> None:
+        """
+        Records that the processing of a subject failed. If redo_stage is given,
+        it and the later stages are recorded as not completed, so that a resumed
+        run repeats them (e.g. when their output was removed)
+        """
+        with self.lock:
+            rec = dict(self.records[img_prefix], status="failed")
+            if redo_stage is not None:
+                redo = STAGES[STAGES.index(redo_stage) :]
+                rec["stages"] = [x for x in rec["stages"] if x not in redo]
+            self._write(rec)
+
+    def compact(self) -> None:
+        """
+        Rewrites the ledger file with only the last record of each subject
+        """
+        with self.lock:
+            tmp_file = self.ledger_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                for rec in self.records.values():
+                    f.write(json.dumps(rec) + "\n")
+            os.replace(tmp_file, self.ledger_file)
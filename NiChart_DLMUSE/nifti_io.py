@@ -0,0 +1,237 @@
+import gzip
+from typing import Any, Optional
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import Opener
+from nibabel.volumeutils import seek_tell
+
+
+def load_nii(in_img: Any, keep_file_open: bool = False) -> Any:
+    """
+    Returns a NIfTI image. The input can be a filename or an image that is already
+    in memory (e.g. the output of the previous stage), which is returned as is
+
+    :param in_img: the input image or filename
+    :type in_img: str or nibabel image
+    :param keep_file_open: if True, the file is kept open between reads, so that
+                           the slabs of a .nii.gz image are read without
+                           decompressing the file again for each slab
+    :type keep_file_open: bool
+
+    :return: the image
+    :rtype: nibabel image
+    """
+    if isinstance(in_img, nib.spatialimages.SpatialImage):
+        return in_img
+    return nib.load(in_img, keep_file_open=keep_file_open)
+
+
+def save_nii(nii: Any, out_img: str, compresslevel: Optional[int] = None) -> None:
+    """
+    Saves a NIfTI image. The gzip compression level of .nii.gz files can be set,
+    e.g. 0 (no compression) for temporary files that are read back only once
+
+    :param nii: the image
+    :type nii: nibabel image
+    :param out_img: the output filename (.nii or .nii.gz)
+    :type out_img: str
+    :param compresslevel: gzip compression level (0-9). If None, the nibabel
+                          default is used
+    :type compresslevel: int
+
+    :rtype: None
+    """
+    if compresslevel is None or not out_img.endswith(".gz"):
+        nii.to_filename(out_img)
+        return
+    with gzip.GzipFile(out_img, "wb", compresslevel=compresslevel) as f:
+        fh = nib.FileHolder(fileobj=f)
+        nii.to_file_map({"header": fh, "image": fh})
+
+
+def get_img_data(nii: Any, dtype: Any = np.float32, slicer: Any = None) -> np.ndarray:
+    """
+    Returns the data of an image without a float64 copy. Integer data that is
+    stored without scaling is returned in its stored type; float or scaled data
+    is returned in the given float type (default: float32, for intensities)
+
+    :param nii: the image
+    :type nii: nibabel image
+    :param dtype: the float type of scaled or float data (default = np.float32)
+    :type dtype: Any
+    :param slicer: if given, only this part of the image is read (e.g. a slab,
+                   see get_slabs)
+    :type slicer: Any
+
+    :return: the data array
+    :rtype: np.ndarray
+    """
+    dataobj = nii.dataobj
+    if nib.is_proxy(dataobj):
+        if slicer is not None:
+            img = np.asanyarray(dataobj[slicer])
+        elif dataobj.slope == 1 and dataobj.inter == 0 and dataobj.dtype.kind in "iu":
+            return np.asanyarray(dataobj)
+        else:
+            return nii.get_fdata(dtype=dtype, caching="unchanged")
+    else:
+        img = np.asanyarray(dataobj)
+        if slicer is not None:
+            img = img[slicer]
+
+    if img.dtype.kind in "iu":
+        return img
+    return img.astype(dtype, copy=False)
+
+
+def get_img_dtype(nii: Any, dtype: Any = np.float32) -> np.dtype:
+    """
+    Returns the data type of the arrays returned by get_img_data, without reading
+    the image
+    """
+    dataobj = nii.dataobj
+    if nib.is_proxy(dataobj):
+        is_scaled = dataobj.slope != 1 or dataobj.inter != 0
+        stored = np.dtype(dataobj.dtype)
+    else:
+        is_scaled = False
+        stored = np.asanyarray(dataobj).dtype
+    if not is_scaled and stored.kind in "iu":
+        return stored
+    return np.dtype(dtype)
+
+
+def get_label_data(nii: Any, slicer: Any = None) -> np.ndarray:
+    """
+    Returns the data of a label image in the smallest integer type that holds its
+    labels (e.g. uint8 for MUSE labels). Float labels are rounded
+
+    :param nii: the image
+    :type nii: nibabel image
+    :param slicer: if given, only this part of the image is read
+    :type slicer: Any
+
+    :return: the label array
+    :rtype: np.ndarray
+    """
+    img = get_img_data(nii, slicer=slicer)
+    if img.size == 0:
+        return img.astype(np.uint8)
+    if img.dtype.kind not in "iu":
+        img = np.rint(img)
+    vmin, vmax = int(img.min()), int(img.max())
+    dtype = np.promote_types(np.min_scalar_type(vmin), np.min_scalar_type(vmax))
+    if img.dtype.kind not in "iu" or dtype.itemsize < img.dtype.itemsize:
+        img = img.astype(dtype)
+    return img
+
+
+def make_nii(img: np.ndarray, ref_nii: Any, dtype: Any = None) -> Any:
+    """
+    Returns a new image with the data img and the affine and header of ref_nii.
+    The stored data type is the type of img (or dtype), and the scaling of the
+    reference header is not copied
+
+    :param img: the data array
+    :type img: np.ndarray
+    :param ref_nii: the reference image
+    :type ref_nii: nibabel image
+    :param dtype: the stored data type (default: the type of img)
+    :type dtype: Any
+
+    :return: the image
+    :rtype: nibabel image
+    """
+    nii = nib.Nifti1Image(img, ref_nii.affine, ref_nii.header)
+    nii.set_data_dtype(img.dtype if dtype is None else dtype)
+    return nii
+
+
+def get_slabs(shape: Any, bytes_per_voxel: float, slab_memory: Optional[int]) -> list:
+    """
+    Splits an image into slabs along its last axis, so that the memory used to
+    process a slab (bytes_per_voxel for each voxel) is below slab_memory. NIfTI
+    data is stored in Fortran order, so each slab is a contiguous part of the
+    file
+
+    :param shape: the image shape
+    :type shape: Any
+    :param bytes_per_voxel: the memory used for each voxel of a slab (all the
+                            arrays of the processing step)
+    :type bytes_per_voxel: float
+    :param slab_memory: the memory limit in MB. If None, a single slab with the
+                        full image is returned
+    :type slab_memory: int
+
+    :return: the slabs, as slicers of the image
+    :rtype: list
+    """
+    n_slices = shape[-1]
+    if slab_memory is not None:
+        slice_bytes = float(np.prod(shape[:-1])) * bytes_per_voxel
+        n_slices = int(slab_memory * 2**20 // max(slice_bytes, 1))
+        n_slices = max(n_slices, 1)
+    return [
+        (Ellipsis, slice(i, min(i + n_slices, shape[-1])))
+        for i in range(0, shape[-1], n_slices)
+    ]
+
+
+class SlabWriter:
+    """
+    Writes a NIfTI image one slab at a time (in the order of get_slabs), so that
+    the full image is never in memory. The header is that of ref_nii, with the
+    given shape and data type and no scaling
+    """
+
+    def __init__(
+        self,
+        out_img: str,
+        ref_nii: Any,
+        shape: Any,
+        dtype: Any,
+        compresslevel: Optional[int] = None,
+    ) -> None:
+        nii = make_nii(np.zeros((1,) * len(shape), dtype), ref_nii)
+        nii.update_header()
+        self.header = nii.header
+        self.header.set_data_shape(shape)
+        self.header.set_slope_inter(1, 0)
+        # The stored type, with the byte order of the header
+        self.dtype = self.header.get_data_dtype()
+        self.n_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.out_img = out_img
+
+        kwargs = {}
+        if compresslevel is not None and out_img.endswith(".gz"):
+            kwargs["compresslevel"] = compresslevel
+        self.fileobj = Opener(out_img, "wb", **kwargs)
+        self.header.write_to(self.fileobj)
+        seek_tell(self.fileobj, self.header.get_data_offset(), write0=True)
+        self.n_written = 0
+
+    def write(self, slab: np.ndarray) -> None:
+        """
+        Writes the next slab
+        """
+        data = slab.astype(self.dtype, copy=False).tobytes(order="F")
+        self.fileobj.write(data)
+        self.n_written += len(data)
+
+    def close(self) -> None:
+        self.fileobj.close()
+        if self.n_written != self.n_bytes:
+            raise ValueError(
+                f"Incomplete image {self.out_img}: {self.n_written} of "
+                f"{self.n_bytes} bytes written"
+            )
+
+    def __enter__(self) -> "SlabWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.fileobj.close()
@@ -0,0 +1,122 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+from .scheduler import MemoryBudget
+from .timing import RunTimer, timed_call
+
+logger = logging.getLogger(__name__)
+
+
+def _run_task(
+    func: Callable, args: tuple, stage: Optional[str], subject: Any, keep_result: bool
+) -> tuple:
+    """
+    Runs one task, measured if a stage name is given. Returns the result (None if
+    not kept, to avoid sending images back from the workers) and the timing record
+    """
+    if stage is None:
+        out, rec = func(*args), None
+    else:
+        out, rec = timed_call(func, args, stage, subject)
+    return (out if keep_result else None), rec
+
+
+def run_tasks(
+    func: Callable,
+    tasks: list,
+    workers: int = 1,
+    timer: Optional[RunTimer] = None,
+    stage: str = "",
+    subjects: Optional[list] = None,
+    keep_results: bool = True,
+    task_memory: Optional[list] = None,
+    max_memory: Optional[int] = None,
+    failed: Optional[list] = None,
+) -> list:
+    """
+    Applies a function to a list of tasks, using a pool of worker processes.
+    Results are returned in the order of the tasks
+
+    :param func: the function to apply (must be defined at module level)
+    :type func: Callable
+    :param tasks: list of argument tuples, one for each call of func
+    :type tasks: list
+    :param workers: number of worker processes. If 1, tasks run serially in the
+                    current process (default = 1)
+    :type workers: int
+    :param timer: if given, each task is measured and added to the timer
+    :type timer: RunTimer
+    :param stage: the stage name used in the timing records
+    :type stage: str
+    :param subjects: the subject of each task, used in the timing records
+    :type subjects: list
+    :param keep_results: if False, the results are not returned (None for each
+                         task), so that workers do not send them back
+    :type keep_results: bool
+    :param task_memory: the estimated memory of each task in bytes (see
+                        scheduler.estimate_memory)
+    :type task_memory: list
+    :param max_memory: if given (in MB), tasks are started, in order, only while
+                       the memory of the running tasks stays below this budget
+    :type max_memory: int
+    :param failed: if given, a task that raises an error is logged and its subject
+                   (its index if no subjects are given) is added to this list, and
+                   the other tasks continue. By default the error is raised
+    :type failed: list
+
+    :return: the list of results (None for the failed tasks)
+    :rtype: list
+    """
+    failed_ids = list(range(len(tasks))) if subjects is None else subjects
+    if subjects is None:
+        subjects = [""] * len(tasks)
+    stage_name = stage if timer is not None else None
+    calls = [
+        (func, task, stage_name, subject, keep_results)
+        for task, subject in zip(tasks, subjects)
+    ]
+
+    def _get_result(get_out: Callable, task_id: Any) -> tuple:
+        # Errors are raised, or recorded if a list of failed tasks is given
+        try:
+            return get_out()
+        except Exception:
+            if failed is None:
+                raise
+            logging.exception(f"Stage {stage or func.__name__} failed for {task_id}")
+            failed.append(task_id)
+            return None, None
+
+    workers = min(int(workers), len(tasks))
+    if workers <= 1:
+        outs = [
+            _get_result(partial(_run_task, *call), task_id)
+            for call, task_id in zip(calls, failed_ids)
+        ]
+    else:
+        logging.info(f"Running {len(tasks)} tasks with {workers} workers")
+        if task_memory is None or max_memory is None:
+            budget = MemoryBudget(None)
+            task_memory = [0] * len(tasks)
+        else:
+            budget = MemoryBudget(max_memory * 2**20)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for call, mem in zip(calls, task_memory):
+                # The memory of a task is returned when it completes
+                budget.acquire(mem)
+                future = executor.submit(_run_task, *call)
+                future.add_done_callback(lambda _, mem=mem: budget.release(mem))
+                futures.append(future)
+            outs = [
+                _get_result(future.result, task_id)
+                for future, task_id in zip(futures, failed_ids)
+            ]
+
+    if timer is not None:
+        for _, rec in outs:
+            if rec is not None:
+                timer.add(rec)
+    return [out for out, _ in outs]
@@ -0,0 +1,257 @@
+import glob
+import logging
+import os
+import shutil
+import time
+import warnings
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Output formats of the roi volumes, and the extension of each
+OUT_FORMATS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "hdf5": ".h5",
+}
+
+# Optional dependency of each binary format (installed with the extra of the same
+# name, e.g. pip install NiChart_DLMUSE[parquet])
+FORMAT_MODULES = {
+    "parquet": "pyarrow",
+    "feather": "pyarrow",
+    "hdf5": "tables",
+}
+
+# Key of the volumes table in hdf5 files
+HDF_KEY = "volumes"
+
+
+def get_out_format(out_file: str) -> str:
+    """
+    Returns the format of a volumes file, from its extension
+    """
+    for out_format, ext in OUT_FORMATS.items():
+        if out_file.endswith(ext):
+            return out_format
+    raise ValueError(f"Unknown format of volumes file: {out_file}")
+
+
+def _typed(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the volumes with MRID as string and float32 roi columns
+    """
+    df = df.astype({x: np.float32 for x in df.columns if x != "MRID"})
+    df["MRID"] = df["MRID"].astype(str)
+    return df
+
+
+def check_out_format(out_format: str) -> None:
+    """
+    Checks that the optional dependency of an output format is installed, so that
+    a run fails before any work if it is missing
+
+    :param out_format: the output format ("csv", "parquet", "feather" or "hdf5")
+    :type out_format: str
+
+    :rtype: None
+    """
+    if out_format not in OUT_FORMATS:
+        raise ValueError(f"Unknown output format: {out_format}")
+    module = FORMAT_MODULES.get(out_format)
+    if module is None:
+        return
+    try:
+        __import__(module)
+    except ImportError:
+        raise ImportError(
+            f"The {out_format} output format needs the '{module}' package: "
+            f"pip install NiChart_DLMUSE[{out_format}] (or pip install {module})"
+        ) from None
+
+
+def _part_name(out_file: str) -> str:
+    """
+    Returns the filename of a new partition of a partitioned volumes folder. Names
+    are ordered by creation time
+    """
+    ext = OUT_FORMATS[get_out_format(out_file)]
+    return os.path.join(out_file, f"part-{time.time_ns():020d}{ext}")
+
+
+def _list_parts(out_file: str) -> list:
+    ext = OUT_FORMATS[get_out_format(out_file)]
+    return sorted(glob.glob(os.path.join(out_file, "part-*" + ext)))
+
+
+def read_volume_ids(in_file: str) -> list:
+    """
+    Returns the MRIDs stored in a volumes file (only the MRID column is read)
+
+    :param in_file: the volumes file (or folder, for parquet and feather)
+    :type in_file: str
+
+    :return: the list of MRIDs
+    :rtype: list
+    """
+    if not os.path.exists(in_file):
+        return []
+    out_format = get_out_format(in_file)
+    check_out_format(out_format)
+    if out_format == "csv":
+        return list(pd.read_csv(in_file, usecols=["MRID"], dtype=str).MRID)
+    if out_format == "hdf5":
+        return list(pd.read_hdf(in_file, HDF_KEY, columns=["MRID"]).MRID)
+    mrids = []
+    for part in _list_parts(in_file):
+        if out_format == "parquet":
+            mrids.extend(pd.read_parquet(part, columns=["MRID"]).MRID)
+        else:
+            mrids.extend(pd.read_feather(part, columns=["MRID"]).MRID)
+    return mrids
+
+
+def read_volumes(in_file: str) -> pd.DataFrame:
+    """
+    Reads a volumes file. If a subject was appended more than once, its last
+    record is kept
+
+    :param in_file: the volumes file (or folder, for parquet and feather)
+    :type in_file: str
+
+    :return: the roi volumes
+    :rtype: pd.DataFrame
+    """
+    out_format = get_out_format(in_file)
+    check_out_format(out_format)
+    if out_format == "csv":
+        df = pd.read_csv(in_file, dtype={"MRID": str})
+    elif out_format == "hdf5":
+        df = pd.read_hdf(in_file, HDF_KEY)
+    else:
+        if out_format == "parquet":
+            dfs = [pd.read_parquet(x) for x in _list_parts(in_file)]
+        else:
+            dfs = [pd.read_feather(x) for x in _list_parts(in_file)]
+        df = pd.concat(dfs) if len(dfs) > 0 else pd.DataFrame(columns=["MRID"])
+    return df.drop_duplicates("MRID", keep="last").reset_index(drop=True)
+
+
+def _remove_subjects(out_file: str, out_format: str, mrids: set) -> None:
+    """
+    Removes the stored volumes of the given subjects. For parquet and feather, only
+    the partitions that hold one of the subjects are rewritten (or removed if they
+    become empty)
+    """
+    if len(mrids) == 0:
+        return
+    if out_format == "hdf5":
+        # The where expression reads mrids_list from this scope
+        mrids_list = sorted(mrids)  # noqa: F841
+        with pd.HDFStore(out_file) as store:
+            store.remove(HDF_KEY, where="MRID in mrids_list")
+        return
+
+    for part in _list_parts(out_file):
+        if out_format == "parquet":
+            part_ids = pd.read_parquet(part, columns=["MRID"]).MRID
+        else:
+            part_ids = pd.read_feather(part, columns=["MRID"]).MRID
+        if not part_ids.isin(mrids).any():
+            continue
+        if out_format == "parquet":
+            df_part = pd.read_parquet(part)
+        else:
+            df_part = pd.read_feather(part)
+        df_part = df_part[~df_part.MRID.isin(mrids)].reset_index(drop=True)
+        if len(df_part) == 0:
+            os.remove(part)
+            continue
+        tmp_part = part + ".tmp"
+        if out_format == "parquet":
+            df_part.to_parquet(tmp_part, index=False)
+        else:
+            df_part.to_feather(tmp_part)
+        os.replace(tmp_part, part)
+
+
+def write_volumes(
+    df: pd.DataFrame,
+    out_file: str,
+    append: bool = False,
+    updated: Optional[Any] = None,
+) -> None:
+    """
+    Writes the roi volumes. The format is selected by the extension of out_file:
+
+        - csv: text file (the file is always rewritten)
+        - parquet/feather: a folder with one file (partition) for each write
+        - hdf5: a table that rows are appended to
+
+    In the binary formats the roi columns are stored as float32, and the
+    subjects are identified by their MRID. With append, the new subjects are added
+    to the existing file without rewriting it (as a new partition or new rows);
+    subjects that are already stored are written again only if they are in
+    updated, and their old record is removed first (only the partitions that hold
+    them are rewritten). Each subject is stored once, so the files can also be
+    read directly (e.g. with pd.read_parquet on the folder)
+
+    :param df: the roi volumes (MRID column and one column per roi)
+    :type df: pd.DataFrame
+    :param out_file: the output file (or folder, for parquet and feather)
+    :type out_file: str
+    :param append: if True, the volumes are appended to the existing file
+    :type append: bool
+    :param updated: MRIDs of the subjects that replace their stored volumes
+    :type updated: list
+
+    :rtype: None
+    """
+    out_format = get_out_format(out_file)
+    if out_format == "csv":
+        df.to_csv(out_file, index=False)
+        return
+
+    check_out_format(out_format)
+    df = _typed(df)
+    append = append and os.path.exists(out_file)
+    if append:
+        stored = set(read_volume_ids(out_file))
+        updated = set() if updated is None else {str(x) for x in updated}
+        df = df[[x not in stored or x in updated for x in df.MRID]]
+        if len(df) == 0:
+            return
+        _remove_subjects(out_file, out_format, set(df.MRID) & stored)
+        logging.info(f"Appending {len(df)} subjects to {out_file}")
+    elif os.path.isdir(out_file):
+        shutil.rmtree(out_file)
+    elif os.path.exists(out_file):
+        os.remove(out_file)
+
+    if out_format == "hdf5":
+        import tables
+
+        # roi names (e.g. "702") are not valid python identifiers
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", tables.NaturalNameWarning)
+            df.to_hdf(
+                out_file,
+                key=HDF_KEY,
+                format="table",
+                append=append,
+                index=False,
+                data_columns=["MRID"],
+                min_itemsize={"MRID": 64},
+            )
+        return
+
+    os.makedirs(out_file, exist_ok=True)
+    part = _part_name(out_file)
+    if out_format == "parquet":
+        df.to_parquet(part, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(part)
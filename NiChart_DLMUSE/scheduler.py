@@ -0,0 +1,184 @@
+import logging
+import threading
+from typing import Optional
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Peak memory of the CPU stages, in bytes per voxel of the stage input: a factor
+# of the size of the voxel values (as read: stored type, or float32 if scaled)
+# and a constant part for the masks and label images of the stage
+STAGE_MEMORY = {
+    "reorient": (2, 0),
+    "refine_dlicv": (0, 8),
+    "mask": (2, 6),
+    "post_process": (0, 8),
+}
+
+# Bytes per voxel of the parts of the slab-wise stages that read whole images
+# (the ICV mask and its connected components; the reoriented labels). The slabs
+# add slab_memory
+SLAB_STAGE_MEMORY = {"mask": 6, "post_process": 3}
+
+
+def get_voxel_count(in_img: str) -> int:
+    """
+    Returns the number of voxels of an image, read from the NIfTI header only
+
+    :param in_img: the input image
+    :type in_img: str
+
+    :return: the number of voxels (0 if the header can not be read)
+    :rtype: int
+    """
+    try:
+        nii = nib.load(in_img)
+    except Exception:
+        logging.warning(f"Could not read header of {in_img}")
+        return 0
+    return int(np.prod(nii.shape[0:3]))
+
+
+def sort_largest_first(df_img: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sorts the list of images by decreasing number of voxels, so that the largest
+    scans are scheduled first and do not become stragglers at the end of the run
+
+    :param df_img: the list of input images
+    :type df_img: pd.DataFrame
+
+    :return: the sorted list of images (the index is kept, so that the initial
+             order can be restored with sort_index)
+    :rtype: pd.DataFrame
+    """
+    num_vox = np.array([get_voxel_count(x) for x in df_img.img_path])
+    ind_sort = np.argsort(-num_vox, kind="stable")
+    return df_img.iloc[ind_sort]
+
+
+def _read_voxel_info(in_img: str) -> Optional[tuple]:
+    """
+    Returns the number of voxels of an image and the size of its voxel values as
+    read by the pipeline (stored type, or float32 for scaled and float data), from
+    the NIfTI header only
+    """
+    try:
+        nii = nib.load(in_img)
+    except Exception:
+        logging.warning(f"Could not read header of {in_img}")
+        return None
+    itemsize = nii.get_data_dtype().itemsize
+    is_scaled = nii.dataobj.slope != 1 or nii.dataobj.inter != 0
+    if is_scaled or nii.get_data_dtype().kind == "f":
+        itemsize = max(itemsize, 4)
+    return int(np.prod(nii.shape[0:3])), itemsize
+
+
+def estimate_memory(in_img: str, stage: str, slab_memory: Optional[int] = None) -> int:
+    """
+    Estimates the peak memory of a CPU stage for one subject, from the shape and
+    data type in the NIfTI header of the stage input (see STAGE_MEMORY)
+
+    :param in_img: the input image of the stage
+    :type in_img: str
+    :param stage: the stage ("reorient", "refine_dlicv", "mask" or "post_process")
+    :type stage: str
+    :param slab_memory: the memory limit of the slab-wise stages in MB (default:
+                        whole images)
+    :type slab_memory: int
+
+    :return: the estimated memory in bytes (0 if the header can not be read)
+    :rtype: int
+    """
+    info = _read_voxel_info(in_img)
+    if info is None:
+        return 0
+    n_vox, itemsize = info
+    if slab_memory is not None and stage in SLAB_STAGE_MEMORY:
+        return int(n_vox * SLAB_STAGE_MEMORY[stage] + slab_memory * 2**20)
+    factor, const = STAGE_MEMORY[stage]
+    return int(n_vox * (factor * itemsize + const))
+
+
+def estimate_subject_memory(in_img: str, slab_memory: Optional[int] = None) -> int:
+    """
+    Estimates the peak memory of a subject in the streaming pipeline, where a
+    subject is in one stage at a time: the largest stage estimate, plus the
+    reoriented image that is kept in memory until it is masked
+
+    :param in_img: the input image of the subject
+    :type in_img: str
+    :param slab_memory: the memory limit of the slab-wise stages in MB (default:
+                        whole images)
+    :type slab_memory: int
+
+    :return: the estimated memory in bytes (0 if the header can not be read)
+    :rtype: int
+    """
+    info = _read_voxel_info(in_img)
+    if info is None:
+        return 0
+    n_vox, itemsize = info
+    peak = 0
+    for stage, (factor, const) in STAGE_MEMORY.items():
+        if slab_memory is not None and stage in SLAB_STAGE_MEMORY:
+            mem = n_vox * SLAB_STAGE_MEMORY[stage] + slab_memory * 2**20
+        else:
+            mem = n_vox * (factor * itemsize + const)
+        peak = max(peak, mem)
+    return int(peak + n_vox * itemsize)
+
+
+class MemoryBudget:
+    """
+    Admission control of concurrent subjects by memory. A subject acquires its
+    estimated memory before it starts and releases it when it leaves the
+    pipeline. It waits while the memory of the running subjects plus its own is
+    above the budget; when nothing else runs it is always admitted, so that a
+    subject larger than the budget still runs (alone). Thread safe
+
+    :param max_memory: the memory budget in bytes. If None, subjects are never
+                       delayed
+    :type max_memory: int
+    """
+
+    def __init__(self, max_memory: Optional[int]) -> None:
+        self.max_memory = max_memory
+        self.used = 0
+        self.n_running = 0
+        self.cond = threading.Condition()
+
+    def fits(self, n_bytes: int) -> bool:
+        """
+        Returns True if a subject with this memory can start now
+        """
+        if self.max_memory is None or self.n_running == 0:
+            return True
+        return self.used + n_bytes <= self.max_memory
+
+    def acquire(self, n_bytes: int) -> None:
+        """
+        Waits until the subject fits in the budget, and reserves its memory
+        """
+        with self.cond:
+            if self.max_memory is not None and n_bytes > self.max_memory:
+                logging.warning(
+                    f"Estimated memory of a subject ({n_bytes / 2**20:.0f} MB) is "
+                    f"above the budget ({self.max_memory / 2**20:.0f} MB); it will "
+                    "run alone"
+                )
+            self.cond.wait_for(lambda: self.fits(n_bytes))
+            self.used += n_bytes
+            self.n_running += 1
+
+    def release(self, n_bytes: int) -> None:
+        """
+        Returns the memory of a subject that is done
+        """
+        with self.cond:
+            self.used -= n_bytes
+            self.n_running -= 1
+            self.cond.notify_all()
@@ -0,0 +1,172 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Marker sent through the queues to tell a stage worker that no more items will come
+_STOP = object()
+
+
+class Stage(NamedTuple):
+    """
+    A step of a streaming pipeline
+
+    :param name: name of the stage (used in log messages)
+    :type name: str
+    :param func: function applied to the items. If batch_size is 1 it receives a
+                 single item and returns the item to pass downstream (or None to drop
+                 it). Otherwise it receives a list of items and returns the list of
+                 items to pass downstream
+    :type func: Callable
+    :param workers: number of threads running the stage
+    :type workers: int
+    :param batch_size: maximum number of items given to func at once. Batches are
+                       built from the items already waiting in the queue, so a batch
+                       stage never waits for a full batch
+    :type batch_size: int
+    """
+
+    name: str
+    func: Callable
+    workers: int = 1
+    batch_size: int = 1
+
+
+def _get_batch(q_in: queue.Queue, batch_size: int) -> tuple:
+    """
+    Reads up to batch_size items from the queue; blocks only for the first item
+
+    :return: the list of items and a flag set if the stop marker was read
+    :rtype: tuple
+    """
+    items: List[Any] = []
+    item = q_in.get()
+    if item is _STOP:
+        return items, True
+    items.append(item)
+    while len(items) < batch_size:
+        try:
+            item = q_in.get_nowait()
+        except queue.Empty:
+            break
+        if item is _STOP:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def _run_worker(
+    stage: Stage,
+    q_in: queue.Queue,
+    q_out: queue.Queue,
+    failed: list,
+    on_exit: Optional[Callable] = None,
+    is_last: bool = False,
+) -> None:
+    """
+    Worker loop of a stage: applies the stage function to the incoming items and
+    forwards the results. Items that raise an error are logged and dropped.
+    on_exit is called for each item that leaves the pipeline in this stage:
+    dropped or failed items, and all items of the last stage
+    """
+    while True:
+        items, stop = _get_batch(q_in, stage.batch_size)
+        if len(items) > 0:
+            # Items that leave the pipeline in this stage
+            exits = items if is_last else []
+            try:
+                if stage.batch_size == 1:
+                    out = stage.func(items[0])
+                    out_items = [] if out is None else [out]
+                    if out is None:
+                        exits = items
+                else:
+                    out_items = stage.func(items)
+                    if not is_last:
+                        exits = [x for x in items if not any(x is y for y in out_items)]
+            except Exception:
+                logging.exception(f"Stage {stage.name} failed for {items}")
+                failed.extend(items)
+                out_items = []
+                exits = items
+            for out in out_items:
+                q_out.put(out)
+            if on_exit is not None:
+                for item in exits:
+                    on_exit(item)
+        if stop:
+            break
+
+
+def run_stream(
+    items: Iterable,
+    stages: List[Stage],
+    queue_size: int = 16,
+    on_exit: Optional[Callable] = None,
+) -> tuple:
+    """
+    Runs all items through a chain of stages. Each stage has its own worker
+    threads, and consecutive stages are connected with bounded queues, so an item
+    moves to the next stage as soon as it is done with the current one.
+
+    :param items: the input items
+    :type items: Iterable
+    :param stages: the ordered list of stages
+    :type stages: list
+    :param queue_size: maximum number of items waiting between two stages
+    :type queue_size: int
+    :param on_exit: if given, it is called (from the stage threads) with each item
+                    when it leaves the pipeline: completed, failed or dropped by a
+                    stage (the items that a batch stage does not return are
+                    dropped). Used e.g. to release the resources reserved while
+                    the items are read from the input iterable
+    :type on_exit: Callable
+
+    :return: the list of items that completed all stages, and the list of items
+             that failed in one of the stages
+    :rtype: tuple
+    """
+    queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in stages]
+    # Completed items are collected without a size limit
+    queues.append(queue.Queue())
+    failed: List[Any] = []
+
+    threads = []
+    for i, stage in enumerate(stages):
+        stage_threads = []
+        for _ in range(max(1, stage.workers)):
+            t = threading.Thread(
+                target=_run_worker,
+                args=(
+                    stage,
+                    queues[i],
+                    queues[i + 1],
+                    failed,
+                    on_exit,
+                    i == len(stages) - 1,
+                ),
+                name=f"stage_{stage.name}",
+                daemon=True,
+            )
+            t.start()
+            stage_threads.append(t)
+        threads.append(stage_threads)
+
+    # Feed the first stage
+    for item in items:
+        queues[0].put(item)
+
+    # Close the stages in order: when all workers of a stage are done, stop the next
+    for i, stage_threads in enumerate(threads):
+        for _ in stage_threads:
+            queues[i].put(_STOP)
+        for t in stage_threads:
+            t.join()
+
+    done = []
+    while not queues[-1].empty():
+        done.append(queues[-1].get())
+
+    return done, failed
@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+import pandas as pd
+
+from .scheduler import get_voxel_count
+
+logger = logging.getLogger(__name__)
+
+# Fields of a timing record
+RECORD_FIELDS = [
+    "stage",
+    "subject",
+    "n_subjects",
+    "start",
+    "wall_time",
+    "cpu_time",
+    "bytes_read",
+    "bytes_written",
+    "voxels",
+    "pid",
+]
+
+
+def _file_size(fname: str) -> int:
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+
+def _is_nifti(fname: str) -> bool:
+    return fname.endswith(".nii.gz") or fname.endswith(".nii")
+
+
+def _cpu_time(include_children: bool) -> float:
+    """
+    Returns the CPU time of the calling thread, plus the CPU time of the finished
+    child processes (e.g. DLICV/DLMUSE commands) if include_children is set
+    """
+    cpu = time.thread_time()
+    if include_children:
+        t = os.times()
+        cpu += t.children_user + t.children_system
+    return cpu
+
+
+def make_record(
+    stage: str,
+    subject: Any,
+    start: float,
+    wall_time: float,
+    cpu_time: float,
+    in_files: Any = (),
+    out_files: Any = (),
+    n_subjects: int = 1,
+    voxels: Optional[int] = None,
+) -> dict:
+    """
+    Creates a timing record. Bytes read and written are the sizes of the input and
+    output files on disk. If not given, the voxel count is read from the header of
+    the first input image
+
+    :return: the timing record
+    :rtype: dict
+    """
+    in_files = [x for x in in_files if isinstance(x, str)]
+    out_files = [x for x in out_files if isinstance(x, str)]
+    if voxels is None:
+        in_nii = [x for x in in_files if _is_nifti(x)]
+        voxels = get_voxel_count(in_nii[0]) if len(in_nii) > 0 else 0
+    return {
+        "stage": stage,
+        "subject": str(subject),
+        "n_subjects": n_subjects,
+        "start": start,
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "bytes_read": sum(_file_size(x) for x in in_files),
+        "bytes_written": sum(_file_size(x) for x in out_files),
+        "voxels": voxels,
+        "pid": os.getpid(),
+    }
+
+
+def timed_call(func: Callable, args: tuple, stage: str, subject: Any) -> tuple:
+    """
+    Calls func(*args) and measures it. The string arguments that are existing files
+    before the call are counted as inputs, and the ones that are created or
+    modified by the call as outputs. Defined at module level, so that it can run
+    in worker processes
+
+    :return: the result of func and the timing record
+    :rtype: tuple
+    """
+    files = [x for x in args if isinstance(x, str) and os.path.isfile(x)]
+    mtimes = {x: os.path.getmtime(x) for x in files}
+
+    start = time.time()
+    t0 = time.perf_counter()
+    c0 = time.thread_time()
+    out = func(*args)
+    cpu_time = time.thread_time() - c0
+    wall_time = time.perf_counter() - t0
+
+    out_files = [
+        x
+        for x in args
+        if isinstance(x, str)
+        and os.path.isfile(x)
+        and (x not in mtimes or os.path.getmtime(x) != mtimes[x])
+    ]
+    in_files = [x for x in files if x not in out_files]
+    rec = make_record(stage, subject, start, wall_time, cpu_time, in_files, out_files)
+    return out, rec
+
+
+class RunTimer:
+    """
+    Collects the timing records of a run: wall time, CPU time, bytes read and
+    written and number of voxels, for each stage and subject. Stages that process a
+    batch of subjects at once (DLICV/DLMUSE) have one record per batch.
+    The records can be saved as a json or csv report at the end of the run
+    """
+
+    def __init__(self) -> None:
+        self.records: list = []
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+
+    def add(self, rec: Optional[dict]) -> None:
+        """
+        Adds a timing record
+        """
+        if rec is None:
+            return
+        with self.lock:
+            self.records.append(rec)
+
+    @contextmanager
+    def measure(
+        self,
+        stage: str,
+        subject: Any = "",
+        in_files: Any = (),
+        out_files: Any = (),
+        n_subjects: int = 1,
+        include_children: bool = False,
+        voxels: Optional[int] = None,
+    ) -> Iterator[None]:
+        """
+        Measures the enclosed block and adds a record. The output files are read
+        after the block
+
+        :param stage: the stage name
+        :type stage: str
+        :param subject: the subject id
+        :type subject: Any
+        :param in_files: the files read in the block
+        :type in_files: list
+        :param out_files: the files written in the block
+        :type out_files: list
+        :param n_subjects: the number of subjects processed in the block
+        :type n_subjects: int
+        :param include_children: if True, the CPU time of the child processes
+                                 (e.g. DLICV/DLMUSE commands) is included
+        :type include_children: bool
+        :param voxels: the number of voxels processed in the block (default: read
+                       from the first input image)
+        :type voxels: int
+        """
+        start = time.time()
+        t0 = time.perf_counter()
+        c0 = _cpu_time(include_children)
+        yield
+        cpu_time = _cpu_time(include_children) - c0
+        wall_time = time.perf_counter() - t0
+        self.add(
+            make_record(
+                stage,
+                subject,
+                start,
+                wall_time,
+                cpu_time,
+                in_files,
+                out_files,
+                n_subjects,
+                voxels,
+            )
+        )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns the timing records, ordered by start time
+        """
+        with self.lock:
+            df = pd.DataFrame(self.records, columns=RECORD_FIELDS)
+        df["start"] = df["start"] - self.t_start
+        return df.sort_values("start", kind="stable").reset_index(drop=True)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Returns the totals of each stage, in order of first use
+
+        :return: the summary table
+        :rtype: pd.DataFrame
+        """
+        df = self.to_dataframe()
+        cols = ["n_subjects", "wall_time", "cpu_time", "bytes_read", "bytes_written"]
+        df_sum = df.groupby("stage", sort=False)[cols].sum()
+        df_sum["voxels"] = df.groupby("stage", sort=False)["voxels"].sum()
+        df_sum["sec_per_subject"] = df_sum.wall_time / df_sum.n_subjects.clip(lower=1)
+        return df_sum.reset_index()
+
+    def write_report(self, out_file: str, run_info: Optional[dict] = None) -> None:
+        """
+        Writes the timing report. A .csv file gets one row per record; otherwise a
+        json file is written with the run info, the per stage summary and the
+        records
+
+        :param out_file: the report file (.json or .csv)
+        :type out_file: str
+        :param run_info: extra information about the run (e.g. settings)
+        :type run_info: dict
+
+        :rtype: None
+        """
+        if out_file.endswith(".csv"):
+            self.to_dataframe().to_csv(out_file, index=False)
+        else:
+            run = {
+                "start": self.t_start,
+                "wall_time": time.time() - self.t_start,
+            }
+            run.update(run_info or {})
+            report = {
+                "run": run,
+                "summary": self.summary().to_dict(orient="records"),
+                "records": self.to_dataframe().to_dict(orient="records"),
+            }
+            with open(out_file, "w") as f:
+                json.dump(report, f, indent=2)
+        logging.info(f"Timing report saved to {out_file}")
+
+    def format_summary(self) -> str:
+        """
+        Returns the per stage summary as a text table
+        """
+        df = self.summary()
+        df["MB_read"] = df.pop("bytes_read") / 1e6
+        df["MB_written"] = df.pop("bytes_written") / 1e6
+        return df.to_string(index=False, float_format=lambda x: f"{x:.2f}")
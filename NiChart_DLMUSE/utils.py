@@ -1,16 +1,21 @@
-import glob
+import json
 import logging
 import os
 import pathlib
 import re
 import shutil
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Optional
 
-import numpy as np
+import nibabel as nib
 import pandas as pd
 
 LIST_IMG_EXT = [".nii", ".nii.gz"]
 
+# List of the T1 images of a BIDS dataset, written to the output folder
+BIDS_MANIFEST = "BIDS_T1w_list.txt"
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename="pipeline.log", encoding="utf-8", level=logging.DEBUG)
 
@@ -71,21 +76,126 @@ def remove_common_suffix(list_files: list) -> list:
             bnames = [x[0:-3] for x in bnames]
         return bnames
 
-    num_diff_suff = 1
-    while num_diff_suff == 1:
-        tmp_suff = [x[-1] for x in bnames]
-        num_diff_suff = len(set(tmp_suff))
-        if num_diff_suff == 1:
-            bnames = [x[0:-1] for x in bnames]
+    # Length of the suffix shared by all names (at least one character is kept)
+    if len(bnames) == 0:
+        return bnames
+    common = os.path.commonprefix([x[::-1] for x in bnames])
+    num_suff = min(len(common), min(len(x) for x in bnames) - 1)
+    if num_suff > 0:
+        bnames = [x[0:-num_suff] for x in bnames]
     return bnames
 
 
-def make_img_list(in_data: str) -> pd.DataFrame:
+def _read_scan_cache(cache_file: Optional[str], in_dir: str, recursive: bool) -> Any:
+    """
+    Returns the image list saved by scan_img_dir, or None if there is no cache or
+    one of the scanned folders was modified since (files added, removed or renamed)
+    """
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    with open(cache_file) as f:
+        cache = json.load(f)
+    if cache["in_dir"] != in_dir or cache["recursive"] != recursive:
+        return None
+    for dname, mtime in cache["dirs"].items():
+        try:
+            if os.stat(dname).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+    return cache["files"]
+
+
+def scan_img_dir(
+    in_dir: str, recursive: bool = False, cache_file: Optional[str] = None
+) -> list:
+    """
+    Lists the images of a folder, with a single os.scandir pass over each folder
+    (hidden files are skipped, as with glob). The .nii images are listed before
+    the .nii.gz images
+
+    :param in_dir: the input directory
+    :type in_dir: str
+    :param recursive: if True, the subfolders are also scanned
+    :type recursive: bool
+    :param cache_file: if given, the list is saved to this file (.json) with the
+                       modification time of the scanned folders, and reused while
+                       the folders are not modified
+    :type cache_file: str
+
+    :return: the full path of each image
+    :rtype: list
+    """
+    in_dir = os.path.abspath(in_dir)
+    files = _read_scan_cache(cache_file, in_dir, recursive)
+    if files is not None:
+        logging.info(f"Image list of {in_dir} read from {cache_file}")
+        return files
+
+    files_ext: dict = {x: [] for x in LIST_IMG_EXT}
+    dirs = {}
+    to_scan = [in_dir]
+    while len(to_scan) > 0:
+        dname = to_scan.pop(0)
+        dirs[dname] = os.stat(dname).st_mtime_ns
+        with os.scandir(dname) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if recursive and entry.is_dir():
+                    to_scan.append(entry.path)
+                    continue
+                for tmp_ext in LIST_IMG_EXT:
+                    if entry.name.endswith(tmp_ext) and entry.is_file():
+                        files_ext[tmp_ext].append(entry.path)
+    files = [x for tmp_ext in LIST_IMG_EXT for x in files_ext[tmp_ext]]
+
+    if cache_file is not None:
+        cache = {"in_dir": in_dir, "recursive": recursive, "dirs": dirs, "files": files}
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+    return files
+
+
+def _is_valid_img(in_img: str, check_header: bool) -> bool:
+    """
+    Returns True if the image exists and, with check_header, if its NIfTI header can
+    be read
+    """
+    if not check_header:
+        return os.path.exists(in_img)
+    try:
+        nib.load(in_img)
+    except Exception:
+        logging.warning(f"Skip image, header can not be read: {in_img}")
+        return False
+    return True
+
+
+def make_img_list(
+    in_data: str,
+    recursive: bool = False,
+    cache_file: Optional[str] = None,
+    check_headers: bool = False,
+    workers: int = 8,
+) -> pd.DataFrame:
     """
     Make a list of images
 
-    :param in_data: the input directory
+    :param in_data: the input directory, a single image, or a list with the full
+                    path of each image (one in each line)
     :type in_data: str
+    :param recursive: if True, the images in the subfolders of the input directory
+                      are also listed
+    :type recursive: bool
+    :param cache_file: if given, the list of the input directory is cached in this
+                       file between runs (see scan_img_dir)
+    :type cache_file: str
+    :param check_headers: if True, the images with a NIfTI header that can not be
+                          read are skipped
+    :type check_headers: bool
+    :param workers: number of threads that check the images (default = 8)
+    :type workers: int
 
     :return: a dataframe with the information about the passed data
     :rtype: pd.DataFrame
@@ -95,10 +205,9 @@ def make_img_list(in_data: str) -> pd.DataFrame:
     nii_files = []
 
     #   case: input data is a folder with images
-    if os.path.isdir(in_data):
-        in_data = os.path.abspath(in_data)
-        for tmp_ext in LIST_IMG_EXT:
-            nii_files.extend(glob.glob(os.path.join(in_data, "*" + tmp_ext)))
+    is_dir = os.path.isdir(in_data)
+    if is_dir:
+        nii_files = scan_img_dir(in_data, recursive, cache_file)
 
     #   case: input data is a single image file
     elif in_data.endswith(".nii") or in_data.endswith(".nii.gz"):
@@ -117,32 +226,38 @@ def make_img_list(in_data: str) -> pd.DataFrame:
                 if is_nifti is True:
                     nii_files.append(os.path.abspath(line.strip()))
 
-    nii_files = np.array(nii_files)
-
-    # Check if images exist
-    if len(nii_files) > 0:
-        flag = np.zeros(nii_files.shape[0])  # type:ignore
-        for i, ftmp in enumerate(nii_files):
-            if os.path.exists(ftmp):
-                flag[i] = 1
-        nii_files = nii_files[flag == 1]
+    # Check if images exist (images found in the folder do) and if their headers can
+    # be read. The checks run in threads, as they mostly wait for the file system
+    num_detected = len(nii_files)
+    if len(nii_files) > 0 and (check_headers or not is_dir):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            flag = list(
+                executor.map(
+                    partial(_is_valid_img, check_header=check_headers), nii_files
+                )
+            )
+        nii_files = [x for x, is_valid in zip(nii_files, flag) if is_valid]
 
     logging.info(
-        f"Detected {nii_files.shape[0]} images. Valid images are {len(nii_files)}..."  # type:ignore
+        f"Detected {num_detected} images. Valid images are {len(nii_files)}..."
     )
-    # Create a dataframe
-    df_out = pd.DataFrame(data=nii_files, columns=["img_path"])
 
     # Detect file info
     bnames = [os.path.basename(filename) for filename in nii_files]
     bnames_noext = [get_basename(filename, "", LIST_IMG_EXT) for filename in bnames]
     mrids = remove_common_suffix(bnames_noext)
+    if len(set(bnames_noext)) < len(bnames_noext):
+        logging.warning("Input images with the same name: their outputs will clash")
 
-    # Extend the dataframe with file info
-    df_out = df_out.reindex(["MRID", "img_path", "img_base", "img_prefix"], axis=1)
-    df_out["MRID"] = mrids
-    df_out["img_base"] = bnames
-    df_out["img_prefix"] = bnames_noext
+    # Create a dataframe
+    df_out = pd.DataFrame(
+        {
+            "MRID": mrids,
+            "img_path": nii_files,
+            "img_base": bnames,
+            "img_prefix": bnames_noext,
+        }
+    )
 
     # Return out dataframe
     return df_out
@@ -252,87 +367,168 @@ def collect_T1(in_dir: str, out_dir: str) -> None:
                 # os.system(f"cp {os.path.join(in_dir, sub)}/anat/* raw_temp_T1/")
 
 
-def merge_bids_output_data(out_data: str) -> None:
+def _scan_subdirs(in_dir: str, prefix: str) -> list:
+    """
+    Returns the names of the subfolders of in_dir that start with prefix, sorted
+    """
+    with os.scandir(in_dir) as it:
+        names = [x.name for x in it if x.name.startswith(prefix) and x.is_dir()]
+    return sorted(names)
+
+
+def index_bids(
+    in_dir: str, manifest: Optional[str] = None, suffix: str = "_T1w"
+) -> pd.DataFrame:
+    """
+    Indexes the T1 images of a BIDS dataset in place: sub-*/anat and
+    sub-*/ses-*/anat are scanned once, and no file is copied. All the runs of a
+    subject and session are listed (the BIDS file names are unique, so they are
+    used as the image ids)
+
+    :param in_dir: the BIDS dataset
+    :type in_dir: str
+    :param manifest: if given, the full path of each image is written to this
+                     file (one in each line), that can be used as the input of the
+                     pipeline
+    :type manifest: str
+    :param suffix: suffix of the images (default = "_T1w")
+    :type suffix: str
+
+    :return: a dataframe with the img_path, img_prefix, participant_id,
+             session_id and anat_dir (relative to the dataset) of each image
+    :rtype: pd.DataFrame
+    """
+    in_dir = os.path.abspath(in_dir)
+    rows = []
+    for sub in _scan_subdirs(in_dir, "sub-"):
+        anat_dirs = [(None, os.path.join(sub, "anat"))]
+        for ses in _scan_subdirs(os.path.join(in_dir, sub), "ses-"):
+            anat_dirs.append((ses, os.path.join(sub, ses, "anat")))
+        for ses, anat_dir in anat_dirs:
+            if not os.path.isdir(os.path.join(in_dir, anat_dir)):
+                continue
+            with os.scandir(os.path.join(in_dir, anat_dir)) as it:
+                fnames = sorted(x.name for x in it if not x.name.startswith("."))
+            for fname in fnames:
+                img_prefix = get_basename(fname, "", LIST_IMG_EXT)
+                if img_prefix == fname or not img_prefix.endswith(suffix):
+                    continue
+                rows.append(
+                    {
+                        "img_path": os.path.join(in_dir, anat_dir, fname),
+                        "img_prefix": img_prefix,
+                        "participant_id": sub,
+                        "session_id": ses,
+                        "anat_dir": anat_dir,
+                    }
+                )
+    df_bids = pd.DataFrame(
+        rows,
+        columns=["img_path", "img_prefix", "participant_id", "session_id", "anat_dir"],
+    )
+    logging.info(f"Found {len(df_bids)} {suffix[1:]} images in BIDS folder {in_dir}")
+
+    if manifest is not None:
+        with open(manifest, "w") as f:
+            f.writelines([x + "\n" for x in df_bids.img_path])
+    return df_bids
+
+
+def merge_bids_output_data(
+    out_data: str, df_bids: Optional[pd.DataFrame] = None
+) -> None:
     """
-    Move all the images on the s5_relabeled subfolder to the subfolder of their prefix
+    Move the final segmentations to the anat subfolder of their subject
 
     :param out_data: the output_directory
     :type out_data: str
+    :param df_bids: the BIDS index of the input images (see index_bids). If given,
+                    each segmentation is moved to the anat folder of its input
+                    image (sub-*/anat or sub-*/ses-*/anat), which is created in
+                    out_data. Otherwise it is moved to the sub-*/anat folder of its
+                    subject, if it exists
+    :type df_bids: pd.DataFrame
 
     :rtype: None
     """
-    for split in os.listdir(out_data):
-        if get_bids_prefix(split, True) == "split":
-            s5_relabeled_dir = os.path.join(
-                out_data, split, "temp_working_dir", "s5_relabeled"
-            )
-            for img in os.listdir(s5_relabeled_dir):
-                # os.system(
-                #    f"mv {s5_relabeled_dir}/{img} {out_data}/{get_bids_prefix(img, True)}/anat/"
-                # )
-                shutil.move(
-                    pathlib.Path(s5_relabeled_dir) / img,
-                    pathlib.Path(out_data) / get_bids_prefix(img, True) / "anat" / img,
-                )
+    if df_bids is not None:
+        for tmp_row in df_bids.itertuples(index=False):
+            img = tmp_row.img_prefix + "_DLMUSE.nii.gz"
+            if not os.path.exists(os.path.join(out_data, img)):
+                continue
+            anat_dir = pathlib.Path(out_data) / tmp_row.anat_dir
+            anat_dir.mkdir(parents=True, exist_ok=True)
+            shutil.move(pathlib.Path(out_data) / img, anat_dir / img)
+        return
+
+    for img in os.listdir(out_data):
+        if not img.endswith("_DLMUSE.nii.gz"):
+            continue
+        anat_dir = pathlib.Path(out_data) / get_bids_prefix(img, True) / "anat"
+        if anat_dir.is_dir():
+            shutil.move(pathlib.Path(out_data) / img, anat_dir / img)
 
 
-def split_data(in_dir: str, N: int) -> list:
+def split_data(in_data: str, N: int, out_dir: str, mode: str = "manifest") -> list:
     """
-    Splits the input data directory into subfolders of size.
-    N should be > 0 and the number of files in each subfolder should be > 0 as well.
-
-    :param in_dir: the input directory
-    :type in_dir: str
+    Splits the input images into N shards without copying any image.
+    N should be > 0 and the number of images in each shard should be > 0 as well.
+    Each shard is either:
+        - a manifest file (out_dir/split_i.txt) with the full path of its images, one
+          in each row, that can be passed directly as the input of the pipeline
+          (mode = 'manifest'), or
+        - a folder (out_dir/split_i) with symbolic links (mode = 'symlink') or hard
+          links (mode = 'hardlink') to its images
+
+    :param in_data: the input images (folder, single image or list of images)
+    :type in_data: str
 
-    :param N: the number of generated split folders
+    :param N: the number of generated shards
     :type N: int
 
-    :return: a list of the subfolders name
+    :param out_dir: the directory where the shards are created
+    :type out_dir: str
+
+    :param mode: 'manifest', 'symlink' or 'hardlink' (default = 'manifest')
+    :type mode: str
+
+    :return: a list of the shard names (manifest files or folders)
     :rtype: list
     """
     assert N > 0
-    data_size = dir_size(in_dir)
+    assert mode in ["manifest", "symlink", "hardlink"]
+    img_paths = list(make_img_list(in_data).img_path)
+    data_size = len(img_paths)
     no_files_in_folders = (
         data_size // N if (data_size % N == 0) else (data_size // N) + 1
     )
     assert no_files_in_folders > 0
-    subfolders = []
 
-    current_folder = 1
-    current_file = 0
-    pathlib.Path(f"{in_dir}/split_{current_folder}").mkdir(parents=True, exist_ok=True)
-    for img in os.listdir(in_dir):
-        if current_file >= no_files_in_folders:
-            subfolders.append(f"{in_dir}/split_{current_folder}")
-            current_folder += 1
-            pathlib.Path(f"{in_dir}/split_{current_folder}").mkdir(
-                parents=True, exist_ok=True
-            )
-            current_file = 0
-
-        file = os.path.join(in_dir, img)
-        if os.path.isfile(file):
-            shutil.copy2(file, f"{in_dir}/split_{current_folder}")
-            current_file += 1
-
-    if current_file <= no_files_in_folders:
-        # Don't forget the last split if it has less files than the maximum files in a subfolder
-        subfolders.append(f"{in_dir}/split_{current_folder}")
-
-    for subfldr in os.listdir(in_dir):
-        joined_folder = os.path.join(in_dir, subfldr)
-        if os.path.isdir(joined_folder):
-            if len(os.listdir(joined_folder)) == 0:
-                shutil.rmtree(joined_folder)
-                if str(joined_folder) in subfolders:
-                    subfolders.remove(str(joined_folder))
+    os.makedirs(out_dir, exist_ok=True)
+    subfolders = []
+    for i, start in enumerate(range(0, data_size, no_files_in_folders)):
+        shard_files = img_paths[start : start + no_files_in_folders]
+        if mode == "manifest":
+            shard = os.path.join(out_dir, f"split_{i + 1}.txt")
+            with open(shard, "w") as f:
+                f.writelines([x + "\n" for x in shard_files])
+        else:
+            shard = os.path.join(out_dir, f"split_{i + 1}")
+            os.makedirs(shard, exist_ok=True)
+            for file in shard_files:
+                link = os.path.join(shard, os.path.basename(file))
+                if mode == "symlink":
+                    os.symlink(file, link)
+                else:
+                    os.link(file, link)
+        subfolders.append(shard)
 
     return subfolders
 
 
 def remove_subfolders(in_dir: str) -> None:
     """
-    Removes all the split_* subolders from the input folder
+    Removes all the split_* subolders and manifest files from the input folder
 
     :param in_dir: the input directory
     :type in_dir: str
@@ -406,10 +602,14 @@ def merge_output_data(in_dir: str) -> None:
         for file in (pathlib.Path(in_dir) / dir).glob("*.nii.gz"):
             shutil.move(file, pathlib.Path(in_dir))
 
+        # Per-subject csv files (if any) are moved; the volumes are read from the
+        # cohort csv of each split
         for file in (pathlib.Path(in_dir) / dir).glob("*_DLMUSE_Volumes.csv"):
-            df = pd.read_csv(file)
-            found_dlmuse_dfs.append(df)
             shutil.move(file, pathlib.Path(in_dir))
 
+        split_csv = pathlib.Path(in_dir) / dir / "DLMUSE_Volumes.csv"
+        if split_csv.exists():
+            found_dlmuse_dfs.append(pd.read_csv(split_csv, dtype={"MRID": str}))
+
     final_dlmuse_df = pd.concat(found_dlmuse_dfs).reset_index(drop=True)
     final_dlmuse_df.to_csv(pathlib.Path(in_dir) / "DLMUSE_Volumes.csv", index=False)
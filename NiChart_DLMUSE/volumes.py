@@ -0,0 +1,231 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2024 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/NiBAx/blob/main/LICENSE
+"""
+
+import argparse
+import logging
+import os
+from typing import Any, Optional
+
+import pandas as pd
+
+from .CalcROIVol import ROITable, get_label_counts
+from .dlmuse_pipeline import DICT_MUSE_DERIVED, DICT_MUSE_SINGLE, SUFF_DLMUSE
+from .parallel import run_tasks
+from .results_io import check_out_format, get_out_format, write_volumes
+from .utils import make_img_list, remove_common_suffix
+
+logger = logging.getLogger(__name__)
+
+
+def rederive_volumes(
+    label_counts: str,
+    out_file: str,
+    list_single_roi: Any = DICT_MUSE_SINGLE,
+    map_derived_roi: Any = DICT_MUSE_DERIVED,
+    single_out_file: Optional[str] = None,
+) -> None:
+    """
+    Re-derives the roi volume tables of a cohort from its saved label histograms
+    (DLMUSE_LabelCounts.npz), without reading the label maps. Used after a change
+    of the single roi list or of the derived roi map
+
+    :param label_counts: the label counts file (.npz)
+    :type label_counts: str
+    :param out_file: the roi volumes file (.csv, .parquet, .feather or .h5)
+    :type out_file: str
+    :param list_single_roi: single roi list file (default: MUSE rois)
+    :type list_single_roi: Any
+    :param map_derived_roi: derived roi map file (default: MUSE derived rois)
+    :type map_derived_roi: Any
+    :param single_out_file: if given, the single roi volumes are also written to
+                            this file
+    :type single_out_file: str
+
+    :rtype: None
+    """
+    roi_table = ROITable.from_label_counts(
+        label_counts, list_single_roi, map_derived_roi
+    )
+    write_volumes(roi_table.to_dataframe(), out_file)
+    if single_out_file is not None:
+        write_volumes(roi_table.single_dataframe(), single_out_file)
+    logging.info(f"Volumes of {len(roi_table.mrids)} subjects saved to {out_file}")
+
+
+def make_label_list(in_data: str, suffix: str = "_DLMUSE") -> pd.DataFrame:
+    """
+    Makes the list of the DLMUSE label maps. The subject ids (MRID) are detected
+    as in the pipeline, from the image names without the suffix
+
+    :param in_data: the label maps: a folder, a single image, a list with the full
+                    path of each image (one in each line), or a csv file with the
+                    columns img_path and MRID (to set the subject ids)
+    :type in_data: str
+    :param suffix: suffix of the label maps. In a folder or list, only the images
+                   with this suffix are used (default = "_DLMUSE")
+    :type suffix: str
+
+    :return: a dataframe with the MRID, img_path and img_prefix of each image
+    :rtype: pd.DataFrame
+    """
+    if in_data.endswith(".csv"):
+        df_img = pd.read_csv(in_data, dtype={"MRID": str})
+        df_img["img_prefix"] = [
+            os.path.basename(x).replace(".nii.gz", "").replace(".nii", "")
+            for x in df_img.img_path
+        ]
+        return df_img[["MRID", "img_path", "img_prefix"]]
+
+    df_img = make_img_list(in_data)
+    if suffix != "":
+        df_img = df_img[df_img.img_prefix.str.endswith(suffix)].reset_index(drop=True)
+        names = [x[: -len(suffix)] for x in df_img.img_prefix]
+        df_img["MRID"] = remove_common_suffix(names) if len(names) > 0 else []
+    return df_img
+
+
+def recompute_volumes(
+    in_data: str,
+    out_file: str,
+    workers: int = 1,
+    list_single_roi: Any = DICT_MUSE_SINGLE,
+    map_derived_roi: Any = DICT_MUSE_DERIVED,
+    single_out_file: Optional[str] = None,
+    label_counts: Optional[str] = None,
+    suffix: str = SUFF_DLMUSE.replace(".nii.gz", ""),
+) -> None:
+    """
+    Calculates the roi volume tables from existing DLMUSE label maps, without
+    running the segmentation or any other step of the pipeline. The label maps
+    are counted by a pool of worker processes
+
+    :param in_data: the label maps (see make_label_list)
+    :type in_data: str
+    :param out_file: the roi volumes file (.csv, .parquet, .feather or .h5)
+    :type out_file: str
+    :param workers: number of worker processes (default = 1)
+    :type workers: int
+    :param list_single_roi: single roi list file (default: MUSE rois)
+    :type list_single_roi: Any
+    :param map_derived_roi: derived roi map file (default: MUSE derived rois)
+    :type map_derived_roi: Any
+    :param single_out_file: if given, the single roi volumes are also written to
+                            this file
+    :type single_out_file: str
+    :param label_counts: if given, the label histograms are saved to this file
+                         (.npz)
+    :type label_counts: str
+    :param suffix: suffix of the label maps (default = "_DLMUSE")
+    :type suffix: str
+
+    :rtype: None
+    """
+    check_out_format(get_out_format(out_file))
+    df_img = make_label_list(in_data, suffix)
+    logging.info(f"Calculating the volumes of {len(df_img)} label maps")
+
+    roi_table = ROITable(df_img, list_single_roi, map_derived_roi)
+    tasks = [(x,) for x in df_img.img_path]
+    hists = run_tasks(get_label_counts, tasks, workers)
+    for img_prefix, (counts, vox_size) in zip(df_img.img_prefix, hists):
+        roi_table.add(img_prefix, counts, vox_size)
+
+    write_volumes(roi_table.to_dataframe(), out_file)
+    if single_out_file is not None:
+        write_volumes(roi_table.single_dataframe(), single_out_file)
+    if label_counts is not None:
+        roi_table.write_label_counts(label_counts)
+    logging.info(f"Volumes of {len(df_img)} subjects saved to {out_file}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="NiChart_DLMUSE_volumes",
+        description="Calculate the NiChart_DLMUSE ROI volume tables of a cohort "
+        "from existing DLMUSE label maps, or re-derive them from the saved label "
+        "counts (DLMUSE_LabelCounts.npz). Segmentation is not run.",
+    )
+    in_group = parser.add_mutually_exclusive_group(required=True)
+    in_group.add_argument(
+        "-i",
+        "--in_data",
+        type=str,
+        help="DLMUSE label maps: a folder (e.g. the NiChart_DLMUSE output folder), a single image, a list with the full path of each image (one in each line), or a csv file with the columns img_path and MRID.",
+    )
+    in_group.add_argument(
+        "-c",
+        "--label_counts",
+        type=str,
+        help="Label counts file saved by NiChart_DLMUSE (DLMUSE_LabelCounts.npz).",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_file",
+        type=str,
+        required=True,
+        help="Output file with the single and derived ROI volumes. The format is selected by the extension (.csv, .parquet, .feather or .h5).",
+    )
+    parser.add_argument(
+        "--single_out_file",
+        type=str,
+        required=False,
+        default=None,
+        help="If set, the volumes of the single ROIs only are also written to this file.",
+    )
+    parser.add_argument(
+        "--single_roi_list",
+        type=str,
+        required=False,
+        default=DICT_MUSE_SINGLE,
+        help="List of the single ROIs (csv with IndexMUSE and ROINameMUSE columns). By default the MUSE ROIs.",
+    )
+    parser.add_argument(
+        "--derived_roi_map",
+        type=str,
+        required=False,
+        default=DICT_MUSE_DERIVED,
+        help="Derived ROI map (csv without header: derived ROI index, name and the indices of its single ROIs). By default the MUSE derived ROIs.",
+    )
+    parser.add_argument(
+        "--save_label_counts",
+        type=str,
+        required=False,
+        default=None,
+        help="With --in_data, save the label counts of the label maps to this file (.npz), to re-derive the volumes later.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes that read the label maps.",
+    )
+    args = parser.parse_args()
+
+    if args.in_data is not None:
+        recompute_volumes(
+            args.in_data,
+            args.out_file,
+            args.workers,
+            args.single_roi_list,
+            args.derived_roi_map,
+            args.single_out_file,
+            args.save_label_counts,
+        )
+        return
+
+    rederive_volumes(
+        args.label_counts,
+        args.out_file,
+        args.single_roi_list,
+        args.derived_roi_map,
+        args.single_out_file,
+    )
+
+
+if __name__ == "__main__":
+    main()
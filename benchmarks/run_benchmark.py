@@ -0,0 +1,203 @@
+"""
+End-to-end throughput benchmark of NiChart_DLMUSE.
+
+Synthetic T1 images are generated at realistic sizes, and the DLICV/DLMUSE
+commands are replaced by the deterministic CPU stubs in benchmarks/stubs, so the
+benchmark runs offline and measures the pipeline itself (I/O, reorientation,
+masking, relabeling, ROI volumes and scheduling), not the models.
+
+Each configuration runs in its own process. The report has the wall time, the
+number of subjects per hour, the peak RSS (of the largest process of the run) and
+the time of each stage of each configuration.
+
+Example:
+    python benchmarks/run_benchmark.py -n 8 --voxel_size 1.0 0.8 \
+        --config "" "--cores 4" "--streaming --workers 4" -o benchmark.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_t1(shape: tuple, voxel_size: float, seed: int) -> nib.Nifti1Image:
+    """
+    Creates a synthetic T1 image: an ellipsoid head (scalp and brain) with smooth
+    intensity variations and noise. The head size is in mm, so smaller voxels
+    give more brain voxels
+    """
+    rng = np.random.default_rng(seed)
+    center = np.array(shape) / 2 + rng.uniform(-5, 5, 3)
+    radii_mm = np.array([70.0, 85.0, 65.0]) * rng.uniform(0.9, 1.1, 3)
+
+    ind = np.indices(shape, sparse=True)
+    r = sum(
+        ((x - c) * voxel_size / rad) ** 2 for x, c, rad in zip(ind, center, radii_mm)
+    )
+    r = np.sqrt(r)
+
+    img = rng.normal(20, 5, shape).astype(np.float32)
+    img[(r >= 0.9) & (r < 1.0)] = 200
+    brain = r < 0.9
+    img[brain] = 400 + 500 * (1 - r[brain]) + rng.normal(0, 20, int(brain.sum()))
+
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = -np.array(shape) * voxel_size / 2
+    return nib.Nifti1Image(np.clip(img, 0, None).astype(np.int16), affine)
+
+
+def make_data(out_dir: str, n_subjects: int, size: int, voxel_size: float) -> None:
+    """
+    Writes n_subjects synthetic T1 images of size^3 voxels to out_dir
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(n_subjects):
+        nii = make_t1((size, size, size), voxel_size, seed=i)
+        nii.to_filename(os.path.join(out_dir, f"sub{i:03d}_T1.nii.gz"))
+
+
+def measure(cmd: list) -> None:
+    """
+    Runs a command and prints its wall time and the peak RSS of its processes as
+    json (used in a separate process for each configuration, so that the peak RSS
+    of one configuration does not include the others)
+    """
+    t0 = time.perf_counter()
+    ret = subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode
+    wall_time = time.perf_counter() - t0
+    # ru_maxrss is in KB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(
+        json.dumps({"returncode": ret, "wall_time": wall_time, "peak_rss_mb": max_rss})
+    )
+
+
+def run_config(in_dir: str, out_dir: str, config: str) -> dict:
+    """
+    Runs the pipeline on in_dir with the given extra command line options. The
+    result has the measures of the run, the number of subjects in the output csv
+    and the time of each stage (from the timing report of the pipeline)
+    """
+    env = dict(os.environ)
+    env["PATH"] = STUBS_DIR + os.pathsep + env["PATH"]
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    timing_file = out_dir + "_timing.json"
+    pipeline = [sys.executable, "-m", "NiChart_DLMUSE", "-i", in_dir, "-o", out_dir]
+    pipeline += ["-d", "cpu", "--timing_report", timing_file] + shlex.split(config)
+
+    cmd = [sys.executable, os.path.abspath(__file__), "--measure", "--"] + pipeline
+    # Run next to the output folder, so that pipeline.log is not written to the CWD
+    out = subprocess.run(
+        cmd, env=env, cwd=os.path.dirname(out_dir), capture_output=True, text=True
+    )
+    res = json.loads(out.stdout.strip().splitlines()[-1])
+
+    out_csv = os.path.join(out_dir, "DLMUSE_Volumes.csv")
+    res["n_done"] = 0
+    if os.path.exists(out_csv):
+        with open(out_csv) as f:
+            res["n_done"] = sum(1 for _ in f) - 1
+    res["stages"] = []
+    if os.path.exists(timing_file):
+        with open(timing_file) as f:
+            res["stages"] = json.load(f)["summary"]
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="NiChart_DLMUSE throughput benchmark")
+    parser.add_argument(
+        "-n", "--n_subjects", type=int, default=4, help="Number of synthetic subjects"
+    )
+    parser.add_argument(
+        "--size", type=int, default=256, help="Image size in voxels (size^3)"
+    )
+    parser.add_argument(
+        "--voxel_size",
+        type=float,
+        nargs="+",
+        default=[1.0, 0.8],
+        help="Voxel sizes (mm) of the synthetic images; one dataset for each",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        nargs="+",
+        default=["", "--cores 4"],
+        help="NiChart_DLMUSE options of each benchmarked configuration",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Folder for the data and outputs (default: a temporary folder)",
+    )
+    parser.add_argument(
+        "-o", "--out_file", type=str, default=None, help="Report file (json)"
+    )
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("cmd", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="dlmuse_bench_")
+    results = []
+    for voxel_size in args.voxel_size:
+        in_dir = os.path.join(work_dir, f"data_{args.size}_{voxel_size}mm")
+        if not os.path.exists(in_dir):
+            print(
+                f"Generating {args.n_subjects} images ({args.size}^3, {voxel_size}mm)"
+            )
+            make_data(in_dir, args.n_subjects, args.size, voxel_size)
+
+        for i, config in enumerate(args.config):
+            out_dir = os.path.join(work_dir, f"out_{args.size}_{voxel_size}mm_{i}")
+            if os.path.exists(out_dir):
+                shutil.rmtree(out_dir)
+            res = run_config(in_dir, out_dir, config)
+            res.update(
+                {
+                    "config": config,
+                    "voxel_size": voxel_size,
+                    "size": args.size,
+                    "n_subjects": args.n_subjects,
+                    "subjects_per_hour": args.n_subjects * 3600 / res["wall_time"],
+                }
+            )
+            results.append(res)
+            print(
+                f"{voxel_size}mm [{config}]: {res['wall_time']:.1f}s, "
+                f"{res['subjects_per_hour']:.0f} subjects/hour, "
+                f"peak RSS {res['peak_rss_mb']:.0f} MB"
+            )
+            if res["returncode"] != 0 or res["n_done"] != args.n_subjects:
+                print(
+                    f"  WARNING: {res['n_done']} of {args.n_subjects} subjects done"
+                    f" (return code {res['returncode']})"
+                )
+
+    if args.out_file is not None:
+        with open(args.out_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,18 @@ setup(
         "argparse",
         "pathlib",
     ],
-    entry_points={"console_scripts": ["NiChart_DLMUSE = NiChart_DLMUSE.__main__:main"]},
+    # Optional dependencies of the binary formats of the roi volumes (--out_format)
+    extras_require={
+        "parquet": ["pyarrow"],
+        "feather": ["pyarrow"],
+        "hdf5": ["tables"],
+    },
+    entry_points={
+        "console_scripts": [
+            "NiChart_DLMUSE = NiChart_DLMUSE.__main__:main",
+            "NiChart_DLMUSE_volumes = NiChart_DLMUSE.volumes:main",
+        ]
+    },
     classifiers=[
         "Intended Audience :: Science/Research",
         "Programming Language :: Python",
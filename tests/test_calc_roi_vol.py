@@ -0,0 +1,119 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from NiChart_DLMUSE.CalcROIVol import (
+    ROITable,
+    calc_derived_rois,
+    calc_roi_volumes,
+    count_labels,
+    create_roi_csv,
+    get_label_counts,
+    get_roi_volumes,
+    get_single_roi_indices,
+)
+from NiChart_DLMUSE.dlmuse_pipeline import DICT_MUSE_DERIVED, DICT_MUSE_SINGLE
+
+
+def testing_count_labels() -> None:
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 200, (20, 30, 10))
+    correct_cnt = np.zeros(img.max() + 1, dtype=int)
+    u_ind, u_cnt = np.unique(img, return_counts=True)
+    correct_cnt[u_ind] = u_cnt
+
+    for dtype in [np.uint8, np.int16, np.int64, np.uint64, np.float64]:
+        img_typed = np.asfortranarray(img.astype(dtype))
+        assert np.array_equal(count_labels(img_typed, chunk_size=1000), correct_cnt)
+
+    # Negative values are ignored
+    img_neg = img.astype(np.int16)
+    img_neg[0, 0, :] = -5
+    assert count_labels(img_neg).sum() == img.size - 10
+
+
+def testing_calc_roi_volumes() -> None:
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 50, (20, 30, 10)).astype(np.uint8)
+    affine = np.diag([0.5, 1.0, 2.0, 1.0])
+    nii = nib.Nifti1Image(img, affine)
+
+    df = calc_roi_volumes("sub1", nii, [1, 4, 60])
+    assert list(df.columns) == ["MRID", "1", "4", "60"]
+    assert df["1"][0] == (img == 1).sum()
+    assert df["4"][0] == (img == 4).sum()
+    assert df["60"][0] == 0
+
+    # Without label indices, all labels in the image (except 0) are used
+    df = calc_roi_volumes("sub1", nii, [])
+    assert df.shape[1] == 50
+
+
+def testing_calc_derived_rois(tmp_path: str) -> None:
+    roi_map = os.path.join(tmp_path, "derived.csv")
+    with open(roi_map, "w") as f:
+        f.write("701,All,4,11,52\n")
+        f.write("4,Single,4\n")
+        f.write("600,Twice,11,11\n")
+
+    df_single = pd.DataFrame(
+        {"MRID": ["s1", "s2"], "4": [1.5, 2.0], "11": [3.0, 0.0], "52": [0.5, 7.0]}
+    )
+    df = calc_derived_rois(df_single, roi_map)
+    assert list(df.columns) == ["MRID", "701", "4", "600"]
+    assert list(df.MRID) == ["s1", "s2"]
+    assert np.allclose(df["701"], [5.0, 9.0])
+    assert np.allclose(df["4"], [1.5, 2.0])
+    assert np.allclose(df["600"], [6.0, 0.0])
+
+    # Single rois missing in the input table
+    with pytest.raises(KeyError):
+        calc_derived_rois(df_single.drop(columns="52"), roi_map)
+
+
+def testing_roi_table(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    labels = np.array((0,) + get_single_roi_indices(DICT_MUSE_SINGLE))
+    df_img = pd.DataFrame(
+        {"MRID": ["s1", "s2", "s3"], "img_prefix": ["s1_T1", "s2_T1", "s3_T1"]}
+    )
+    table = ROITable(df_img, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED)
+
+    # Subjects are added in any order; rows follow the order of df_img
+    dfs = {}
+    for mrid in ["s3", "s1"]:
+        img = labels[rng.integers(0, len(labels), (20, 20, 20))].astype(np.uint8)
+        nii = nib.Nifti1Image(img, np.diag([0.8, 0.8, 1.2, 1.0]))
+        out_csv = os.path.join(tmp_path, mrid + ".csv")
+        counts, vox_size = create_roi_csv(
+            mrid, nii, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED, out_csv
+        )
+        assert np.array_equal(counts, get_label_counts(nii)[0])
+        table.add(mrid + "_T1", counts, vox_size)
+        dfs[mrid] = pd.read_csv(out_csv, dtype={"MRID": str})
+
+    assert "s1_T1" in table and "s2_T1" not in table
+    assert table.missing() == ["s2_T1"]
+
+    out_csv = os.path.join(tmp_path, "DLMUSE_Volumes.csv")
+    table.write_csv(out_csv)
+    df = pd.read_csv(out_csv, dtype={"MRID": str})
+    df_subj = pd.concat([dfs["s1"], dfs["s3"]]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, df_subj)
+
+    # The volumes are re-derived from the saved label histograms
+    counts_file = os.path.join(tmp_path, "DLMUSE_LabelCounts.npz")
+    table.write_label_counts(counts_file)
+    table_counts = ROITable.from_label_counts(
+        counts_file, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED
+    )
+    assert table_counts.mrids == ["s1", "s3"]
+    pd.testing.assert_frame_equal(table_counts.to_dataframe(), table.to_dataframe())
+
+    df_single = table_counts.single_dataframe()
+    label_indices, vols = get_roi_volumes(nii, get_single_roi_indices(DICT_MUSE_SINGLE))
+    assert list(df_single.columns[1:]) == list(label_indices.astype(str))
+    assert np.array_equal(df_single.iloc[0, 1:].to_numpy(dtype=float), vols)
@@ -0,0 +1,75 @@
+import os
+import shutil
+
+import pytest
+
+from NiChart_DLMUSE import ledger as ledger_module
+from NiChart_DLMUSE.ledger import STAGES, RunLedger
+from NiChart_DLMUSE.utils import make_img_list
+
+
+def testing_run_ledger() -> None:
+    if os.path.exists("test_ledger"):
+        shutil.rmtree("test_ledger")
+    os.mkdir("test_ledger")
+    for i in range(3):
+        with open(f"test_ledger/IXI10{i}_T1.nii.gz", "w") as f:
+            f.write(f"image {i}")
+    ledger_file = "test_ledger/ledger.jsonl"
+
+    df_img = make_img_list("test_ledger")
+    ledger = RunLedger(ledger_file)
+    assert len(ledger.start(df_img)) == 3
+
+    # Complete one subject, and one stage of a second subject
+    for stage in STAGES:
+        ledger.mark_done("IXI100_T1", stage)
+    ledger.mark_done("IXI101_T1", "reorient")
+    ledger.compact()
+
+    # Resume: the completed subject is skipped, the other keeps its done stages
+    ledger = RunLedger(ledger_file)
+    df_todo = ledger.start(df_img)
+    assert sorted(df_todo["img_prefix"]) == ["IXI101_T1", "IXI102_T1"]
+    assert ledger.is_done("IXI101_T1", "reorient")
+    assert len(ledger.pending(df_todo, "reorient")) == 1
+
+    # A changed input is processed again from the first stage
+    with open("test_ledger/IXI100_T1.nii.gz", "w") as f:
+        f.write("new image content")
+    ledger = RunLedger(ledger_file)
+    df_todo = ledger.start(df_img)
+    assert "IXI100_T1" in list(df_todo["img_prefix"])
+    assert not ledger.is_done("IXI100_T1", "reorient")
+
+    # Without resume all subjects are processed
+    ledger = RunLedger(ledger_file)
+    assert len(ledger.start(df_img, resume=False)) == 3
+
+    shutil.rmtree("test_ledger")
+
+
+def testing_ledger_hash_on_resume(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    for i in range(2):
+        with open(os.path.join(tmp_path, f"IXI10{i}_T1.nii.gz"), "w") as f:
+            f.write(f"image {i}")
+    ledger_file = os.path.join(tmp_path, "ledger.jsonl")
+    df_img = make_img_list(str(tmp_path))
+
+    # A run that is not resumed does not read the inputs
+    def no_hash(in_file: str) -> str:
+        raise AssertionError(f"hashed {in_file}")
+
+    monkeypatch.setattr(ledger_module, "hash_file", no_hash)
+    ledger = RunLedger(ledger_file)
+    assert len(ledger.start(df_img, resume=False)) == 2
+    for stage in STAGES:
+        ledger.mark_done("IXI100_T1", stage)
+    monkeypatch.undo()
+
+    # The resumed run checks the unchanged inputs and stores their hash
+    ledger = RunLedger(ledger_file)
+    assert list(ledger.start(df_img).img_prefix) == ["IXI101_T1"]
+    assert ledger.records["IXI101_T1"]["input_hash"] is not None
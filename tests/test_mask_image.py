@@ -0,0 +1,164 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from NiChart_DLMUSE.CalcROIVol import get_label_counts
+from NiChart_DLMUSE.MaskImage import (
+    calc_bbox_with_padding,
+    combine_masks,
+    keep_largest_component,
+    largest_component_bbox,
+    mask_img,
+    read_crop_box,
+    refine_mask,
+)
+from NiChart_DLMUSE.RelabelROI import relabel_rois
+
+
+def _icv_mask() -> np.ndarray:
+    ind = np.indices((40, 50, 30))
+    r = ((ind[0] - 20) / 12) ** 2 + ((ind[1] - 22) / 15) ** 2 + ((ind[2] - 15) / 9) ** 2
+    return (r < 1).astype(np.uint8)
+
+
+def testing_combine_masks() -> None:
+    rng = np.random.default_rng(0)
+    icv = _icv_mask()
+    bcoors = calc_bbox_with_padding(icv)
+    box = tuple(slice(b[0], b[1]) for b in bcoors)
+
+    shape = [b[1] - b[0] for b in bcoors]
+    muse = rng.integers(0, 5, shape).astype(np.uint8) * 50
+    nii_muse = nib.Nifti1Image(muse, np.eye(4))
+    nii_muse.set_data_dtype(np.uint8)
+    nii_out = combine_masks(nii_muse, nib.Nifti1Image(icv, np.eye(4)), None)
+
+    # Reference: MUSE labels padded to the full size, label 1 in the rest of ICV
+    img_ref = np.zeros(icv.shape)
+    img_ref[box] = muse
+    img_ref[(img_ref == 0) & (icv > 0)] = 1
+
+    img_out = np.asanyarray(nii_out.dataobj)
+    assert img_out.dtype == np.uint8
+    assert np.array_equal(img_out, img_ref)
+
+
+def testing_relabel_rois(tmp_path: str) -> None:
+    roi_map = str(tmp_path / "map.csv")
+    with open(roi_map, "w") as f:
+        f.write("IndexConsecutive,IndexMUSE\n0,0\n1,4\n2,11\n3,207\n")
+
+    img = np.array([[[0, 1, 2, 3]]], dtype=np.int16)
+    for dtype in [np.uint8, np.int16, np.float32]:
+        nii = nib.Nifti1Image(img.astype(dtype), np.eye(4))
+        nii_out = relabel_rois(nii, roi_map, "IndexConsecutive", "IndexMUSE", None)
+        out = np.asanyarray(nii_out.dataobj)
+        assert out.dtype == np.uint8
+        assert out.ravel().tolist() == [0, 4, 11, 207]
+
+
+def testing_crop_box(tmp_path: str) -> None:
+    icv = _icv_mask()
+    nii_icv = nib.Nifti1Image(icv, np.eye(4))
+    nii_t1 = nib.Nifti1Image(icv * 100.0, np.eye(4))
+    crop_json = os.path.join(tmp_path, "s1_crop.json")
+
+    # The crop box of the masking step is saved and used to pad the MUSE labels
+    nii_crop = mask_img(nii_t1, nii_icv, None, crop_json=crop_json)
+    bcoors = read_crop_box(crop_json, icv.shape)
+    assert np.array_equal(bcoors, calc_bbox_with_padding(icv))
+    assert read_crop_box(crop_json, (10, 10, 10)) is None
+
+    muse = (np.asanyarray(nii_crop.dataobj) > 0).astype(np.uint8) * 4
+    nii_muse = nib.Nifti1Image(muse, np.eye(4))
+    nii_muse.set_data_dtype(np.uint8)
+    out_crop = combine_masks(nii_muse, nii_icv, None, crop_json=crop_json)
+    out_calc = combine_masks(nii_muse, nii_icv, None)
+    assert np.array_equal(out_crop.dataobj, out_calc.dataobj)
+
+
+def testing_largest_component(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    icv = _icv_mask()
+    img = icv.copy()
+    img[rng.random(img.shape) < 0.01] = 1
+    img[0, 0, 0:3] = 1
+
+    # Reference: component with the largest size, from a mask of each component
+    labeled, ncomp = ndimage.label(img)
+    sizes = [np.sum(labeled == i) for i in range(1, ncomp + 1)]
+    img_ref = (labeled == np.argmax(sizes) + 1).astype(np.uint8)
+    box_ref = ndimage.find_objects(img_ref)[0]
+
+    for downsample in [1, 4]:
+        assert np.array_equal(keep_largest_component(img, downsample), img_ref)
+        assert largest_component_bbox(img, downsample) == box_ref
+    assert largest_component_bbox(np.zeros((4, 4, 4)), 2) is None
+
+    in_mask = os.path.join(tmp_path, "s1_DLICV.nii.gz")
+    nib.Nifti1Image(img.astype(np.float32), np.eye(4)).to_filename(in_mask)
+    refine_mask(in_mask, in_mask)
+    nii_out = nib.load(in_mask)
+    assert nii_out.get_data_dtype() == np.uint8
+    assert np.array_equal(np.asanyarray(nii_out.dataobj), img_ref)
+
+
+def testing_slab_processing(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    ind = np.indices((128, 128, 40))
+    r = (
+        ((ind[0] - 60) / 40) ** 2
+        + ((ind[1] - 64) / 50) ** 2
+        + ((ind[2] - 20) / 15) ** 2
+    )
+    icv = (r < 1).astype(np.uint8)
+    nii_icv = nib.Nifti1Image(icv, np.eye(4))
+    t1 = rng.integers(1, 1000, icv.shape).astype(np.int16)
+    nii_t1 = nib.Nifti1Image(t1, np.eye(4))
+    roi_map = os.path.join(tmp_path, "map.csv")
+    with open(roi_map, "w") as f:
+        f.write("IndexConsecutive,IndexMUSE\n0,0\n1,4\n2,11\n3,207\n")
+
+    # Each step gives the same image with slabs of a few slices (1 MB)
+    out_img = {}
+    for mode in ["full", "slab"]:
+        slab_memory = 1 if mode == "slab" else None
+        out_img[mode] = [os.path.join(tmp_path, f"{mode}_{i}.nii.gz") for i in range(3)]
+        crop_json = os.path.join(tmp_path, f"{mode}_crop.json")
+        mask_img(nii_t1, nii_icv, out_img[mode][0], None, crop_json, slab_memory)
+        muse = np.asanyarray(nib.load(out_img[mode][0]).dataobj) % 4
+        nii = nib.Nifti1Image(muse, np.eye(4))
+        nii = relabel_rois(
+            nii,
+            roi_map,
+            "IndexConsecutive",
+            "IndexMUSE",
+            out_img[mode][1],
+            None,
+            slab_memory,
+        )
+        combine_masks(nii, nii_icv, out_img[mode][2], None, crop_json, slab_memory)
+
+    for f_full, f_slab in zip(out_img["full"], out_img["slab"]):
+        nii_full = nib.load(f_full)
+        nii_slab = nib.load(f_slab)
+        assert nii_slab.get_data_dtype() == nii_full.get_data_dtype()
+        assert np.array_equal(np.asanyarray(nii_slab.dataobj), nii_full.dataobj)
+
+    counts = get_label_counts(out_img["full"][2])
+    counts_slab = get_label_counts(out_img["full"][2], slab_memory=1)
+    assert np.array_equal(counts[0], counts_slab[0])
+
+    # Scaled integer images are masked to the same float32 image
+    in_img = os.path.join(tmp_path, "scaled.nii.gz")
+    nii_scaled = nib.Nifti1Image(t1, np.eye(4))
+    nii_scaled.header.set_slope_inter(0.37, 0)
+    nii_scaled.to_filename(in_img)
+    mask_img(in_img, nii_icv, out_img["full"][0], None, None, None)
+    mask_img(in_img, nii_icv, out_img["slab"][0], None, None, 1)
+    nii_full = nib.load(out_img["full"][0])
+    nii_slab = nib.load(out_img["slab"][0])
+    assert nii_full.get_data_dtype() == nii_slab.get_data_dtype() == np.float32
+    assert np.array_equal(nii_full.get_fdata(), nii_slab.get_fdata())
@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import nibabel as nib
+import numpy as np
+
+from NiChart_DLMUSE.nifti_io import (
+    SlabWriter,
+    get_img_data,
+    get_label_data,
+    get_slabs,
+    load_nii,
+    make_nii,
+    save_nii,
+)
+
+
+def testing_save_nii() -> None:
+    if os.path.exists("test_nifti_io"):
+        shutil.rmtree("test_nifti_io")
+    os.mkdir("test_nifti_io")
+
+    img = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    nii = nib.Nifti1Image(img, np.eye(4))
+    for fname, level in [("a.nii.gz", None), ("b.nii.gz", 0), ("c.nii", 0)]:
+        out_file = os.path.join("test_nifti_io", fname)
+        save_nii(nii, out_file, level)
+        nii_out = load_nii(out_file)
+        assert np.array_equal(np.asanyarray(nii_out.dataobj), img)
+        assert nii_out.get_data_dtype() == np.int16
+
+    # An image in memory is returned as is
+    assert load_nii(nii) is nii
+
+    shutil.rmtree("test_nifti_io")
+
+
+def testing_img_data(tmp_path: str) -> None:
+    img = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    nii = nib.Nifti1Image(img, np.eye(4))
+    out_file = os.path.join(tmp_path, "a.nii.gz")
+
+    # Unscaled integers are read in the stored type, scaled data as float32
+    nii.to_filename(out_file)
+    assert get_img_data(load_nii(out_file)).dtype == np.int16
+    nii.header.set_slope_inter(0.5, 0)
+    nii.to_filename(out_file)
+    img_out = get_img_data(load_nii(out_file))
+    assert img_out.dtype == np.float32
+    assert np.allclose(img_out, img * 0.5)
+
+    # Labels are returned in the smallest type
+    nii_lab = nib.Nifti1Image(img.astype(np.float64) * 10, np.eye(4))
+    assert get_label_data(nii_lab).dtype == np.uint8
+    assert (
+        get_label_data(nib.Nifti1Image(img.astype(np.int32) * 20, np.eye(4))).dtype
+        == np.uint16
+    )
+    assert get_label_data(nib.Nifti1Image(img - 1, np.eye(4))).dtype == np.int16
+
+    # The new image is stored in the type of its data, without the reference scaling
+    nii_out = make_nii(get_label_data(nii_lab), load_nii(out_file))
+    assert nii_out.get_data_dtype() == np.uint8
+    assert nii_out.header.get_slope_inter() == (None, None)
+
+
+def testing_slab_writer(tmp_path: str) -> None:
+    img = np.arange(20 * 30 * 25, dtype=np.int16).reshape(20, 30, 25)
+    nii = nib.Nifti1Image(img, np.diag([2.0, 2.0, 1.5, 1.0]))
+
+    # 4 slices per slab
+    slabs = get_slabs(img.shape, 2**20 / (20 * 30 * 4), 1)
+    assert len(slabs) == 7
+    assert len(get_slabs(img.shape, 2, None)) == 1
+
+    for fname in ["a.nii.gz", "b.nii"]:
+        out_file = os.path.join(tmp_path, fname)
+        with SlabWriter(out_file, nii, img.shape, np.int16, 1) as writer:
+            for slicer in slabs:
+                writer.write(get_img_data(nii, slicer=slicer))
+        nii_out = load_nii(out_file, keep_file_open=True)
+        assert nii_out.get_data_dtype() == np.int16
+        assert np.array_equal(nii_out.affine, nii.affine)
+        assert np.array_equal(get_img_data(nii_out, slicer=slabs[2]), img[..., 8:12])
+        assert np.array_equal(np.asanyarray(nii_out.dataobj), img)
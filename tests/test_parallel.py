@@ -0,0 +1,38 @@
+import pytest
+
+from NiChart_DLMUSE.parallel import run_tasks
+
+
+def testing_run_tasks() -> None:
+    tasks = [(i, 2) for i in range(10)]
+    correct_res = [i**2 for i in range(10)]
+
+    assert run_tasks(pow, tasks, 1) == correct_res
+    assert run_tasks(pow, tasks, 3) == correct_res
+    assert run_tasks(pow, [], 3) == []
+
+
+def check_positive(x: int) -> int:
+    if x < 0:
+        raise ValueError("negative value")
+    return x
+
+
+def testing_run_tasks_failed() -> None:
+    tasks = [(1,), (-2,), (3,)]
+
+    for workers in [1, 2]:
+        failed: list = []
+        out = run_tasks(
+            check_positive, tasks, workers, subjects=["a", "b", "c"], failed=failed
+        )
+        assert out == [1, None, 3]
+        assert failed == ["b"]
+
+    failed = []
+    assert run_tasks(check_positive, tasks, 1, failed=failed) == [1, None, 3]
+    assert failed == [1]
+
+    # Without a list of failed tasks, the error is raised
+    with pytest.raises(ValueError):
+        run_tasks(check_positive, tasks, 2)
@@ -0,0 +1,92 @@
+import inspect
+import os
+from types import SimpleNamespace
+from typing import Any
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from NiChart_DLMUSE import dlmuse_pipeline
+from NiChart_DLMUSE.dlmuse_pipeline import (
+    PostProcessTask,
+    _post_process_args,
+    post_process_img,
+)
+from NiChart_DLMUSE.ledger import LEDGER_FILE, RunLedger
+
+
+def testing_post_process_task(tmp_path: str) -> None:
+    # The task is passed positionally to post_process_img by run_tasks
+    params = list(inspect.signature(post_process_img).parameters)
+    assert list(PostProcessTask._fields) == params
+
+    row = SimpleNamespace(MRID="s1", img_prefix="s1_T1", img_path="/in/s1_T1.nii.gz")
+    task = _post_process_args(row, str(tmp_path), "/out", False, subject_csv=False)
+    assert task.ref_img in task.in_files
+    assert task.crop_json in task.in_files and task.orient_json in task.in_files
+    assert task.out_files == ["/out/s1_T1_DLMUSE.nii.gz", None, None, None]
+
+
+def _fake_segmentation(
+    in_dir: str,
+    in_suff: str,
+    out_dir: str,
+    out_suff: str,
+    device: str,
+    extra_args: str = "",
+    backend: str = "subprocess",
+    skip: str = "",
+) -> None:
+    # Writes the voxels above a threshold as label 1, except for the skipped subject
+    os.makedirs(out_dir, exist_ok=True)
+    for fname in os.listdir(in_dir):
+        prefix = fname.replace(in_suff, "")
+        if prefix != skip:
+            nii = nib.load(os.path.join(in_dir, fname))
+            mask = (np.asanyarray(nii.dataobj) > 0).astype(np.uint8)
+            out_img = os.path.join(out_dir, prefix + out_suff)
+            nib.save(nib.Nifti1Image(mask, nii.affine), out_img)
+
+
+def testing_batch_missing_segmentation(tmp_path: Any, monkeypatch: Any) -> None:
+    in_dir = tmp_path / "in"
+    out_dir = tmp_path / "out"
+    in_dir.mkdir()
+    img = np.zeros((8, 8, 8), dtype=np.int16)
+    img[2:6, 2:6, 2:6] = 500
+    for mrid in ["sub001", "sub002", "sub003"]:
+        nib.save(nib.Nifti1Image(img, np.eye(4)), in_dir / f"{mrid}_T1.nii.gz")
+
+    # DLICV does not write the mask of sub001
+    def run_dlicv(*args: Any) -> None:
+        _fake_segmentation(*args, skip="sub001_T1")
+
+    monkeypatch.setattr(dlmuse_pipeline, "run_dlicv", run_dlicv)
+    monkeypatch.setattr(dlmuse_pipeline, "run_dlmuse", _fake_segmentation)
+    dlmuse_pipeline.run_pipeline(str(in_dir), str(out_dir), "cpu", workers=2)
+
+    # The other subjects complete, and sub001 is recorded as failed
+    for mrid in ["sub002", "sub003"]:
+        assert os.path.exists(out_dir / f"{mrid}_T1_DLMUSE.nii.gz")
+    assert not os.path.exists(out_dir / "sub001_T1_DLMUSE.nii.gz")
+    df = pd.read_csv(out_dir / "DLMUSE_Volumes.csv", dtype={"MRID": str})
+    assert sorted(df.MRID) == ["sub002", "sub003"]
+    ledger = RunLedger(str(out_dir / LEDGER_FILE))
+    assert ledger.is_failed("sub001_T1")
+    assert ledger.records["sub001_T1"]["stages"] == ["reorient"]
+    assert ledger.records["sub002_T1"]["status"] == "done"
+
+    # A removed intermediate fails the subject in a resumed run, and the stage that
+    # writes it is repeated by the next one
+    os.remove(out_dir / "temp_working_dir" / "s1_reorient_lps" / "sub001_T1_LPS.nii.gz")
+    monkeypatch.setattr(dlmuse_pipeline, "run_dlicv", _fake_segmentation)
+    dlmuse_pipeline.run_pipeline(str(in_dir), str(out_dir), "cpu", resume=True)
+    ledger = RunLedger(str(out_dir / LEDGER_FILE))
+    assert ledger.is_failed("sub001_T1")
+    assert ledger.records["sub001_T1"]["stages"] == []
+
+    dlmuse_pipeline.run_pipeline(str(in_dir), str(out_dir), "cpu", resume=True)
+    assert os.path.exists(out_dir / "sub001_T1_DLMUSE.nii.gz")
+    ledger = RunLedger(str(out_dir / LEDGER_FILE))
+    assert ledger.records["sub001_T1"]["status"] == "done"
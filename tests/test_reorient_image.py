@@ -0,0 +1,41 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from nibabel.orientations import axcodes2ornt, ornt_transform
+
+from NiChart_DLMUSE.ReorientImage import (
+    get_orientation,
+    invert_transform,
+    reorient_img,
+    reorient_to_init,
+)
+
+
+def testing_reorient_to_init(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 100, (6, 7, 8)).astype(np.int16)
+    for axcodes in ["RAS", "LPS", "PSL", "IRA"]:
+        ornt = ornt_transform(axcodes2ornt("RAS"), axcodes2ornt(axcodes))
+        nii_in = nib.Nifti1Image(img, np.eye(4)).as_reoriented(ornt)
+        in_img = os.path.join(tmp_path, f"{axcodes}_T1.nii.gz")
+        nii_in.to_filename(in_img)
+        assert get_orientation(in_img) == axcodes
+
+        # The saved transform is inverted to go back to the initial image
+        out_img = os.path.join(tmp_path, f"{axcodes}_LPS.nii.gz")
+        orient_json = os.path.join(tmp_path, f"{axcodes}_orient.json")
+        nii_lps = reorient_img(in_img, "LPS", out_img, None, orient_json, True)
+        assert get_orientation(out_img) == "LPS"
+        assert os.path.islink(out_img) == (axcodes == "LPS")
+        assert np.array_equal(
+            invert_transform(
+                ornt_transform(axcodes2ornt(axcodes), axcodes2ornt("LPS"))
+            ),
+            ornt_transform(axcodes2ornt("LPS"), axcodes2ornt(axcodes)),
+        )
+
+        nii_out = reorient_to_init(nii_lps, in_img, None, orient_json)
+        nii_ref = reorient_img(nii_lps, in_img, None)
+        assert np.array_equal(nii_out.dataobj, nii_in.dataobj)
+        assert np.allclose(nii_out.affine, nii_ref.affine)
@@ -0,0 +1,80 @@
+import os
+import sys
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from NiChart_DLMUSE.results_io import (
+    check_out_format,
+    read_volume_ids,
+    read_volumes,
+    write_volumes,
+)
+
+
+def _volumes(mrids: list, value: float) -> pd.DataFrame:
+    df = pd.DataFrame({"MRID": mrids})
+    for roi in ["702", "4", "11"]:
+        df[roi] = value + np.arange(len(mrids))
+    return df
+
+
+@pytest.mark.parametrize(
+    "ext,module",
+    [
+        (".csv", None),
+        (".parquet", "pyarrow"),
+        (".feather", "pyarrow"),
+        (".h5", "tables"),
+    ],
+)
+def testing_write_volumes(tmp_path: str, ext: str, module: str) -> None:
+    if module is not None:
+        pytest.importorskip(module)
+    out_file = os.path.join(tmp_path, "DLMUSE_Volumes" + ext)
+
+    write_volumes(_volumes(["001", "s2"], 1000.5), out_file)
+    df = read_volumes(out_file)
+    assert list(df.columns) == ["MRID", "702", "4", "11"]
+    assert list(df.MRID) == ["001", "s2"]
+    assert np.allclose(df["4"], [1000.5, 1001.5])
+    if ext != ".csv":
+        assert df["4"].dtype == np.float32
+
+    # Without append, the file is replaced
+    write_volumes(_volumes(["s1"], 1.0), out_file)
+    assert list(read_volumes(out_file).MRID) == ["s1"]
+    if ext == ".csv":
+        return
+
+    # New subjects are appended; stored subjects only if they were updated
+    write_volumes(_volumes(["s1", "s3", "s4"], 5.0), out_file, True, ["s4"])
+    assert read_volume_ids(out_file) == ["s1", "s3", "s4"]
+    write_volumes(_volumes(["s1", "s3"], 9.0), out_file, True, ["s1"])
+    df = read_volumes(out_file)
+    assert list(df.MRID) == ["s3", "s4", "s1"]
+    assert np.allclose(df["4"], [6.0, 7.0, 9.0])
+
+    # The updated subject is stored once: its old partition (or rows) is removed
+    if ext == ".parquet":
+        df = pd.read_parquet(out_file)
+    elif ext == ".feather":
+        df = pd.concat([pd.read_feather(x) for x in sorted(glob(out_file + "/*"))])
+    else:
+        df = pd.read_hdf(out_file)
+    assert sorted(df.MRID) == ["s1", "s3", "s4"]
+    if ext != ".h5":
+        assert len(os.listdir(out_file)) == 2
+
+
+def testing_check_out_format(monkeypatch: pytest.MonkeyPatch) -> None:
+    check_out_format("csv")
+    with pytest.raises(ValueError):
+        check_out_format("xlsx")
+
+    # A missing optional dependency is reported with the extra to install
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(ImportError, match=r"NiChart_DLMUSE\[parquet\]"):
+        check_out_format("parquet")
@@ -0,0 +1,77 @@
+import os
+import shutil
+import threading
+import time
+
+import nibabel as nib
+import numpy as np
+
+from NiChart_DLMUSE.scheduler import (
+    MemoryBudget,
+    estimate_memory,
+    estimate_subject_memory,
+    get_voxel_count,
+    sort_largest_first,
+)
+from NiChart_DLMUSE.utils import make_img_list
+
+
+def testing_sort_largest_first() -> None:
+    if os.path.exists("test_scheduler"):
+        shutil.rmtree("test_scheduler")
+    os.mkdir("test_scheduler")
+
+    sizes = {"IXI100": 4, "IXI101": 8, "IXI102": 6}
+    for mrid, size in sizes.items():
+        img = np.zeros([size, size, size], dtype=np.uint8)
+        nib.save(nib.Nifti1Image(img, np.eye(4)), f"test_scheduler/{mrid}_T1.nii.gz")
+
+    assert get_voxel_count("test_scheduler/IXI101_T1.nii.gz") == 512
+
+    df_img = make_img_list("test_scheduler")
+    df_sorted = sort_largest_first(df_img)
+
+    assert list(df_sorted["MRID"]) == ["IXI101", "IXI102", "IXI100"]
+    assert list(df_sorted.sort_index()["MRID"]) == list(df_img["MRID"])
+
+    shutil.rmtree("test_scheduler")
+
+
+def testing_estimate_memory(tmp_path: str) -> None:
+    in_img = os.path.join(tmp_path, "s1_T1.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((10, 10, 10), np.int16), np.eye(4)), in_img)
+
+    # int16 values: 2 bytes per voxel, read as stored
+    assert estimate_memory(in_img, "reorient") == 1000 * 4
+    assert estimate_memory(in_img, "mask") == 1000 * 10
+    assert estimate_memory(in_img, "mask", slab_memory=1) == 1000 * 6 + 2**20
+    assert estimate_subject_memory(in_img) == 1000 * (10 + 2)
+    assert estimate_memory(os.path.join(tmp_path, "none.nii.gz"), "mask") == 0
+
+
+def testing_memory_budget() -> None:
+    budget = MemoryBudget(100)
+    budget.acquire(60)
+    budget.acquire(40)
+
+    # The next subject waits until there is room for it
+    started = threading.Event()
+
+    def start(n_bytes: int) -> None:
+        budget.acquire(n_bytes)
+        started.set()
+
+    t = threading.Thread(target=start, args=(50,))
+    t.start()
+    time.sleep(0.1)
+    assert not started.is_set()
+    budget.release(60)
+    t.join(5)
+    assert started.is_set() and budget.used == 90
+
+    # A subject above the budget runs when nothing else is running
+    budget.release(40)
+    budget.release(50)
+    budget.acquire(500)
+    assert budget.used == 500
+    assert MemoryBudget(None).fits(10**12)
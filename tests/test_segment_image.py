@@ -0,0 +1,122 @@
+import os
+import sys
+from types import ModuleType, SimpleNamespace
+from typing import Any
+
+from NiChart_DLMUSE import SegmentImage
+from NiChart_DLMUSE.SegmentImage import run_dlicv, run_dlmuse
+
+
+class FakePredictor:
+    """
+    Stand-in for nnUNetPredictor: copies each input to its output file
+    """
+
+    created: list = []
+
+    def __init__(self, **kwargs: Any) -> None:
+        self.kwargs = kwargs
+        self.model_folder = None
+        FakePredictor.created.append(self)
+
+    def initialize_from_trained_model_folder(
+        self, model_folder: str, folds: list, checkpoint_name: str
+    ) -> None:
+        self.model_folder = model_folder
+
+    def predict_from_files(
+        self, in_files: list, out_trunc: list, **kwargs: Any
+    ) -> None:
+        # Record the deterministic setting used for the predictions
+        self.deterministic = sys.modules["torch"].deterministic
+        for (in_file,), out_file in zip(in_files, out_trunc):
+            with open(in_file) as f_in, open(out_file + ".nii.gz", "w") as f_out:
+                f_out.write(f_in.read())
+
+
+def _fake_torch() -> ModuleType:
+    torch = ModuleType("torch")
+    torch.deterministic = False  # type: ignore
+
+    def use_deterministic_algorithms(mode: bool) -> None:
+        torch.deterministic = mode  # type: ignore
+
+    torch.use_deterministic_algorithms = use_deterministic_algorithms  # type: ignore
+    torch.are_deterministic_algorithms_enabled = (  # type: ignore
+        lambda: torch.deterministic  # type: ignore
+    )
+    torch.set_num_threads = lambda n: None  # type: ignore
+    torch.device = lambda x: x  # type: ignore
+    return torch
+
+
+def testing_predict_inprocess(tmp_path: Any, monkeypatch: Any) -> None:
+    predict_module = ModuleType("nnunetv2.inference.predict_from_raw_data")
+    predict_module.nnUNetPredictor = FakePredictor  # type: ignore
+    monkeypatch.setitem(sys.modules, "torch", _fake_torch())
+    monkeypatch.setitem(sys.modules, "nnunetv2", ModuleType("nnunetv2"))
+    monkeypatch.setitem(sys.modules, "nnunetv2.inference", ModuleType("inference"))
+    monkeypatch.setitem(
+        sys.modules, "nnunetv2.inference.predict_from_raw_data", predict_module
+    )
+    monkeypatch.setattr(SegmentImage, "_PREDICTORS", {})
+    monkeypatch.setattr(FakePredictor, "created", [])
+
+    # The models are found in the package folders
+    models = [("DLICV", SegmentImage.MODEL_DLICV, "901")]
+    models.append(("DLMUSE", SegmentImage.MODEL_DLMUSE, "903"))
+    for model, model_dir, dataset in models:
+        pkg_dir = tmp_path / model
+        fake_pkg = SimpleNamespace(__file__=str(pkg_dir / "__init__.py"))
+        monkeypatch.setattr(SegmentImage, model, fake_pkg)
+        model_dir = model_dir % (dataset, dataset, "3d_fullres")
+        os.makedirs(pkg_dir / "nnunet_results" / model_dir)
+
+    in_dir = tmp_path / "in"
+    in_dir.mkdir()
+    for mrid in ["s1", "s2"]:
+        (in_dir / f"{mrid}_LPS.nii.gz").write_text(mrid)
+
+    # The predictor is built once for each model, device and arguments
+    out_dir = tmp_path / "out"
+    for _ in range(2):
+        run_dlmuse(
+            str(in_dir),
+            "_LPS.nii.gz",
+            str(out_dir),
+            "_DLMUSE.nii.gz",
+            "cpu",
+            "",
+            "inprocess",
+        )
+    assert len(FakePredictor.created) == 1
+    run_dlmuse(
+        str(in_dir),
+        "_LPS.nii.gz",
+        str(out_dir),
+        "_DLMUSE.nii.gz",
+        "cpu",
+        "-f 1",
+        "inprocess",
+    )
+    assert len(FakePredictor.created) == 2
+
+    # The outputs are written with their final names
+    assert sorted(os.listdir(out_dir)) == ["s1_DLMUSE.nii.gz", "s2_DLMUSE.nii.gz"]
+    assert (out_dir / "s2_DLMUSE.nii.gz").read_text() == "s2"
+
+    # DLICV runs with deterministic algorithms, and the setting is then restored
+    run_dlicv(
+        str(in_dir),
+        "_LPS.nii.gz",
+        str(out_dir),
+        "_DLICV.nii.gz",
+        "cpu",
+        "--post_processing false",
+        "inprocess",
+    )
+    assert len(FakePredictor.created) == 3
+    assert FakePredictor.created[-1].deterministic is True
+    assert FakePredictor.created[0].deterministic is False
+    assert sys.modules["torch"].deterministic is False  # type: ignore
+    assert os.path.exists(out_dir / "s1_DLICV.nii.gz")
@@ -0,0 +1,54 @@
+from NiChart_DLMUSE.streaming import Stage, run_stream
+
+
+def testing_run_stream() -> None:
+    def add_one(x: int) -> int:
+        return x + 1
+
+    def drop_odd(x: int) -> object:
+        return None if x % 2 else x
+
+    def double_batch(items: list) -> list:
+        assert len(items) <= 3
+        return [2 * x for x in items]
+
+    stages = [
+        Stage("add", add_one, workers=2),
+        Stage("drop", drop_odd),
+        Stage("double", double_batch, batch_size=3),
+    ]
+    done, failed = run_stream(range(10), stages, queue_size=2)
+
+    assert sorted(done) == [4, 8, 12, 16, 20]
+    assert failed == []
+
+
+def testing_run_stream_failed() -> None:
+    def check(x: int) -> int:
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    done, failed = run_stream(range(5), [Stage("check", check)])
+
+    assert sorted(done) == [0, 1, 2, 4]
+    assert failed == [3]
+
+
+def testing_run_stream_on_exit() -> None:
+    def check(x: int) -> object:
+        if x == 3:
+            raise ValueError("bad item")
+        return None if x == 5 else x
+
+    def keep_even(items: list) -> list:
+        return [x for x in items if x % 2 == 0]
+
+    # Each item leaves the pipeline once: failed, dropped or completed
+    exits = []
+    stages = [Stage("check", check, workers=2), Stage("even", keep_even, 1, 3)]
+    done, failed = run_stream(range(10), stages, 2, on_exit=exits.append)
+
+    assert sorted(done) == [0, 2, 4, 6, 8]
+    assert failed == [3]
+    assert sorted(exits) == list(range(10))
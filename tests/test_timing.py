@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from NiChart_DLMUSE.parallel import run_tasks
+from NiChart_DLMUSE.timing import RunTimer
+
+
+def copy_file(in_file: str, out_file: str) -> str:
+    shutil.copyfile(in_file, out_file)
+    return out_file
+
+
+def testing_run_timer() -> None:
+    if os.path.exists("test_timing"):
+        shutil.rmtree("test_timing")
+    os.mkdir("test_timing")
+    for i in range(3):
+        with open(f"test_timing/in_{i}.txt", "w") as f:
+            f.write("x" * 100)
+
+    timer = RunTimer()
+    tasks = [(f"test_timing/in_{i}.txt", f"test_timing/out_{i}.txt") for i in range(3)]
+    out = run_tasks(copy_file, tasks, 2, timer, "copy", ["s0", "s1", "s2"])
+    assert out == [x[1] for x in tasks]
+
+    with timer.measure("batch", "s0;s1", n_subjects=2):
+        pass
+
+    df = timer.to_dataframe()
+    assert len(df) == 4
+    df_copy = df[df.stage == "copy"]
+    assert sorted(df_copy.subject) == ["s0", "s1", "s2"]
+    assert (df_copy.bytes_read == 100).all()
+    assert (df_copy.bytes_written == 100).all()
+
+    df_sum = timer.summary()
+    assert list(df_sum.stage) == ["copy", "batch"]
+    assert list(df_sum.n_subjects) == [3, 2]
+
+    timer.write_report("test_timing/report.json", {"workers": 2})
+    with open("test_timing/report.json") as f:
+        report = json.load(f)
+    assert report["run"]["workers"] == 2
+    assert len(report["records"]) == 4
+
+    timer.write_report("test_timing/report.csv")
+    assert len(pd.read_csv("test_timing/report.csv")) == 4
+
+    shutil.rmtree("test_timing")
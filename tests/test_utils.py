@@ -1,13 +1,18 @@
 import os
 
+import nibabel as nib
+import numpy as np
 import pandas as pd
 
 from NiChart_DLMUSE.utils import (
     get_basename,
     get_bids_prefix,
+    index_bids,
     make_img_list,
+    merge_bids_output_data,
     remove_common_suffix,
     remove_subfolders,
+    scan_img_dir,
     split_data,
 )
 
@@ -30,6 +35,41 @@ def testing_remove_common_suffix() -> None:
 
     assert remove_common_suffix(test_files) == correct_res
 
+    test_files = ["s1_T1", "s22_T1", "x_T1"]
+    assert remove_common_suffix(test_files) == ["s1", "s22", "x"]
+    assert remove_common_suffix(["a_T1", "a_T1"]) == ["a", "a"]
+    assert remove_common_suffix([]) == []
+
+
+def testing_scan_img_dir(tmp_path: str) -> None:
+    in_dir = os.path.join(tmp_path, "in")
+    os.makedirs(os.path.join(in_dir, "sub-01", "anat"))
+    nii = nib.Nifti1Image(np.zeros((2, 2, 2), np.uint8), np.eye(4))
+    for fname in ["s1_T1.nii.gz", "sub-01/anat/s2_T1.nii.gz", "s3_T1.nii"]:
+        nii.to_filename(os.path.join(in_dir, fname))
+    for fname in [".s4_T1.nii.gz", "bad_T1.nii.gz", "notes.txt"]:
+        with open(os.path.join(in_dir, fname), "w") as f:
+            f.write("x")
+
+    # .nii images first, hidden files skipped
+    files = [os.path.basename(x) for x in scan_img_dir(in_dir)]
+    assert files[0] == "s3_T1.nii"
+    assert sorted(files[1:]) == ["bad_T1.nii.gz", "s1_T1.nii.gz"]
+    assert len(scan_img_dir(in_dir, recursive=True)) == 4
+
+    df_img = make_img_list(in_dir, recursive=True, check_headers=True)
+    assert sorted(df_img.MRID) == ["s1", "s2", "s3"]
+
+    # The cached list is used while the scanned folders keep their modification time
+    cache_file = os.path.join(tmp_path, "scan.json")
+    files = scan_img_dir(in_dir, True, cache_file)
+    mtime = os.stat(in_dir).st_mtime_ns
+    os.remove(os.path.join(in_dir, "s3_T1.nii"))
+    os.utime(in_dir, ns=(mtime, mtime))
+    assert scan_img_dir(in_dir, True, cache_file) == files
+    nii.to_filename(os.path.join(in_dir, "sub-01", "anat", "s5_T1.nii.gz"))
+    assert len(scan_img_dir(in_dir, True, cache_file)) == 4
+
 
 def testing_make_img_list() -> None:
     os.system("mkdir test_dataset")
@@ -76,9 +116,58 @@ def testing_collect_T1() -> None:
     os.system("rm -r test_collect_T1")
 
 
+def testing_index_bids(tmp_path: str) -> None:
+    in_dir = os.path.join(tmp_path, "bids")
+    fnames = [
+        "sub-01/anat/sub-01_T1w.nii.gz",
+        "sub-01/anat/sub-01_T1w.json",
+        "sub-02/ses-1/anat/sub-02_ses-1_run-1_T1w.nii.gz",
+        "sub-02/ses-1/anat/sub-02_ses-1_run-2_T1w.nii.gz",
+        "sub-02/ses-1/anat/sub-02_ses-1_FLAIR.nii.gz",
+        "sub-03/ses-2/anat/sub-03_ses-2_T1w.nii",
+        "derivatives/sub-01/anat/sub-01_T1w.nii.gz",
+    ]
+    for fname in fnames:
+        os.makedirs(os.path.dirname(os.path.join(in_dir, fname)), exist_ok=True)
+        with open(os.path.join(in_dir, fname), "w") as f:
+            f.write("x")
+
+    # The images are listed in place, with their session and anat folder
+    manifest = os.path.join(tmp_path, "list.txt")
+    df_bids = index_bids(in_dir, manifest)
+    assert list(df_bids.img_prefix) == [
+        "sub-01_T1w",
+        "sub-02_ses-1_run-1_T1w",
+        "sub-02_ses-1_run-2_T1w",
+        "sub-03_ses-2_T1w",
+    ]
+    assert list(df_bids.session_id.fillna("")) == ["", "ses-1", "ses-1", "ses-2"]
+    df_img = make_img_list(manifest)
+    assert list(df_img.img_path) == list(df_bids.img_path)
+    assert list(df_img.MRID) == [
+        "sub-01",
+        "sub-02_ses-1_run-1",
+        "sub-02_ses-1_run-2",
+        "sub-03_ses-2",
+    ]
+
+    # The segmentations are moved to the anat folder of their input image
+    out_dir = os.path.join(tmp_path, "out")
+    os.makedirs(out_dir)
+    for img_prefix in df_bids.img_prefix:
+        with open(os.path.join(out_dir, img_prefix + "_DLMUSE.nii.gz"), "w") as f:
+            f.write("x")
+    merge_bids_output_data(out_dir, df_bids)
+    for anat_dir, img_prefix in zip(df_bids.anat_dir, df_bids.img_prefix):
+        out_img = os.path.join(out_dir, anat_dir, img_prefix + "_DLMUSE.nii.gz")
+        assert os.path.exists(out_img)
+
+
 def testing_split_data() -> None:
     if os.path.exists("test_split_data"):
         os.system("rm -r test_split_data")
+    if os.path.exists("test_split_out"):
+        os.system("rm -r test_split_out")
 
     def generate_random_test_folders(no_files: int = 15) -> None:
         os.system("mkdir test_split_data")
@@ -88,58 +177,51 @@ def testing_split_data() -> None:
             else:
                 os.system(f"touch test_split_data/IXI-1{i}-Guys-0000-T1.nii.gz")
 
-    def check_subfolder_count(no_folders: int, count_in: int, count_last: int) -> None:
-        subfldr_files = []
-        for idx, subfldr in enumerate(os.listdir("test_split_data")):
-            joined = os.path.join("test_split_data", subfldr)
-            if idx < no_folders and os.path.isdir(joined):
-                subfldr_files.append(len(os.listdir(joined)))
-            elif idx >= no_folders and os.path.isdir(joined):
-                subfldr_files.append(len(os.listdir(joined)))
-
-        in_count: int = 0
-        last_count: int = 0
-
-        for files in subfldr_files:
-            if files == count_in:
-                in_count += 1
-            else:
-                last_count += 1
-
-        assert (last_count == 1 if count_in != count_last else last_count == 0) and (
-            in_count == no_folders - 1
-            if count_in != count_last
-            else in_count == no_folders
-        )
+    def check_manifest_count(
+        subfolders: list, no_folders: int, count_in: int, count_last: int
+    ) -> None:
+        assert len(subfolders) == no_folders
+        counts = []
+        for manifest in subfolders:
+            with open(manifest) as f:
+                counts.append(len(f.readlines()))
+        assert counts[:-1] == [count_in] * (no_folders - 1)
+        assert counts[-1] == count_last
+
+        # The input folder is left untouched and all images are listed once
+        assert len(os.listdir("test_split_data")) == sum(counts)
+        df_all = pd.concat([make_img_list(x) for x in subfolders])
+        assert len(set(df_all["img_path"])) == sum(counts)
 
     generate_random_test_folders(12)
-    subfolders: list = split_data("test_split_data", 4)
-
-    assert len(subfolders) == 4
-    check_subfolder_count(4, 3, 3)
-    os.system("rm -r test_split_data")
+    subfolders: list = split_data("test_split_data", 4, "test_split_out")
+    check_manifest_count(subfolders, 4, 3, 3)
+    os.system("rm -r test_split_data test_split_out")
 
     generate_random_test_folders(20)
-    subfolders = split_data("test_split_data", 4)
-
-    assert len(subfolders) == 4
-    check_subfolder_count(4, 5, 5)
-    os.system("rm -r test_split_data")
+    subfolders = split_data("test_split_data", 4, "test_split_out")
+    check_manifest_count(subfolders, 4, 5, 5)
+    os.system("rm -r test_split_data test_split_out")
 
     generate_random_test_folders(35)
-    subfolders = split_data("test_split_data", 4)
-
-    assert len(subfolders) == 4
-    check_subfolder_count(4, 9, 8)
-    os.system("rm -r test_split_data")
+    subfolders = split_data("test_split_data", 4, "test_split_out")
+    check_manifest_count(subfolders, 4, 9, 8)
+    os.system("rm -r test_split_data test_split_out")
 
     generate_random_test_folders(1)
-    subfolders = split_data("test_split_data", 4)
+    subfolders = split_data("test_split_data", 4, "test_split_out")
+    check_manifest_count(subfolders, 1, 1, 1)
+    os.system("rm -r test_split_data test_split_out")
 
-    assert len(subfolders) == 1
-    print(len(subfolders))
-    check_subfolder_count(1, 1, 1)
-    os.system("rm -r test_split_data")
+    generate_random_test_folders(10)
+    subfolders = split_data("test_split_data", 3, "test_split_out", "symlink")
+    assert [len(os.listdir(x)) for x in subfolders] == [4, 4, 2]
+    assert all(
+        os.path.islink(os.path.join(x, f)) for x in subfolders for f in os.listdir(x)
+    )
+    remove_subfolders("test_split_out")
+    assert len(os.listdir("test_split_out")) == 0
+    os.system("rm -r test_split_data test_split_out")
 
 
 def testing_remove_subfolders() -> None:
@@ -0,0 +1,40 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from NiChart_DLMUSE.CalcROIVol import create_roi_csv, get_single_roi_indices
+from NiChart_DLMUSE.dlmuse_pipeline import DICT_MUSE_DERIVED, DICT_MUSE_SINGLE
+from NiChart_DLMUSE.volumes import make_label_list, recompute_volumes, rederive_volumes
+
+
+def testing_recompute_volumes(tmp_path: str) -> None:
+    rng = np.random.default_rng(0)
+    labels = np.array((0,) + get_single_roi_indices(DICT_MUSE_SINGLE))
+    dfs = []
+    for mrid in ["s1", "s2", "s3"]:
+        img = labels[rng.integers(0, len(labels), (16, 16, 16))].astype(np.uint8)
+        nii = nib.Nifti1Image(img, np.diag([1.0, 1.0, 1.2, 1.0]))
+        nii.to_filename(os.path.join(tmp_path, mrid + "_T1_DLMUSE.nii.gz"))
+        out_csv = os.path.join(tmp_path, mrid + "_ref.csv")
+        create_roi_csv(mrid, nii, DICT_MUSE_SINGLE, DICT_MUSE_DERIVED, out_csv)
+        dfs.append(pd.read_csv(out_csv, dtype={"MRID": str}))
+    df_ref = pd.concat(dfs).set_index("MRID")
+
+    # Images without the DLMUSE suffix are ignored
+    nii.to_filename(os.path.join(tmp_path, "s1_T1.nii.gz"))
+    assert sorted(make_label_list(str(tmp_path)).MRID) == ["s1", "s2", "s3"]
+
+    out_csv = os.path.join(tmp_path, "DLMUSE_Volumes.csv")
+    counts_file = os.path.join(tmp_path, "DLMUSE_LabelCounts.npz")
+    recompute_volumes(str(tmp_path), out_csv, 2, label_counts=counts_file)
+    df = pd.read_csv(out_csv, dtype={"MRID": str}).set_index("MRID")
+    pd.testing.assert_frame_equal(df.loc[df_ref.index], df_ref)
+
+    # Same tables from the saved label counts
+    out_csv2 = os.path.join(tmp_path, "DLMUSE_Volumes2.csv")
+    rederive_volumes(counts_file, out_csv2)
+    pd.testing.assert_frame_equal(
+        pd.read_csv(out_csv2, dtype={"MRID": str}).set_index("MRID"), df
+    )